@@ -138,7 +138,8 @@ def get_decoder_name_full(entry):
 def get_decoder(entry):
     entry = lookup_task_entries(entry)
     filename = get_decoder_name_full(entry)
-    dec = pickle.load(open(filename, 'r'))
+    from riglib.bmi import decoder_store
+    dec = decoder_store.load(filename)
     dec.db_entry = get_decoder_entry(entry)
     dec.name = dec.db_entry.name
     return dec
@@ -330,12 +331,17 @@ def search_by_units(unitlist, decoderlist = None, exact=False):
         all_decoders = decoderlist
     else:
         all_decoders = models.Decoder.objects.using(db_name).all()
+    from riglib.bmi import decoder_store
     subset = set(tuple(unit) for unit in unitlist)
     dec_list = []
     for dec in all_decoders:
         try:
-            decobj = cPickle.load(open(db.paths.data_path+'/decoders/'+dec.path))
-            decset = set(tuple(unit) for unit in decobj.units)
+            decoder_fname = db.paths.data_path+'/decoders/'+dec.path
+            if decoder_store.is_decoder_file(decoder_fname):
+                dec_units = decoder_store.read_header(decoder_fname)['decoder']['units']
+            else:
+                dec_units = cPickle.load(open(decoder_fname)).units
+            decset = set(tuple(unit) for unit in dec_units)
             if subset==decset:
                 dec_list = dec_list + [dec]
             elif not exact and subset.issubset(decset):
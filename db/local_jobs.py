@@ -0,0 +1,324 @@
+'''
+Executor for running decoder training jobs in local worker processes, for rigs
+without a celery broker. Jobs run in parallel (up to a maximum number at a time) without
+blocking the web server. Preparation steps which are shared between jobs, e.g., parsing
+the neural data file of a block, are identified by a key and run only once.
+'''
+import sys
+import time
+import Queue
+import threading
+import traceback
+import cStringIO
+import collections
+import multiprocessing as mp
+
+
+def _init_worker():
+    # database connections inherited from the web server process must not be used by the workers
+    if 'django.db' in sys.modules:
+        from django.db import connections
+        for conn in connections.all():
+            conn.close()
+
+
+def _run(fn, args, kwargs):
+    '''
+    Run one job or step in a worker process. Exceptions are returned as a formatted traceback,
+    so that they can be reported by the parent process
+    '''
+    t_start = time.time()
+    try:
+        fn(*args, **kwargs)
+        err = None
+    except Exception:
+        buf = cStringIO.StringIO()
+        traceback.print_exc(None, buf)
+        err = buf.getvalue()
+    return time.time() - t_start, err
+
+
+def _worker_main(fn, args, kwargs, conn):
+    '''
+    Body of a worker process: run one job or step and send (elapsed time, error) back to the executor
+    '''
+    _init_worker()
+    conn.send(_run(fn, args, kwargs))
+    conn.close()
+
+
+class LocalJobExecutor(object):
+    '''
+    Runs jobs in worker processes, at most 'max_workers' at a time and in the order
+    in which they were submitted. A job can depend on steps (e.g., caching a .plx file) which
+    are identified by a key. A step is run once for all the jobs submitted while it is queued or
+    running; jobs submitted after the step completed do not run it again. If a step fails, the jobs
+    waiting for it fail and the step is run again for the next job which needs it.
+
+    Each job or step gets a new worker process, so that the memory used for training is given back 
+    when it finishes. A watcher thread collects the results; a worker which exits without a result 
+    (e.g., killed for running out of memory, or a crash in a C extension) fails its job or step.
+    '''
+    poll_interval = 0.05 # seconds between checks of the running worker processes
+
+    def __init__(self, max_workers=2, notify=None):
+        '''
+        Constructor for LocalJobExecutor
+
+        Parameters
+        ----------
+        max_workers : int, optional, default=2
+            Maximum number of jobs/steps to run at the same time
+        notify : callable, optional
+            Called with a progress message (string) whenever a job or step is queued, started,
+            finished or failed. The messages are queued and delivered in order by a single notifier
+            thread of the executor, so 'notify' is never called from the thread watching the workers
+            or while the executor is locked. It must still be safe to call from a thread other than
+            the one which created the executor
+
+        Returns
+        -------
+        LocalJobExecutor instance
+        '''
+        self.max_workers = max_workers
+        self.notify = notify
+        self.jobs = collections.OrderedDict()
+
+        self._lock = threading.RLock()
+        self._ready = collections.deque()
+        self._n_running = 0
+        self._steps = dict() # key -> dict(state, waiting)
+        self._next_id = 1
+        self._running = dict() # (kind, key) -> (worker process, end of the pipe for its result)
+        self._stopped = threading.Event()
+
+        self._watcher = threading.Thread(target=self._watch_workers, name='LocalJobExecutor-watch')
+        self._watcher.daemon = True
+        self._watcher.start()
+
+        self._notifications = Queue.Queue()
+        self._notifier = threading.Thread(target=self._deliver_notifications, name='LocalJobExecutor-notify')
+        self._notifier.daemon = True
+        self._notifier.start()
+
+    def _notify(self, msg):
+        self._notifications.put(msg)
+
+    def _deliver_notifications(self):
+        '''
+        Body of the notifier thread: pass the queued progress messages to 'notify' until shutdown
+        '''
+        while True:
+            msg = self._notifications.get()
+            if msg is None:
+                break
+            if self.notify is not None:
+                try:
+                    self.notify(msg)
+                except Exception:
+                    traceback.print_exc()
+
+    def submit(self, name, fn, args=(), kwargs=None, steps=[]):
+        '''
+        Queue a job
+
+        Parameters
+        ----------
+        name : string
+            Name of the job, for the progress messages
+        fn : callable
+            Function to run in a worker process (forked from this one)
+        args : tuple, optional
+            Positional arguments to fn
+        kwargs : dict, optional
+            Keyword arguments to fn
+        steps : list of (key, fn, args) tuples, optional
+            Steps to complete before the job is started. Steps with the same key are only run once
+
+        Returns
+        -------
+        job_id : int
+        '''
+        with self._lock:
+            job_id = self._next_id
+            self._next_id += 1
+            job = dict(name=name, state='queued', submitted=time.time(), elapsed=None, error=None,
+                call=(fn, tuple(args), dict() if kwargs is None else dict(kwargs)), pending=set())
+            self.jobs[job_id] = job
+
+            for key, step_fn, step_args in steps:
+                step = self._steps.get(key, None)
+                if step is not None and step['state'] == 'done':
+                    continue
+                job['pending'].add(key)
+                if step is None:
+                    self._steps[key] = dict(state='queued', waiting=[job_id])
+                    # steps go ahead of the queued jobs, which are likely waiting for them
+                    self._ready.appendleft(('step', key, (step_fn, tuple(step_args), dict())))
+                    self._notify("Queued step %s\n" % key)
+                else:
+                    step['waiting'].append(job_id)
+
+            if len(job['pending']) > 0:
+                job['state'] = 'waiting'
+                self._notify("Queued job %d (%s), waiting for %s\n" % (job_id, name, ', '.join(sorted(job['pending']))))
+            else:
+                self._ready.append(('job', job_id, job['call']))
+                self._notify("Queued job %d (%s)\n" % (job_id, name))
+            self._dispatch()
+        return job_id
+
+    def _dispatch(self):
+        '''
+        Start queued jobs/steps while there are free workers
+        '''
+        with self._lock:
+            while self._n_running < self.max_workers and len(self._ready) > 0 and not self._stopped.is_set():
+                kind, key, (fn, args, kwargs) = self._ready.popleft()
+                self._n_running += 1
+                if kind == 'step':
+                    self._steps[key]['state'] = 'running'
+                    self._notify("Running step %s\n" % key)
+                else:
+                    self.jobs[key]['state'] = 'running'
+                    self._notify("Started job %d (%s)\n" % (key, self.jobs[key]['name']))
+                conn, child_conn = mp.Pipe(duplex=False)
+                # daemonic, like the workers of a multiprocessing.Pool, so they are stopped with the web server
+                proc = mp.Process(target=_worker_main, args=(fn, args, kwargs, child_conn))
+                proc.daemon = True
+                proc.start()
+                child_conn.close()
+                self._running[(kind, key)] = (proc, conn)
+
+    def _collect(self, proc, conn):
+        '''
+        Result of a worker process, or None if it is still running. A worker which exits without 
+        sending its result is reported as an error
+        '''
+        if not conn.poll() and proc.is_alive():
+            return None
+        try:
+            result = conn.recv()
+        except EOFError:
+            # the pipe is closed without a result once the worker has exited
+            result = None
+        proc.join()
+        if result is None:
+            result = (None, "Worker process (pid %d) exited with code %s without returning a result\n" % (proc.pid, proc.exitcode))
+        conn.close()
+        return result
+
+    def _watch_workers(self):
+        '''
+        Body of the watcher thread: collect the results of the worker processes until shutdown
+        '''
+        while not self._stopped.is_set():
+            with self._lock:
+                for (kind, key), (proc, conn) in self._running.items():
+                    result = self._collect(proc, conn)
+                    if result is not None:
+                        del self._running[(kind, key)]
+                        self._finished(kind, key, result)
+            self._stopped.wait(self.poll_interval)
+
+    def _finished(self, kind, key, result):
+        '''
+        Record the result (elapsed time, error) of a job or step, in the watcher thread
+        '''
+        elapsed, err = result
+        with self._lock:
+            self._n_running -= 1
+            if kind == 'step':
+                step = self._steps[key]
+                if err is None:
+                    step['state'] = 'done'
+                    self._notify("Finished step %s in %.1f s\n" % (key, elapsed))
+                else:
+                    # forget the step so that the next job which needs it tries again
+                    del self._steps[key]
+                    self._notify("Step %s failed:\n%s" % (key, err))
+
+                for job_id in step['waiting']:
+                    job = self.jobs[job_id]
+                    if job['state'] != 'waiting':
+                        continue
+                    if err is not None:
+                        job['state'] = 'failed'
+                        job['error'] = "Step %s failed:\n%s" % (key, err)
+                        self._notify("Job %d (%s) failed: step %s failed\n" % (job_id, job['name'], key))
+                        continue
+                    job['pending'].discard(key)
+                    if len(job['pending']) == 0:
+                        self._ready.append(('job', job_id, job['call']))
+            else:
+                job = self.jobs[key]
+                job['elapsed'] = elapsed
+                job['error'] = err
+                if err is None:
+                    job['state'] = 'done'
+                    self._notify("Finished job %d (%s) in %.1f s\n" % (key, job['name'], elapsed))
+                else:
+                    job['state'] = 'failed'
+                    self._notify("Job %d (%s) failed:\n%s" % (key, job['name'], err))
+            self._dispatch()
+
+    def status(self, job_id):
+        '''
+        State of a job: 'queued', 'waiting' (for a step), 'running', 'done' or 'failed'
+        '''
+        with self._lock:
+            return self.jobs[job_id]['state']
+
+    def wait(self, job_ids=None, timeout=None, poll_interval=0.1):
+        '''
+        Block until the jobs are done or have failed
+
+        Parameters
+        ----------
+        job_ids : list of int, optional
+            Jobs to wait for. Defaults to all the submitted jobs
+        timeout : float, optional
+            Maximum time to wait, in seconds
+
+        Returns
+        -------
+        bool
+            True if all the jobs are done or have failed
+        '''
+        t_start = time.time()
+        while True:
+            with self._lock:
+                ids = self.jobs.keys() if job_ids is None else job_ids
+                if all(self.jobs[job_id]['state'] in ['done', 'failed'] for job_id in ids):
+                    return True
+            if timeout is not None and time.time() - t_start > timeout:
+                return False
+            time.sleep(poll_interval)
+
+    def shutdown(self, wait=True):
+        '''
+        Stop the worker processes and the threads of the executor. If 'wait' is true, the running and 
+        queued jobs are completed first; otherwise the queued jobs are dropped and the running ones are killed
+        '''
+        if wait:
+            self.wait()
+        with self._lock:
+            self._stopped.set()
+            for proc, conn in self._running.values():
+                proc.terminate()
+        self._watcher.join()
+
+        with self._lock:
+            for (kind, key), (proc, conn) in self._running.items():
+                del self._running[(kind, key)]
+                proc.join()
+                self._finished(kind, key, self._collect(proc, conn))
+            for job_id, job in self.jobs.items():
+                if job['state'] in ['queued', 'waiting']:
+                    job['state'] = 'failed'
+                    job['error'] = "Cancelled by shutdown\n"
+                    self._notify("Job %d (%s) cancelled\n" % (job_id, job['name']))
+
+        # deliver the remaining progress messages before stopping the notifier thread
+        self._notifications.put(None)
+        self._notifier.join()
@@ -43,7 +43,7 @@ class Track(object):
         self.tracker_end_of_pipe, self.task_end_of_pipe = mp.Pipe()
 
     def notify(self, msg):
-        if msg['status'] == "error" or msg['State'] == "stopped":
+        if msg['status'] == "error" or msg.get('State', None) == "stopped":
             self.status.value = ""
 
     def runtask(self, **kwargs):
@@ -2,6 +2,7 @@
 Handlers for AJAX (Javascript) functions used in the web interface to start 
 experiments and train BMI decoders
 '''
+import cgi
 import json
 
 import numpy as np
@@ -64,9 +65,19 @@ def train_decoder_ajax_handler(request, idx):
         kin_extractor=request.POST['kin_extractor'],
         zscore=request.POST['zscore'],
     )
-    trainbmi.cache_and_train(**kwargs)
+    if request.POST.get('cv_regularizers', '').strip() != '':
+        kwargs['cv_regularizers'] = map(float, request.POST['cv_regularizers'].split(','))
+        kwargs['cv_folds'] = int(request.POST.get('cv_folds', 5))
+    trainbmi.cache_and_train(notify=_training_progress, **kwargs)
     return _respond(dict(status="success"))
 
+def _training_progress(msg):
+    '''
+    Print progress messages of decoder training jobs on the web interface. Called from the notifier
+    thread of the local job executor; websocket.Server.send serializes the writes to the pipe
+    '''
+    exp_tracker.websock.send(dict(status="stdout", msg=cgi.escape(msg)))
+
 
 class encoder(json.JSONEncoder):
     '''
@@ -95,10 +95,13 @@ def save_bmi(name, entry, filename, dbname='default'):
     enums = dict([(e, i) for i, e in enumerate(entries.order_by("date"))])
     num = enums[entry]
 
-    pklname = "{subj}{time}_{num:02}_{name}.pkl".format(
+    from riglib.bmi import decoder_store
+    ext = decoder_store.FILE_EXT if decoder_store.is_decoder_file(filename) else '.pkl'
+
+    pklname = "{subj}{time}_{num:02}_{name}{ext}".format(
         subj=entry.subject.name[:4].lower(),
         time=entry.date.strftime('%Y%m%d'),
-        num=num, name=name)
+        num=num, name=name, ext=ext)
     base = System.objects.using(dbname).get(name='bmi').path
 
     #Make sure decoder name doesn't exist already:
@@ -107,10 +110,10 @@ def save_bmi(name, entry, filename, dbname='default'):
     dec_ix = 0
 
     while os.path.isfile(os.path.join(base, pklname)): 
-        pklname = "{subj}{time}_{num:02}_{name}_{ix}.pkl".format(
+        pklname = "{subj}{time}_{num:02}_{name}_{ix}{ext}".format(
         subj=entry.subject.name[:4].lower(),
         time=entry.date.strftime('%Y%m%d'),
-        num=num, name=name,ix=dec_ix)
+        num=num, name=name,ix=dec_ix, ext=ext)
         dec_ix += 1
 
     shutil.copy2(filename, os.path.join(base, pklname))
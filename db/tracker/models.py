@@ -827,11 +827,9 @@ class Decoder(models.Model):
         decoder_fname = os.path.join(data_path, 'decoders', self.path)
 
         if os.path.exists(decoder_fname):
-            fh = open(decoder_fname, 'r')
-            unpickler = cPickle.Unpickler(fh)
-            unpickler.find_global = decoder_unpickler
-            dec = unpickler.load() # object will now contain the new class path reference
-            fh.close()
+            from riglib.bmi import decoder_store
+            # pickled decoders will now contain the new class path reference
+            dec = decoder_store.load(decoder_fname, find_global=decoder_unpickler)
 
             dec.name = self.name
             return dec
@@ -843,8 +841,19 @@ class Decoder(models.Model):
         return self.load()
 
     def to_json(self):
-        dec = self.get()
+        from riglib.bmi import decoder_store
         decoder_data = dict(name=self.name, path=self.path)
+
+        # decoders in the binary format describe themselves in the file header, no need to load them
+        if os.path.exists(self.filename) and decoder_store.is_decoder_file(self.filename):
+            info = decoder_store.read_header(self.filename)['decoder']
+            decoder_data['cls'] = info['cls'].split('.')[-1],
+            decoder_data['units'] = info.get('units', [])
+            decoder_data['binlen'] = info.get('binlen', 0)
+            decoder_data['tslice'] = info.get('tslice', [])
+            return decoder_data
+
+        dec = self.get()
         if not (dec is None):
             decoder_data['cls'] = dec.__class__.__name__,
             if hasattr(dec, 'units'):
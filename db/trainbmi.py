@@ -21,7 +21,8 @@ from celery import task, chain
 from tracker import dbq
 
 import numpy as np
-from riglib.bmi import extractor, train
+from riglib.bmi import extractor, train, decoder_store
+from riglib.bmi.feature_cache import FeatureCache
 from config import config 
 
 import dbfunctions as dbfn
@@ -48,8 +49,17 @@ def cache_plx(plxfile):
     from plexon import plexfile
     plexfile.openFile(str(plxfile)) 
 
+def cache_nev(nev_fname, entry):
+    """
+    Convert a blackrock .nev file to HDF, unless it has already been converted (see train._get_tmask_blackrock)
+    """
+    if not os.path.isfile(nev_fname + '.hdf'):
+        te = models.TaskEntry.objects.get(id=entry)
+        models.parse_blackrock_file(nev_fname, None, te)
+
 @task()
-def make_bmi(name, clsname, extractorname, entry, cells, channels, binlen, tslice, ssm, pos_key, kin_extractor, zscore):
+def make_bmi(name, clsname, extractorname, entry, cells, channels, binlen, tslice, ssm, pos_key, kin_extractor, zscore, 
+    cv_regularizers=None, cv_folds=5, n_processes=1):
     """
     Create a new Decoder object from training data and save a record to the database
 
@@ -78,6 +88,13 @@ def make_bmi(name, clsname, extractorname, entry, cells, channels, binlen, tslic
         TODO
     pos_key : string
         TODO
+    cv_regularizers : list of float, optional
+        If specified, the regularizer of a KF decoder is chosen from these values by cross-validation
+        (see riglib.bmi.cross_validation)
+    cv_folds : int, optional, default=5
+        Number of cross-validation folds
+    n_processes : int, optional, default=1
+        Number of processes for the training computations which can run in parallel
     """
     print "make bmi"
     extractor_cls = namelist.extractors[extractorname]
@@ -148,19 +165,90 @@ def make_bmi(name, clsname, extractorname, entry, cells, channels, binlen, tslic
     training_method = namelist.bmi_algorithms[clsname]
     ssm = namelist.bmi_state_space_models[ssm]
     kin_extractor_fn = namelist.kin_extractors[kin_extractor]
+    training_kwargs = dict()
+    if cv_regularizers is not None:
+        training_kwargs.update(cv_regularizers=cv_regularizers, cv_folds=cv_folds)
+    if n_processes > 1:
+        training_kwargs['n_processes'] = n_processes
     decoder = training_method(files, extractor_cls, extractor_kwargs, kin_extractor_fn, ssm, units, update_rate=binlen, tslice=tslice, pos_key=pos_key,
-        zscore=zscore)
+        zscore=zscore, feature_cache=FeatureCache.default(), **training_kwargs)
+    if isinstance(decoder, tuple):
+        # train_KFDecoder also returns the training data
+        decoder = decoder[0]
     decoder.te_id = entry
 
-    tf = tempfile.NamedTemporaryFile('wb')
-    cPickle.dump(decoder, tf, 2)
-    tf.flush()
-    database.save_bmi(name, int(entry), tf.name)
+    decoder_fname = decoder.save(binary=True)
+    database.save_bmi(name, int(entry), decoder_fname)
+    os.remove(decoder_fname)
+
+def _training_jobs_config():
+    """
+    Settings of the optional [training_jobs] section of the config file. 'backend' is 'celery' (default) 
+    or 'local', to run the training jobs in local worker processes without a celery broker. 'max_workers' 
+    is the number of local worker processes (default 2)
+    """
+    settings = dict()
+    try:
+        settings = config.training_jobs
+    except Exception:
+        pass
+    return settings.get('backend', 'celery'), int(settings.get('max_workers', 2))
+
+_local_executor = None
+def get_local_executor():
+    """
+    Executor for the 'local' training backend, created on first use
+    """
+    global _local_executor
+    if _local_executor is None:
+        from local_jobs import LocalJobExecutor
+        backend, max_workers = _training_jobs_config()
+        _local_executor = LocalJobExecutor(max_workers=max_workers)
+    return _local_executor
+
+def _run_local(fn_name, *args, **kwargs):
+    """
+    Run one of the (celery) tasks of this module directly, in a local worker process
+    """
+    globals()[fn_name](*args, **kwargs)
+
+def _cache_and_train_local(notify, *args, **kwargs):
+    """
+    Queue the training job (and caching/parsing of the neural data file, once per file) on the local executor
+    """
+    executor = get_local_executor()
+    if notify is not None:
+        executor.notify = notify
+
+    entry = kwargs['entry']
+    steps = []
+    if config.recording_sys['make'] == 'plexon':
+        plxfile = models.DataFile.objects.get(system__name='plexon', entry=entry)
+        if not plxfile.has_cache():
+            plx_fname = plxfile.get_path()
+            steps.append(('plexon:%s' % plx_fname, _run_local, ('cache_plx', plx_fname)))
+    elif config.recording_sys['make'] == 'blackrock':
+        for datafile in models.DataFile.objects.filter(system__name='blackrock', entry=entry):
+            nev_fname = datafile.get_path()
+            if nev_fname.endswith('.nev') and not os.path.isfile(nev_fname + '.hdf'):
+                steps.append(('blackrock:%s' % nev_fname, cache_nev, (nev_fname, entry)))
+    else:
+        raise Exception('Unknown recording_system!')
+
+    # the workers of the executor cannot start processes of their own
+    kwargs.pop('n_processes', None)
+    return executor.submit(kwargs.get('name', 'decoder'), _run_local, ('make_bmi',) + args, kwargs, steps=steps)
 
 def cache_and_train(*args, **kwargs):
     """
-    Cache plexon file (if using plexon system) and train BMI.
+    Cache plexon file (if using plexon system) and train BMI. The jobs are run by celery, or in 
+    local worker processes if configured (see _training_jobs_config). The optional keyword 
+    argument 'notify' is a function to call with progress messages of the local jobs.
     """
+    notify = kwargs.pop('notify', None)
+    backend, max_workers = _training_jobs_config()
+    if backend == 'local':
+        return _cache_and_train_local(notify, *args, **kwargs)
 
     # import config
     if config.recording_sys['make'] == 'plexon':
@@ -221,11 +309,11 @@ def conv_mm_dec_to_cm(decoder_record):
     decoder_fname = os.path.join('/storage/decoders/', decoder_record.path)
     print decoder_fname
     decoder_name = decoder_record.name
-    dec = pickle.load(open(decoder_fname))
+    dec = decoder_store.load(decoder_fname)
     from riglib.bmi import train
     dec_cm = train.rescale_KFDecoder_units(dec, 10)
 
-    new_decoder_basename = os.path.basename(decoder_fname).rstrip('.pkl') + '_cm.pkl'
+    new_decoder_basename = os.path.splitext(os.path.basename(decoder_fname))[0] + '_cm.pkl'
     new_decoder_fname = '/tmp/%s' % new_decoder_basename
     pickle.dump(dec_cm, open(new_decoder_fname, 'w'))
 
@@ -250,12 +338,12 @@ def conv_kfdecoder_to_ppfdecoder(decoder_record):
     decoder_fname = os.path.join('/storage/decoders/', decoder_record.path)
     print decoder_fname
     decoder_name = decoder_record.name
-    dec = pickle.load(open(decoder_fname))
+    dec = decoder_store.load(decoder_fname)
 
     from riglib.bmi import train
     dec_ppf = train.convert_KFDecoder_to_PPFDecoder(dec)
 
-    new_decoder_basename = os.path.basename(decoder_fname).rstrip('.pkl') + '_ppf.pkl'
+    new_decoder_basename = os.path.splitext(os.path.basename(decoder_fname))[0] + '_ppf.pkl'
     new_decoder_fname = '/tmp/%s' % new_decoder_basename
     pickle.dump(dec_ppf, open(new_decoder_fname, 'w'))
 
@@ -280,12 +368,12 @@ def make_kfdecoder_interpolate(decoder_record):
     decoder_fname = os.path.join('/storage/decoders/', decoder_record.path)
     print decoder_fname
     decoder_name = decoder_record.name
-    dec = pickle.load(open(decoder_fname))
+    dec = decoder_store.load(decoder_fname)
 
     from riglib.bmi import train
     dec_ppf = train._interpolate_KFDecoder_state_between_updates(dec)
 
-    new_decoder_basename = os.path.basename(decoder_fname).rstrip('.pkl') + '_ppf.pkl'
+    new_decoder_basename = os.path.splitext(os.path.basename(decoder_fname))[0] + '_ppf.pkl'
     new_decoder_fname = '/tmp/%s' % new_decoder_basename
     pickle.dump(dec_ppf, open(new_decoder_fname, 'w'))
 
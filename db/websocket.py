@@ -8,6 +8,7 @@ import sys
 import cgi
 import json
 import struct
+import threading
 import multiprocessing as mp
 import tornado.ioloop
 import tornado.web
@@ -55,6 +56,9 @@ class Server(mp.Process):
         self._outp, self.outp = os.pipe()
         self.outqueue = ""
         self.notify = notify
+        # messages are sent from the request threads of the web server and from the notifier thread 
+        # of the local training jobs; a long message takes more than one (atomic) write to the pipe
+        self._send_lock = threading.Lock()
         self.start()
 
     def run(self):
@@ -82,7 +86,10 @@ class Server(mp.Process):
             msg = json.dumps(msg)
 
         # Write to 'self.pipe'. The write apparently triggers the function self._stdout to run 
-        os.write(self.pipe, struct.pack('I', len(msg))+msg)
+        data = struct.pack('I', len(msg))+msg
+        with self._send_lock:
+            while len(data) > 0:
+                data = data[os.write(self.pipe, data):]
 
     def _stdout(self, fd, event):
         '''
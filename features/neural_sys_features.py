@@ -36,6 +36,8 @@ class CorticalData(object):
             self.neurondata = self._neural_src_type(self._neural_src_system_type, **self._neural_src_kwargs)
         elif 'spike' in self.decoder.extractor_cls.feature_type:  # e.g., 'spike_counts'
             self.neurondata = source.DataSource(sys_module.Spikes, **kwargs)
+        elif 'cluster' in self.decoder.extractor_cls.feature_type:  # e.g., 'cluster_counts'
+            self.neurondata = source.DataSource(sys_module.SpikeWaveforms, **kwargs)
         elif 'lfp' in self.decoder.extractor_cls.feature_type:  # e.g., 'lfp_power'
             self.neurondata = source.MultiChanDataSource(sys_module.LFP, **kwargs)
         else:
@@ -14,6 +14,7 @@ import os
 import tables
 import datetime
 import copy
+import pickle
 
 
 class GaussianState(object):
@@ -697,6 +698,90 @@ class Decoder(object):
             output.append(self.filt.get_mean())
         return np.vstack(output)
 
+    def decode_batch(self, neural_obs, max_chunk=256, **kwargs):
+        '''
+        Decode multiple observations in one pass. Gives the same output as 'decode', but once the filter 
+        is in steady state (x_t = F*x_{t-1} + K*y_t) the observations are z-scored and multiplied by the gain 
+        as one matrix, leaving only the small state recursion to run sequentially. Observations before the 
+        filter reaches steady state (and all of them, for filters without a steady state) are decoded with 'predict'.
+
+        Parameters
+        ----------
+        neural_obs: np.array of shape (# features, # observations)
+            Independent neural observations are columns of the data
+            matrix and are decoded sequentially
+        max_chunk: int, optional, default=256
+            The state bounder (if any) is applied to chunks of up to this many decoded states at a 
+            time. Must be a column-wise operation, e.g., clipping each state to a range
+        kwargs: dict
+            Container for special keyword-arguments for the specific decoding
+            algorithm's 'predict'. If any are specified, this is the same as 'decode'
+
+        Returns
+        -------
+        np.array of shape (# observations, # states)
+        '''
+        if len(kwargs) > 0:
+            return self.decode(neural_obs, **kwargs)
+
+        neural_obs = np.asarray(neural_obs)
+        n_obs = neural_obs.shape[1]
+        output = np.zeros([n_obs, len(self.filt.get_mean())])
+
+        # run the time-varying filter until it reaches steady state
+        get_steady_state_gains = getattr(self.filt, 'get_steady_state_gains', lambda: None)
+        k = 0
+        gains = get_steady_state_gains()
+        while k < n_obs and gains is None:
+            self.predict(neural_obs[:,k])
+            output[k] = self.filt.get_mean()
+            k += 1
+            gains = get_steady_state_gains()
+        if k == n_obs:
+            return output
+
+        F, K = gains
+        obs = np.array(neural_obs[:,k:], dtype=np.float64)
+        if hasattr(self, 'zscore') and self.zscore:
+            mFR = np.asarray(self.mFR).ravel()
+            obs = (obs - mFR[:,np.newaxis]) * (1./np.asarray(self.sdFR).ravel())[:,np.newaxis]
+            obs[self.zeromeanunits] = mFR[self.zeromeanunits][:,np.newaxis]
+        Ky = np.dot(K, obs).T
+
+        bounder = getattr(self, 'bounder', None)
+        x = np.array(self.filt.state.mean, dtype=np.float64).ravel()
+        states = np.empty_like(Ky)
+        chunk = max_chunk
+        t = 0
+        while t < states.shape[0]:
+            stop = min(t + chunk, states.shape[0])
+            for j in range(t, stop):
+                x = np.dot(F, x) + Ky[j]
+                states[j] = x
+
+            if bounder is None:
+                t = stop
+                continue
+
+            # Bounding is rare, so it is checked for a whole chunk at once. If a state had 
+            # to be bounded, the recursion is restarted from the bounded state
+            bounded = np.asarray(bounder(np.mat(states[t:stop].T), self.states)).T
+            changed, = np.nonzero(np.any(bounded != states[t:stop], axis=1))
+            if len(changed) == 0:
+                t = stop
+                chunk = min(2*chunk, max_chunk)
+            else:
+                j = t + changed[0]
+                states[j] = bounded[changed[0]]
+                x = states[j]
+                t = j + 1
+                chunk = 1
+        output[k:] = states
+
+        # leave the filter in the same state as if 'predict' had been called on each observation
+        self.filt.state.mean = np.mat(x.reshape(-1,1))
+        return output
+
     def __str__(self):
         if hasattr(self, 'db_entry'):
             return self.db_entry.name
@@ -735,7 +820,7 @@ class Decoder(object):
         self.predict(obs_t, **kwargs)
         return self.filt.get_mean().reshape(-1,1)
 
-    def save(self, filename=''):
+    def save(self, filename='', binary=False):
         '''
         Pickle the Decoder object to a file
 
@@ -743,13 +828,22 @@ class Decoder(object):
         ----------
         filename: string, optional
             Filename to pickle the decoder to. If unspecified, a temporary file will be created.
+        binary: bool, optional, default=False
+            Save in the memory-mappable format of riglib.bmi.decoder_store instead of as a pickle
 
         Returns
         -------
         filename: string
             filename of pickled Decoder object 
         '''
-        if filename is not '':
+        if binary:
+            import decoder_store
+            if filename is '':
+                import tempfile
+                fd, filename = tempfile.mkstemp(suffix=decoder_store.FILE_EXT)
+                os.close(fd)
+            return decoder_store.save_decoder(self, filename)
+        elif filename is not '':
             f = open(filename, 'w')
             pickle.dump(self, f)
             f.close()
@@ -815,11 +909,22 @@ class BMISystem(object):
         self.learner = learner
         self.updater = updater
         self.feature_accumulator = feature_accumulator
+
+        # history of parameter updates. Replaced by a CLDAParamHistStream to save the updates as they happen
         self.param_hist = []
 
+        # if set to a list, each observation decoded is appended to it (e.g., for the shadow decoders)
+        self.decoded_obs = None
+
         self.has_updater = not (self.updater is None)
         if self.has_updater:
             self.updater.init(self.decoder)
+            suff_stats_cls = getattr(self.updater, 'suff_stats_cls', None)
+            if suff_stats_cls is not None and hasattr(self.learner, 'suff_stats'):
+                # the learner accumulates the statistics the updater needs as the samples arrive
+                self.learner.suff_stats = suff_stats_cls()
+            if hasattr(self.updater, 'start'):
+                self.updater.start(self.decoder, batch_size=getattr(self.learner, 'batch_size', None))
 
     def __call__(self, neural_obs, target_state, task_state, learn_flag=False, **kwargs):
         '''
@@ -880,6 +985,8 @@ class BMISystem(object):
                 prev_state = self.decoder.get_state()
                 
                 self.decoder(decodable_obs, **kwargs)
+                if self.decoded_obs is not None:
+                    self.decoded_obs.append(np.array(decodable_obs, dtype=np.float64).ravel())
 
                 # Determine whether the current state or previous state should be given to the learner
                 if self.learner.input_state_index == 0:
@@ -906,14 +1013,15 @@ class BMISystem(object):
                 self.learner.disable() 
 
             new_params = None # by default, no new parameters are available
-            if self.has_updater:
-                new_params = copy.deepcopy(self.updater.get_result())
+            if self.has_updater and self.updater.result_ready():
+                # with a worker process, the result belongs to a batch submitted on an earlier call
+                new_params, update_batch = self.updater.get_result(with_batch=True)
 
             # Update the decoder if new parameters are available
             if not (new_params is None):
                 self.decoder.update_params(new_params, **self.updater.update_kwargs)
-                new_params['intended_kin'] = batch_data['intended_kin']
-                new_params['spike_counts_batch'] = batch_data['spike_counts']
+                new_params['intended_kin'] = update_batch['intended_kin']
+                new_params['spike_counts_batch'] = update_batch['spike_counts']
 
                 self.learner.enable()
                 update_flag = True
@@ -923,12 +1031,148 @@ class BMISystem(object):
         return decoded_states, update_flag
 
 
+class CLDAParamHistStream(object):
+    '''
+    Stand-in for the list BMISystem.param_hist which sends each parameter update to the 
+    HDF sink (the 'clda' table of the HDF file) as it happens, instead of keeping the 
+    whole history in memory until the end of the experiment. The table is registered 
+    when the stream is created, so its dtype must be known before the first update
+    '''
+    # columns holding the samples of a batch. Batches ended early (e.g., by a done state of the 
+    # learner) are written into the first columns, and the rest are NaN's
+    batch_columns = ('intended_kin', 'spike_counts_batch')
+
+    def __init__(self, sink, dtype, table_name='clda', ignore_none=False):
+        '''
+        Constructor for CLDAParamHistStream
+
+        Parameters
+        ----------
+        sink : riglib.sink.DataSink instance
+            HDF sink to send the parameter updates to. Only this sink receives the updates, 
+            unlike the data registered with the SinkManager, which goes to all the sinks
+        dtype : np.dtype
+            Record dtype of the table, see 'updater_dtype'
+        table_name : string, optional, default='clda'
+            Name of the table to register with the sink
+        ignore_none : bool, optional, default=False
+            If False, 'None' updates are saved as rows of NaN's
+
+        Returns
+        -------
+        CLDAParamHistStream instance
+        '''
+        self.sink = sink
+        self.dtype = dtype
+        self.table_name = table_name
+        self.ignore_none = ignore_none
+        self.n_updates = 0
+        self.sink.register(self.table_name, self.dtype)
+
+    @staticmethod
+    def table_dtype(param_update):
+        '''
+        Record dtype for a table of parameter updates with the same keys and shapes as 'param_update'
+        '''
+        dtype = []
+        for col_name in param_update.keys():
+            if isinstance(param_update[col_name], float):
+                shape = (1,)
+            else:
+                shape = param_update[col_name].shape
+            dtype.append((col_name.replace('.', '_'), 'f8', shape))
+        return np.dtype(dtype)
+
+    @staticmethod
+    def updater_dtype(decoder, param_names, batch_size):
+        '''
+        Record dtype for the updates of a CLDA updater, declared before any update is computed. 
+        The shape of each parameter is that of the decoder attribute it replaces; parameters which 
+        are not attributes of the decoder (e.g., 'rho') are scalars. The 'batch_len' column holds the 
+        number of samples of each batch, which can be smaller than 'batch_size'
+
+        Parameters
+        ----------
+        decoder : bmi.Decoder instance
+            Decoder being adapted
+        param_names : iterable of string
+            Keys of the parameter updates, see clda.Updater.param_names
+        batch_size : int
+            Maximum number of samples in each batch of the learner
+
+        Returns
+        -------
+        np.dtype
+        '''
+        params = dict()
+        for name in param_names:
+            value = decoder
+            for attr in name.split('.'):
+                value = getattr(value, attr, None)
+            params[name] = np.zeros(np.shape(value)) if np.ndim(value) > 0 else 0.
+        batch_size = max(int(np.ceil(batch_size)), 1)
+        params['intended_kin'] = np.zeros([decoder.n_states, batch_size])
+        params['spike_counts_batch'] = np.zeros([len(decoder.units), batch_size])
+        params['batch_len'] = 0.
+        return CLDAParamHistStream.table_dtype(params)
+
+    @classmethod
+    def table_row(cls, param_update, dtype):
+        '''
+        Convert a parameter update dictionary to a row of the table. 'None' becomes a row of NaN's, 
+        as do values which do not fit their column. Batches with fewer samples than the batch 
+        columns fill their first columns, and their length is saved in the 'batch_len' column
+        '''
+        data_row = np.zeros((1,), dtype=dtype)
+        if param_update is None:
+            for col_name in dtype.names:
+                data_row[col_name] = np.nan
+            return data_row
+
+        for col_name, value in param_update.items():
+            col_name = col_name.replace('.', '_')
+            if col_name not in dtype.names:
+                continue
+            value = np.asarray(value, dtype=np.float64)
+            shape = dtype[col_name].shape
+            if value.size == np.prod(shape):
+                data_row[col_name] = value.reshape(shape)
+            elif col_name in cls.batch_columns and value.ndim == 2 and len(shape) == 2 and \
+                value.shape[0] == shape[0] and value.shape[1] < shape[1]:
+                data_row[col_name] = np.nan
+                data_row[col_name][0, :, :value.shape[1]] = value
+            else:
+                data_row[col_name] = np.nan
+
+        if 'batch_len' in dtype.names and 'intended_kin' in param_update:
+            data_row['batch_len'] = np.shape(param_update['intended_kin'])[-1]
+        return data_row
+
+    def append(self, param_update):
+        '''
+        Send a parameter update to the sink
+        '''
+        self.n_updates += 1
+        if param_update is None and self.ignore_none:
+            return
+        self.sink.send(self.table_name, self.table_row(param_update, self.dtype))
+
+    def __len__(self):
+        return self.n_updates
+
+
 class BMILoop(object):
     '''
     Container class/interface definition for BMI tasks. Intended to be used with multiple inheritance structure paired with riglib.experiment classes
     '''
     static_states = [] # states in which the decoder is not run
     decoder_sequence = ''
+    offload_feature_extraction = False # run the feature extractor inside the neural data source process
+    stream_clda_params = True # send CLDA parameter updates to the HDF file as they happen
+    shadow_decoders = [] # decoders run on the same features as the live decoder without driving the plant
+    shadow_decoder_time_budget = 0.002 # time (s) per cycle for shadow decoders which cannot be stacked
+    shadow_decoder_stack = True # stack the steady-state shadow decoders (bool, or list of bool per decoder)
+    shadow_decoder_bank = None
 
     def init(self):
         '''
@@ -960,12 +1204,51 @@ class BMILoop(object):
         self.create_learner()
         self.create_updater()
         self.create_bmi_system()
+        self.create_shadow_decoder_bank()
 
         super(BMILoop, self).init()        
 
     def create_bmi_system(self):
         self.bmi_system = BMISystem(self.decoder, self.learner, self.updater, self.feature_accumulator)
 
+        # save parameter updates to the HDF file as they happen rather than at the end of the experiment. 
+        # The updates only go to the HDF sink: the other sinks (e.g., the digital I/O to the neural 
+        # recording system) would have to forward the whole batch on every update
+        param_names = getattr(self.updater, 'param_names', None)
+        if self.stream_clda_params and self.updater is not None and param_names is not None:
+            from riglib import sink, hdfwriter
+            hdf_sinks = [s for s in sink.sinks if issubclass(s.output, hdfwriter.HDFWriter)]
+            if len(hdf_sinks) > 0:
+                batch_size = getattr(self.learner, 'batch_size', 1)
+                dtype = CLDAParamHistStream.updater_dtype(self.decoder, param_names, batch_size)
+                self.bmi_system.param_hist = CLDAParamHistStream(hdf_sinks[0], dtype, ignore_none=batch_size > 1)
+
+    def create_shadow_decoder_bank(self):
+        '''
+        Set up the shadow decoders (if any) to run on the observations decoded by the live decoder 
+        and declare the HDF columns for their states. See riglib.bmi.shadow_decoders
+        '''
+        self.shadow_decoder_bank = None
+        if len(self.shadow_decoders) == 0:
+            return
+
+        from shadow_decoders import ShadowDecoderBank
+        self.shadow_decoder_bank = ShadowDecoderBank(self.shadow_decoders, self.decoder.units, 
+            time_budget=self.shadow_decoder_time_budget, stack=self.shadow_decoder_stack)
+        self.bmi_system.decoded_obs = []
+        self.add_dtype('shadow_decoder_state', 'f8', self.shadow_decoder_bank.state_shape)
+        self.add_dtype('shadow_decoder_skipped', 'i8', (len(self.shadow_decoders),))
+
+    def run_shadow_decoders(self):
+        '''
+        Run the shadow decoders on the observations decoded by the live decoder since the last call 
+        and save their states to the HDF file. Called by move_plant after the plant has been driven
+        '''
+        decoded_obs = self.bmi_system.decoded_obs
+        self.bmi_system.decoded_obs = []
+        self.task_data['shadow_decoder_state'] = self.shadow_decoder_bank.run(decoded_obs)
+        self.task_data['shadow_decoder_skipped'] = self.shadow_decoder_bank.n_skipped
+
     def load_decoder(self):
         '''
         Shell function. In tasks launched from the GUI with the BMI feature 
@@ -1035,6 +1318,9 @@ class BMILoop(object):
             self.extractor = extractor.BinnedSpikeCountsExtractor(self.neurondata, 
                 n_subbins=self.decoder.n_subbins, units=self.decoder.units)
 
+        if self.offload_feature_extraction and hasattr(self.neurondata, 'set_feature_extractor'):
+            self.extractor = extractor.SourceProcessFeatureExtractor(self.extractor, self.update_rate)
+
         self._add_feature_extractor_dtype()
 
     def _add_feature_extractor_dtype(self):
@@ -1150,6 +1436,9 @@ class BMILoop(object):
         except:
             self.dec_cnt = 0
 
+        if self.shadow_decoder_bank is not None:
+            self.run_shadow_decoders()
+
         self.task_data['decoder_state'] = decoder_state = self.decoder.get_state(shape=(-1,1))
         return decoder_state
 
@@ -1194,7 +1483,15 @@ class BMILoop(object):
         log_file.write(str(self.state) + '\n')
         try:
             import clda
-            if len(self.bmi_system.param_hist) > 0 and not self.updater is None:
+            latency = self.updater.latency_summary() if hasattr(self.updater, 'latency_summary') else None
+            if latency is not None:
+                log_file.write('CLDA update latency (ms): median %g, max %g; computation (ms): median %g, max %g; %d updates\n' % 
+                    (latency['median_latency']*1000, latency['max_latency']*1000, latency['median_compute_time']*1000, 
+                    latency['max_compute_time']*1000, latency['n_updates']))
+
+            if isinstance(self.bmi_system.param_hist, CLDAParamHistStream):
+                log_file.write('n_updates: %g (saved during the experiment)\n' % len(self.bmi_system.param_hist))
+            elif len(self.bmi_system.param_hist) > 0 and not self.updater is None:
                 log_file.write('n_updates: %g\n' % len(self.bmi_system.param_hist))
                 ignore_none = self.learner.batch_size > 1
                 log_file.write('Ignoring "None" values: %s\n' % str(ignore_none))
@@ -1234,42 +1531,19 @@ class BMILoop(object):
                 k += 1
                 first_update = data[k]
         
-            table_col_names = first_update.keys()
-            print table_col_names
-            dtype = []
-            shapes = []
-            for col_name in table_col_names:
-                if isinstance(first_update[col_name], float):
-                    shape = (1,)
-                else:
-                    shape = first_update[col_name].shape
-                dtype.append((col_name.replace('.', '_'), 'f8', shape))
-                shapes.append(shape)
-        
+            print first_update.keys()
+            dtype = CLDAParamHistStream.table_dtype(first_update)
             log_file.write(str(dtype))
-            # Create the HDF table with the datatype above
-            dtype = np.dtype(dtype) 
         
+            # Create the HDF table with the datatype above
             h5file = tables.openFile(hdf_fname, mode='a')
             arr = h5file.createTable("/", 'clda', dtype, filters=compfilt)
 
-            null_update = np.zeros((1,), dtype=dtype)
-            for col_name in table_col_names:
-                null_update[col_name.replace('.', '_')] *= np.nan
-        
             for k, param_update in enumerate(data):
                 log_file.write('%d, %s\n' % (k, str(ignore_none)))
-                if param_update == None:
-                    if ignore_none:
-                        continue
-                    else:
-                        data_row = null_update
-                else:
-                    data_row = np.zeros((1,), dtype=dtype)
-                    for col_name in table_col_names:
-                        data_row[col_name.replace('.', '_')] = np.asarray(param_update[col_name])
-        
-                arr.append(data_row)
+                if param_update == None and ignore_none:
+                    continue
+                arr.append(CLDAParamHistStream.table_row(param_update, dtype))
             h5file.close()
 
     def cleanup(self, database, saveid, **kwargs):
@@ -12,9 +12,10 @@ import cmath
 from itertools import izip
 import tables
 import re
-import assist
 import os
 import scipy
+import scipy.linalg
+import scipy.linalg.blas
 import copy
 
 from utils.angle_utils import *
@@ -89,6 +90,10 @@ class Learner(object):
         self.passed_done_state = False
         self.enabled = True
         self.input_state_index = -1
+        self._kin_buf = None
+
+        # optional BatchSuffStats, updated with each sample of the batch (see BMISystem)
+        self.suff_stats = None
         self.reset()
 
     def disable(self):
@@ -100,10 +105,60 @@ class Learner(object):
         self.enabled = True
 
     def reset(self):
-        '''Reset the lists of saved intention estimates and corresponding neural data'''
-        self.kindata = []
-        self.neuraldata = []
-        self.obs_value = []
+        '''Discard the saved intention estimates and corresponding neural data'''
+        self.n_samples = 0
+        self._write_idx = 0
+        if getattr(self, 'suff_stats', None) is not None:
+            self.suff_stats.reset()
+
+    def _alloc_buffers(self, int_kin, spike_counts, capacity):
+        '''
+        Allocate the arrays which the samples of a batch are written into, one column per sample
+        '''
+        self._kin_is_matrix = isinstance(int_kin, np.matrix)
+        self._neural_is_matrix = isinstance(spike_counts, np.matrix)
+        int_kin, spike_counts = np.asarray(int_kin), np.asarray(spike_counts)
+        self._kin_buf = np.empty([int_kin.size, capacity], dtype=np.result_type(int_kin, np.float64))
+        self._neural_buf = np.empty([spike_counts.size, capacity], dtype=spike_counts.dtype)
+        self._value_buf = np.empty(capacity)
+
+    def _append(self, int_kin, spike_counts, obs_value):
+        '''
+        Write a sample into the batch buffers. The buffers hold 'batch_size' samples; if more samples 
+        arrive before the batch is retrieved, the oldest are overwritten
+        '''
+        capacity = max(int(np.ceil(self.batch_size)), 1)
+        if self._kin_buf is None:
+            self._alloc_buffers(int_kin, spike_counts, capacity)
+        elif capacity > self._kin_buf.shape[1]:
+            # the batch size was increased: move the samples, in the order they arrived, into larger buffers
+            bufs = []
+            for buf in [self._kin_buf, self._neural_buf, self._value_buf]:
+                new_buf = np.empty(buf.shape[:-1] + (capacity,), dtype=buf.dtype)
+                new_buf[..., :self.n_samples] = self._batch_view(buf)
+                bufs.append(new_buf)
+            self._kin_buf, self._neural_buf, self._value_buf = bufs
+            self._write_idx = self.n_samples
+
+        k = self._write_idx
+        if self.suff_stats is not None:
+            if self.n_samples == self._kin_buf.shape[1]:
+                # the oldest sample is overwritten
+                self.suff_stats.remove(self._kin_buf[:, k], self._neural_buf[:, k])
+            self.suff_stats.add(int_kin, spike_counts)
+        self._kin_buf[:, k] = np.asarray(int_kin).ravel()
+        self._neural_buf[:, k] = np.asarray(spike_counts).ravel()
+        self._value_buf[k] = obs_value
+        self._write_idx = (k + 1) % self._kin_buf.shape[1]
+        self.n_samples = min(self.n_samples + 1, self._kin_buf.shape[1])
+
+    def _batch_view(self, buf):
+        '''
+        Samples of the current batch in the order they arrived. A view of the buffer unless it has wrapped around
+        '''
+        if self.n_samples < buf.shape[-1] or self._write_idx == 0:
+            return buf[..., :self.n_samples]
+        return np.concatenate([buf[..., self._write_idx:], buf[..., :self._write_idx]], axis=-1)
 
     def __call__(self, spike_counts, decoder_state, target_state, decoder_output, task_state, state_order=None, **kwargs):
         """
@@ -142,13 +197,96 @@ class Learner(object):
                 self.passed_done_state = False
 
         if self.enabled and not self.passed_done_state and int_kin is not None:
-            self.kindata.append(int_kin)
-            self.neuraldata.append(spike_counts)
-            self.obs_value.append(obs_value)
+            self._append(int_kin, spike_counts, obs_value)
 
             if task_state in self.done_states:
                 self.passed_done_state = True
 
+    def calc_int_kin_batch(self, current_states, target_states, decoder_outputs, task_states, state_order=None):
+        '''
+        Calculate the intended kinematics for a whole trajectory, e.g., to reconstruct a CLDA block offline. 
+        By default, calls 'calc_int_kin' for each time point; child classes can replace this with a 
+        vectorized calculation
+
+        Parameters
+        ----------
+        current_states : np.ndarray of shape (N, T)
+            State estimates given to the learner at each time point (see BMISystem.__call__)
+        target_states : np.ndarray of shape (N, T)
+            Target state at each time point
+        decoder_outputs : np.ndarray of shape (N, T)
+            State estimate output from the decoder at each time point
+        task_states : sequence of strings, length T
+            Name of the task state at each time point
+        state_order : np.ndarray of shape (N,), optional
+            Order of each state in the decoder; see riglib.bmi.state_space_models.State
+
+        Returns
+        -------
+        int_kin : np.ndarray of shape (N, T)
+            Intended kinematics, NaN at the time points where the learner has no estimate
+        valid : np.ndarray of shape (T,), dtype=bool
+            True at the time points where the learner has an estimate
+        '''
+        current_states = np.asarray(current_states)
+        target_states = np.asarray(target_states)
+        decoder_outputs = np.asarray(decoder_outputs)
+        int_kin = np.ones(current_states.shape) * np.nan
+        valid = np.zeros(current_states.shape[1], dtype=bool)
+        for k, task_state in enumerate(task_states):
+            int_kin_k = self.calc_int_kin(current_states[:,k], target_states[:,k], decoder_outputs[:,k], task_state, state_order=state_order)
+            if int_kin_k is not None:
+                int_kin[:,k] = np.asarray(int_kin_k).ravel()
+                valid[k] = True
+        return int_kin, valid
+
+    @staticmethod
+    def _group_task_states(task_states):
+        '''
+        Indices of the time points in each task state
+        '''
+        groups = dict()
+        for k, task_state in enumerate(task_states):
+            groups.setdefault(task_state, []).append(k)
+        return dict((task_state, np.array(inds)) for task_state, inds in groups.items())
+
+    def batch_inds(self, task_states, valid):
+        '''
+        Split a trajectory into the batches the learner would have handed to the updater online, 
+        assuming that each update is applied before the next observation (i.e., the updater 
+        runs in the same process)
+
+        Parameters
+        ----------
+        task_states : sequence of strings, length T
+            Name of the task state at each time point
+        valid : np.ndarray of shape (T,), dtype=bool
+            Time points where the learner has an estimate of the intended kinematics, see 'calc_int_kin_batch'
+
+        Returns
+        -------
+        list of np.ndarray
+            Time indices of the samples in each batch
+        '''
+        batches = []
+        batch = []
+        passed_done_state = False
+        for k, task_state in enumerate(task_states):
+            # same logic as __call__ followed by is_ready
+            if task_state in self.reset_states:
+                batch = []
+            if passed_done_state and task_state in ['hold', 'target']:
+                passed_done_state = False
+            if not passed_done_state and valid[k]:
+                batch.append(k)
+                if task_state in self.done_states:
+                    passed_done_state = True
+
+            if len(batch) >= self.batch_size or (len(batch) > 0 and passed_done_state):
+                batches.append(np.array(batch))
+                batch = []
+        return batches
+
     def calc_value(self, *args, **kwargs):
         '''
         Calculate a "value", i.e. a usefulness, for a particular observation. 
@@ -160,18 +298,32 @@ class Learner(object):
         '''
         Returns True if the collected estimates of the subject's intention are ready for processing into new decoder parameters
         '''
-        _is_ready = len(self.kindata) >= self.batch_size or ((len(self.kindata) > 0) and self.passed_done_state)
+        _is_ready = self.n_samples >= self.batch_size or ((self.n_samples > 0) and self.passed_done_state)
         return _is_ready
 
     def get_batch(self):
         '''
-        Returns all the data from the last 'batch' of obserations of intended kinematics and neural decoder inputs
+        Returns all the data from the last 'batch' of obserations of intended kinematics and neural decoder inputs. 
+        The returned arrays are the learner's buffers, which are handed off with the batch; the next batch is 
+        written into new buffers.
         '''
-        kindata = np.hstack(self.kindata)
-        neuraldata = np.hstack(self.neuraldata)
+        if self.n_samples == 0:
+            raise ValueError("Learner has no samples in the current batch")
+        kindata = self._batch_view(self._kin_buf)
+        neuraldata = self._batch_view(self._neural_buf)
+        if self._kin_is_matrix:
+            kindata = np.asmatrix(kindata)
+        if self._neural_is_matrix:
+            neuraldata = np.asmatrix(neuraldata)
+
+        batch = dict(intended_kin=kindata, spike_counts=neuraldata)
+        if self.suff_stats is not None:
+            batch['suff_stats'] = self.suff_stats
+            self.suff_stats = self.suff_stats.__class__()
+
+        self._kin_buf = None
         self.reset()
-        return dict(intended_kin=kindata, spike_counts=neuraldata)
-        # return kindata, neuraldata
+        return batch
 
 class DumbLearner(Learner):
     '''
@@ -260,6 +412,28 @@ class FeedbackControllerLearner(Learner):
             traceback.print_exc()
             return None
 
+    def calc_int_kin_batch(self, current_states, target_states, decoder_outputs, task_states, state_order=None):
+        '''
+        Vectorized version of 'calc_int_kin', see Learner.calc_int_kin_batch for docs. Time points 
+        in each task state are passed to the feedback controller together.
+        '''
+        if self.style != 'mixing':
+            return super(FeedbackControllerLearner, self).calc_int_kin_batch(current_states, target_states, 
+                decoder_outputs, task_states, state_order=state_order)
+
+        current_states = np.asarray(current_states)
+        target_states = np.asarray(target_states)
+        int_kin = np.ones(current_states.shape) * np.nan
+        valid = np.zeros(current_states.shape[1], dtype=bool)
+        for task_state, inds in self._group_task_states(task_states).items():
+            try:
+                int_kin[:,inds] = self.fb_ctrl.calc_next_state_batch(current_states[:,inds], target_states[:,inds], mode=task_state)
+                valid[inds] = True
+            except KeyError:
+                # the feedback controller doesn't have a policy for this task state
+                pass
+        return int_kin, valid
+
 class OFCLearner(Learner):
     '''
     An intention estimator where the subject is assumed to operate like a muiti-modal LQR controller
@@ -291,6 +465,20 @@ class OFCLearner(Learner):
         self.B = B
         self.F_dict = F_dict
         self.A = A
+        self._closed_loop = dict()
+
+    def _closed_loop_matrices(self, task_state, F):
+        '''
+        (A - B*F, B*F) for the feedback gain of a task state, cached until A, B or the gain is replaced
+        '''
+        if not hasattr(self, '_closed_loop'):
+            self._closed_loop = dict()
+        cached = self._closed_loop.get(task_state, None)
+        if cached is None or cached[0] is not self.A or cached[1] is not self.B or cached[2] is not F:
+            BF = np.dot(np.asarray(self.B), np.asarray(F))
+            cached = (self.A, self.B, F, np.asarray(self.A) - BF, BF)
+            self._closed_loop[task_state] = cached
+        return cached[3:]
 
     def calc_int_kin(self, current_state, target_state, decoder_output, task_state, state_order=None):
         '''
@@ -317,16 +505,108 @@ class OFCLearner(Learner):
             Estimate of intended next state for BMI
         '''
         try:
-            current_state = np.mat(current_state).reshape(-1,1)
-            target_state = np.mat(target_state).reshape(-1,1)
             F = self.F_dict[task_state]
-            A = self.A
-            B = self.B
-
-            return A*current_state + B*F*(target_state - current_state)
         except KeyError:
             return None
 
+        # A*x + B*F*(x^* - x) = (A - B*F)*x + B*F*x^*
+        A_BF, BF = self._closed_loop_matrices(task_state, F)
+        current_state = np.asarray(current_state).reshape(-1,1)
+        target_state = np.asarray(target_state).reshape(-1,1)
+        return np.asmatrix(np.dot(A_BF, current_state) + np.dot(BF, target_state))
+
+    def calc_int_kin_batch(self, current_states, target_states, decoder_outputs, task_states, state_order=None):
+        '''
+        Vectorized version of 'calc_int_kin', see Learner.calc_int_kin_batch for docs
+        '''
+        current_states = np.asarray(current_states)
+        target_states = np.asarray(target_states)
+        int_kin = np.ones(current_states.shape) * np.nan
+        valid = np.zeros(current_states.shape[1], dtype=bool)
+        for task_state, inds in self._group_task_states(task_states).items():
+            if task_state not in self.F_dict:
+                continue
+            A_BF, BF = self._closed_loop_matrices(task_state, self.F_dict[task_state])
+            int_kin[:,inds] = np.dot(A_BF, current_states[:,inds]) + np.dot(BF, target_states[:,inds])
+            valid[inds] = True
+        return int_kin, valid
+
+def replay_updates(decoder, learner, updater, spike_counts, current_states, target_states, task_states, 
+        decoder_outputs=None, half_life=None, **kwargs):
+    '''
+    Reconstruct the parameter updates of a CLDA block from the recorded data, without running the 
+    task loop. The intended kinematics are calculated for the whole block at once from the recorded 
+    decoder states, split into the batches the learner would have collected and passed through the 
+    updater in order, as BMISystem does online. The parameter trajectory is reproduced exactly if 
+    the updates were computed in the task process (multiproc=False), so that each update was 
+    applied before the next observation was decoded.
+
+    Parameters
+    ----------
+    decoder : bmi.Decoder instance
+        Seed decoder of the block. Updated in place, so pass a copy to keep the original
+    learner : Learner instance
+        Learner with the same settings (batch size, done/reset states, etc.) as the one used online
+    updater : Updater instance
+        Updater with the same settings as the one used online
+    spike_counts : np.ndarray of shape (n_features, T)
+        Decoded observations, one column per decoder update
+    current_states : np.ndarray of shape (n_states, T)
+        State estimates given to the learner at each time point, i.e., the decoder state before 
+        (learner.input_state_index == -1) or after (learner.input_state_index == 0) the observation was decoded
+    target_states : np.ndarray of shape (n_states, T)
+        Target state at each time point
+    task_states : sequence of strings, length T
+        Name of the task state at each time point
+    decoder_outputs : np.ndarray of shape (n_states, T), optional
+        Decoder state after each observation, if the learner uses it. Defaults to 'current_states'
+    half_life : float or np.ndarray of shape (T,), optional
+        Half-life given to the updater. If an array, each update uses the value at the last sample of its batch
+    **kwargs : optional keyword arguments
+        Passed to the updater with every batch
+
+    Returns
+    -------
+    param_hist : list of dict
+        New parameters of each update, in the same format as BMISystem.param_hist
+    '''
+    spike_counts = np.asarray(spike_counts)
+    target_states = np.asarray(target_states)
+    if decoder_outputs is None:
+        decoder_outputs = current_states
+    n_samples = spike_counts.shape[1]
+    if len(task_states) != n_samples or np.shape(current_states)[1] != n_samples or target_states.shape[1] != n_samples:
+        raise ValueError("spike_counts, current_states, target_states and task_states must have the same number of time points")
+
+    # as in BMISystem.__call__, time points without a target are in the 'no_target' state
+    task_states = ['no_target' if np.any(np.isnan(target_states[:,k])) else task_state for k, task_state in enumerate(task_states)]
+
+    int_kin, valid = learner.calc_int_kin_batch(current_states, target_states, decoder_outputs, task_states, 
+        state_order=decoder.ssm.state_order)
+
+    updater.init(decoder)
+    update_kwargs = getattr(updater, 'update_kwargs', dict())
+    param_hist = []
+    for inds in learner.batch_inds(task_states, valid):
+        batch_kwargs = dict(kwargs)
+        if np.ndim(half_life) > 0:
+            batch_kwargs['half_life'] = half_life[inds[-1]]
+        elif half_life is not None:
+            batch_kwargs['half_life'] = half_life
+
+        # intended kinematics are np.matrix columns online
+        intended_kin = np.asmatrix(int_kin[:,inds])
+        spike_counts_batch = spike_counts[:,inds]
+        new_params = updater.fn(intended_kin=intended_kin, spike_counts=spike_counts_batch, decoder=decoder, **batch_kwargs)
+        if new_params is None:
+            continue
+        decoder.update_params(new_params, **update_kwargs)
+        new_params['intended_kin'] = intended_kin
+        new_params['spike_counts_batch'] = spike_counts_batch
+        param_hist.append(new_params)
+    return param_hist
+
+
 class RegexKeyDict(dict):
     '''
     Dictionary where key matching applies regular expressions in addition to exact matches
@@ -360,68 +640,188 @@ class RegexKeyDict(dict):
 ##############################################################################
 ## Updaters
 ##############################################################################
-from riglib.mp_calc import MPCompute
+from riglib.mp_calc import SharedBatchCompute, SharedArrayPool
+import Queue
+from collections import deque
 class Updater(object):
     '''
-    Wrapper for MPCompute computations running in another process
+    Wrapper for the update function of a CLDA method. If 'multiproc' is set, the updates are 
+    computed in a separate process (see riglib.mp_calc.SharedBatchCompute)
     '''
+    # batch arrays sent to the worker process through shared memory instead of being pickled
+    shared_batch_keys = ['intended_kin', 'spike_counts']
+    max_batch_size = 2000 # size of the shared buffers, if the batch size is not known when the worker starts
+
+    # keys of the parameter dictionaries returned by the update function, so that the table of 
+    # updates can be declared before the experiment starts (see bmi.CLDAParamHistStream). None if not known
+    param_names = None
+
+    latency_hist_len = 1000 # number of recent updates whose timing is kept, see 'latency_summary'
+
     def __init__(self, fn, multiproc=False, verbose=False):
         self.verbose = verbose
         self.multiproc = multiproc
-        if self.multiproc:
-            # create the queues
-            self.work_queue = mp.Queue()
-            self.result_queue = mp.Queue()
-
-            # Instantiate the process
-            self.calculator = MPCompute(self.work_queue, self.result_queue, fn)
-
-            # spawn the process
-            self.calculator.start()
-        else:
-            self.fn = fn
+        self.fn = fn
+        self.calculator = None
+        self.n_pending = 0
 
         self._result = None
+        self._result_batch = None
         self.waiting = False
 
+        # batches submitted to the worker process whose results have not been retrieved, oldest first
+        self._submitted = deque()
+
+        # (time from the batch to the new parameters, computation time) of the most recent updates, in seconds, 
+        # and the number of updates and largest times of the whole session
+        self.latency_hist = deque(maxlen=self.latency_hist_len)
+        self.n_timed_updates = 0
+        self.max_latency = (0., 0.)
+
     def init(self, decoder):
         pass
 
+    def start(self, decoder, batch_size=None):
+        '''
+        Spawn the worker process, if the updates are computed in a separate process. The decoder is 
+        handed to the worker once, here, rather than with every batch. The worker keeps its copy of 
+        the decoder in sync by applying each update to it, so the decoder parameters should not 
+        be modified by anything other than this updater afterwards.
+
+        Parameters
+        ----------
+        decoder : bmi.Decoder instance
+            Decoder being adapted
+        batch_size : int, optional
+            Number of observations in each batch, for sizing the shared buffers. Defaults to 'max_batch_size'
+
+        Returns
+        -------
+        None
+        '''
+        if not self.multiproc or self.calculator is not None:
+            return
+        if batch_size is None:
+            batch_size = self.max_batch_size
+
+        batch_size = int(batch_size)
+        self.batch_buffers = SharedArrayPool(dict(intended_kin=(decoder.n_states, batch_size), 
+            spike_counts=(decoder.n_features, batch_size)))
+        self.work_queue = mp.Queue()
+        self.result_queue = mp.Queue()
+        self.calculator = SharedBatchCompute(self.work_queue, self.result_queue, self.fn, self.batch_buffers, 
+            registered=dict(decoder=decoder), on_result=self._sync_worker_decoder)
+        self.calculator.start()
+
+    def _sync_worker_decoder(self, new_params, decoder=None):
+        '''
+        Run in the worker process after each update, to apply the update to the worker's copy of the decoder
+        '''
+        if new_params is not None:
+            decoder.update_params(new_params, **getattr(self, 'update_kwargs', dict()))
+
     def __call__(self, *args, **kwargs):
-        input_data = (args, kwargs)
+        batch = dict(intended_kin=kwargs.get('intended_kin', None), spike_counts=kwargs.get('spike_counts', None))
         if self.multiproc:
+            if self.calculator is None:
+                self.start(kwargs['decoder'])
+            kwargs.pop('decoder', None)
+            arrays = dict((key, kwargs.pop(key)) for key in self.shared_batch_keys if key in kwargs)
             if self.verbose: print "queuing job"
-            self.work_queue.put(input_data)    
-            self.prev_input = input_data
+            self.calculator.submit(arrays, *args, **kwargs)
+            self._submitted.append(batch)
+            self.n_pending += 1
             self.waiting = True
         else:
+            t_start = time.time()
             self._result = self.fn(*args, **kwargs)
+            self._result_batch = batch
+            dt = time.time() - t_start
+            self._record_latency(dt, dt)
+
+    def _record_latency(self, latency, compute_time):
+        self.latency_hist.append((latency, compute_time))
+        self.n_timed_updates += 1
+        self.max_latency = (max(self.max_latency[0], latency), max(self.max_latency[1], compute_time))
+
+    def latency_summary(self):
+        '''
+        Timing of the updates, in seconds: the maxima are over all the updates and the medians 
+        are over the most recent 'latency_hist_len' updates
 
-    def get_result(self):
+        Returns
+        -------
+        dict or None
+            Keys 'n_updates', 'median_latency', 'max_latency', 'median_compute_time' and 'max_compute_time'. 
+            None if no update has been computed
+        '''
+        if self.n_timed_updates == 0:
+            return None
+        latency, compute_time = np.array(self.latency_hist).T
+        return dict(n_updates=self.n_timed_updates, median_latency=np.median(latency), max_latency=self.max_latency[0], 
+            median_compute_time=np.median(compute_time), max_compute_time=self.max_latency[1])
+
+    def result_ready(self):
+        '''
+        Cheap check for whether get_result will return new parameters, without retrieving them
+        '''
+        if self.multiproc:
+            return self.waiting and not self.result_queue.empty()
+        else:
+            return self._result is not None
+
+    def get_result(self, with_batch=False):
+        '''
+        Hand off the latest result of the update function, if there is one. The result is not 
+        copied, so the update function should not modify the returned parameters afterwards.
+
+        Parameters
+        ----------
+        with_batch : bool, optional, default=False
+            If True, also return the batch which the result was computed from. With a worker 
+            process, the result arrives some time after the batch was submitted
+
+        Returns
+        -------
+        dict or None
+            New decoder parameters, or None if no new result is available
+        dict or None
+            Only if 'with_batch' is True: the 'intended_kin' and 'spike_counts' of the batch, 
+            or None if no new result is available
+        '''
         if self.multiproc:
             try:
-                output_data = self.result_queue.get_nowait()
-                self.prev_result = output_data
-                self.waiting = False
-                return output_data
+                job_result = self.result_queue.get_nowait()
             except Queue.Empty:
-                return None
-            except:
-                import traceback
-                traceback.print_exc()
+                return (None, None) if with_batch else None
+
+            self.batch_buffers.release(job_result['slot'])
+            batch = self._submitted.popleft()
+            self.n_pending -= 1
+            self.waiting = self.n_pending > 0
+
+            latency = time.time() - job_result['t_submit']
+            compute_time = job_result['t_done'] - job_result['t_start']
+            self._record_latency(latency, compute_time)
+            if self.verbose: 
+                print "CLDA update latency: %.1f ms (computation: %.1f ms)" % (latency*1000, compute_time*1000)
+
+            self.prev_result = job_result['result']
+            res = job_result['result']
         else:
             if self._result is not None:
-                res = self._result
+                res, batch = self._result, self._result_batch
             else:
-                res = None
+                res, batch = None, None
             self._result = None
-            return res
+            self._result_batch = None
+        return (res, batch) if with_batch else res
 
     def __del__(self):
         '''
         Stop the child process if one was spawned
         '''
-        if self.multiproc:
+        if getattr(self, 'calculator', None) is not None:
             self.calculator.stop()
 
 class PPFContinuousBayesianUpdater(Updater):
@@ -435,6 +835,8 @@ class PPFContinuousBayesianUpdater(Updater):
     for mathematical details
     '''
     update_kwargs = dict()
+    param_names = ('filt.C',)
+
     def __init__(self, decoder, units='cm', param_noise_scale=1., param_noise_variances=None):
         '''
         Constructor for PPFContinuousBayesianUpdater
@@ -528,6 +930,13 @@ class KFRML(Updater):
     See (Dangi et al, Neural Computation, 2014) for mathematical details.
     '''
     update_kwargs = dict(steady_state=False)
+    param_names = ('filt.C', 'filt.Q', 'filt.C_xpose_Q_inv', 'filt.C_xpose_Q_inv_C', 'filt.R', 
+        'filt.S', 'filt.T', 'kf.ESS', 'mFR', 'sdFR')
+
+    # When the update is an exact RML fit (see '_exact_rml'), Q^{-1} is updated recursively from the 
+    # new batch instead of re-inverting Q. It is re-computed directly this often, to limit round-off drift
+    Q_inv_refresh_interval = 100
+
     def __init__(self, batch_time, half_life, adapt_C_xpose_Q_inv_C=True, regularizer=None):
         '''
         Constructor for KFRML
@@ -555,6 +964,74 @@ class KFRML(Updater):
         self.adapt_C_xpose_Q_inv_C = adapt_C_xpose_Q_inv_C
         self.regularizer = regularizer
         self._new_params = None
+        self._Q_inv_cache = None
+
+    @staticmethod
+    def weighted_batch_stats(x, y, values=None):
+        '''
+        Contributions of a batch to the sufficient statistics, x*B*x.T, y*B*x.T and y*B*y.T with 
+        B = diag(values). The weights are applied by broadcasting instead of forming B, so the 
+        cost is linear in the number of samples.
+
+        Parameters
+        ----------
+        x : np.ndarray of shape (n_states, n_samples)
+            Intended kinematics
+        y : np.ndarray of shape (n_features, n_samples)
+            Neural observations
+        values : np.ndarray of shape (n_samples,), optional
+            Weight of each sample. If not specified, all samples have weight 1
+
+        Returns
+        -------
+        xBx : np.ndarray of shape (n_states, n_states)
+        yBx : np.ndarray of shape (n_features, n_states)
+        yBy : np.ndarray of shape (n_features, n_features)
+        n_samples : float
+            Sum of the weights
+        '''
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if values is None:
+            xB, yB = x, y
+            n_samples = x.shape[1]
+        else:
+            w = np.asarray(values, dtype=np.float64).ravel()
+            xB, yB = x * w, y * w
+            n_samples = np.sum(w)
+        return np.dot(xB, x.T), np.dot(yB, x.T), np.dot(yB, y.T), n_samples
+
+    @staticmethod
+    def _solve_spd(M, B):
+        '''
+        Solve M*X = B for a symmetric positive-definite M, using the pseudo-inverse if M is singular
+        '''
+        try:
+            return scipy.linalg.cho_solve(scipy.linalg.cho_factor(M), B)
+        except (np.linalg.LinAlgError, ValueError):
+            return np.dot(np.linalg.pinv(M), B)
+
+    def _exact_rml(self, decoder):
+        '''
+        True if the new Q is exactly the Schur complement (T - S*R^{-1}*S.T)/ESS of the updated sufficient 
+        statistics, so that it changes from the previous Q by a rank-k term for a batch of k samples
+        '''
+        return self.adapt_C_xpose_Q_inv_C and self.regularizer is None and len(self.stable_inds) == 0 and \
+            len(self.adapting_inds) == decoder.n_features and len(self.state_adapting_inds) == decoder.n_states
+
+    def _recursive_Q_inv(self, Q_inv, ESS_old, rho, E, X, R_old):
+        '''
+        Woodbury update of Q^{-1}. With Sigma = ESS*Q, the RML update of the sufficient statistics gives
+            Sigma_new = rho*Sigma + E*(I + X.T*(rho*R_old)^{-1}*X)^{-1}*E.T
+        where E = Y - C_old*X are the residuals of the batch under the previous C, and X and E 
+        are scaled by the square roots of the sample weights.
+        '''
+        k = E.shape[1]
+        Sigma_inv_E = np.dot(Q_inv, E) * (1./(ESS_old*rho))
+        M = np.eye(k) + np.dot(X.T, self._solve_spd(rho*R_old, X)) + np.dot(E.T, Sigma_inv_E)
+        Sigma_inv = Q_inv * (1./(ESS_old*rho)) - np.dot(Sigma_inv_E, np.linalg.solve(M, Sigma_inv_E.T))
+        Q_inv = self.ESS * Sigma_inv
+        return 0.5*(Q_inv + Q_inv.T)
 
     @staticmethod
     def compute_suff_stats(hidden_state, obs, include_offset=True):
@@ -627,6 +1104,7 @@ class KFRML(Updater):
         self.S = decoder.filt.S
         self.T = decoder.filt.T
         self.ESS = decoder.filt.ESS
+        self._Q_inv_cache = None
 
 
         #Neural indices that will be adapted / stable are defined here:
@@ -709,48 +1187,43 @@ class KFRML(Updater):
             mFR_old = decoder.mFR
             sdFR_old = decoder.sdFR
 
-        x = np.mat(intended_kin)
-        y = np.mat(spike_counts)
-        #limit x to the indices that can adapt:
-        #x = x[self.state_adapting_inds, :]
-
-        # limit y to the features which are permitted to adapt
-        #y = y[self.adapting_inds, :]
-
-        if values is not None:
-            n_samples = np.sum(values)
-            B = np.mat(np.diag(values))
-        else:
-            n_samples = spike_counts.shape[1]
-            B = np.mat(np.eye(n_samples))
+        x = np.asarray(intended_kin, dtype=np.float64)
+        y = np.asarray(spike_counts, dtype=np.float64)
+        dn = np.nonzero(drives_neurons)[0]
+        dn_mesh = np.ix_(dn, dn)
+        xBx, yBx, yBy, n_samples = self.weighted_batch_stats(x, y, values)
+
+        # Q^{-1} can be updated recursively if the previous Q came from the previous call 
+        # and the batch is small compared to the number of features
+        cache = self._Q_inv_cache
+        recursive_Q_inv = self._exact_rml(decoder) and cache is not None and cache[0] is decoder.filt.Q \
+            and cache[2] < self.Q_inv_refresh_interval and 2*x.shape[1] < decoder.n_features
+        if recursive_Q_inv:
+            R_old = np.array(self.R[dn_mesh])
+            C_old = self._solve_spd(R_old, np.asarray(self.S)[:, dn].T).T
+            sqrt_w = 1. if values is None else np.sqrt(np.asarray(values, dtype=np.float64).ravel())
+            X_batch = x[dn] * sqrt_w
+            E_batch = (y - np.dot(C_old, x[dn])) * sqrt_w
+            ESS_old = self.ESS
 
         if self.adapt_C_xpose_Q_inv_C:
             #self.R[self.state_adapting_inds_mesh] = rho*self.R[self.state_adapting_inds_mesh] + (x*B*x.T)
-            self.R = rho*self.R + (x*B*x.T)
+            self.R = rho*self.R + xBx
 
         if np.any(np.isnan(self.R)):
             print 'np.nan in self.R in riglib/bmi/clda.py!'
 
-        #self.S[self.neur_by_state_adapting_inds_mesh] = rho*self.S[self.neur_by_state_adapting_inds_mesh] + (y*B*x.T)
-        #self.T[self.adapting_inds_mesh] = rho*self.T[self.adapting_inds_mesh] + np.dot(y, B*y.T)
-
-        self.S[:, decoder.drives_neurons] = rho*self.S[:, decoder.drives_neurons] + (y*B*x[decoder.drives_neurons, :].T)
-        self.T = rho*self.T + np.dot(y, B*y.T)
+        self.S[:, dn] = rho*self.S[:, dn] + yBx[:, dn]
+        self.T = rho*self.T + yBy
         self.ESS = rho*self.ESS + n_samples
 
-        R_inv = np.mat(np.zeros(self.R.shape))
-        
-        try:
-            if self.regularizer is None:
-                R_inv[np.ix_(drives_neurons, drives_neurons)] = np.linalg.pinv(self.R[np.ix_(drives_neurons, drives_neurons)])
-            else:
-                dn = np.sum(drives_neurons)
-                R_inv[np.ix_(drives_neurons, drives_neurons)] = np.linalg.pinv(self.R[np.ix_(drives_neurons, drives_neurons)]+self.regularizer*np.eye(dn))
-        except:
-            print self.R
-            print 'Error with pinv in riglib/bmi/clda.py'
+        # C = S*R^{-1}, solved on the (small) block of states which drive the neurons
+        R_dn = np.asarray(self.R[dn_mesh])
+        if self.regularizer is not None:
+            R_dn = R_dn + self.regularizer*np.eye(len(dn))
+        C_new = np.zeros(self.S.shape)
+        C_new[:, dn] = self._solve_spd(R_dn, np.asarray(self.S)[:, dn].T).T
 
-        C_new = self.S * R_inv
         C = copy.deepcopy(decoder.filt.C)
         C[np.ix_(self.adapting_inds, self.state_adapting_inds)] = C_new[np.ix_(self.adapting_inds, self.state_adapting_inds)]
         
@@ -765,6 +1238,14 @@ class KFRML(Updater):
             Q[np.ix_(self.stable_inds, self.adapting_inds)] = 0
             Q[np.ix_(self.adapting_inds, self.stable_inds)] = 0
 
+        if recursive_Q_inv:
+            Q_inv = self._recursive_Q_inv(cache[1], ESS_old, rho, E_batch, X_batch, R_old)
+            n_recursive = cache[2] + 1
+        else:
+            Q_inv = self._solve_spd(np.asarray(Q), np.eye(Q.shape[0]))
+            n_recursive = 0
+        self._Q_inv_cache = (Q, Q_inv, n_recursive) if self._exact_rml(decoder) else None
+
         #mFR and sdFR are not exempt from the 'adapting_inds'
         try:
             mFR = mFR_old.copy()
@@ -777,7 +1258,7 @@ class KFRML(Updater):
             mFR[self.adapting_inds] = (1-rho)*np.mean(spike_counts[self.adapting_inds,:].T, axis=0) + rho*mFR_old[self.adapting_inds]
             sdFR[self.adapting_inds] = (1-rho)*np.std(spike_counts[self.adapting_inds,:].T, axis=0) + rho*sdFR_old[self.adapting_inds]
 
-        C_xpose_Q_inv = C.T * np.linalg.pinv(Q)
+        C_xpose_Q_inv = C.T * np.mat(Q_inv)
         new_params = {'filt.C':C, 'filt.Q':Q, 'filt.C_xpose_Q_inv':C_xpose_Q_inv,
             'mFR':mFR, 'sdFR':sdFR, 'kf.ESS':self.ESS, 'filt.S':self.S, 'filt.T':self.T}
 
@@ -830,9 +1311,9 @@ class KFRML_IVC(KFRML):
         See KFRML.calc for input argument documentation
         '''
         new_params = super(KFRML_IVC, self).calc(intended_kin=intended_kin, spike_counts=spike_counts, decoder=decoder, half_life=half_life, values=values, **kwargs)
-        C, Q, = new_params['filt.C'], new_params['filt.Q']
+        C, C_xpose_Q_inv = new_params['filt.C'], new_params['filt.C_xpose_Q_inv']
 
-        D = (C.T * np.linalg.pinv(Q) * C)
+        D = C_xpose_Q_inv * C
         if self.default_gain == None:
             # assume velocity states are last half of states: 
             v0 = int(.5*(D.shape[0] - 1))
@@ -861,7 +1342,6 @@ class KFRML_IVC(KFRML):
             D[3:6, 3:6] = np.mat(np.diag(D_diag))
 
         new_params['filt.C_xpose_Q_inv_C'] = D
-        new_params['filt.C_xpose_Q_inv'] = C.T * np.linalg.pinv(Q)
         return new_params
 
     @classmethod
@@ -890,6 +1370,8 @@ class KFRML_baseline(KFRML):
     '''
     RML version where only the baseline firing rates are adapted
     '''
+    param_names = ('mFR', 'sdFR')
+
     def calc(self, intended_kin=None, spike_counts=None, decoder=None, half_life=None, values=None, **kwargs):
         '''
         See KFRML.calc for input argument documentation
@@ -921,6 +1403,8 @@ class KFRML_baseline(KFRML):
 class PPFRML(Updater):
     '''RML method applied to more generic GLM'''
     update_kwargs = dict()
+    param_names = ('filt.C',)
+
     def __init__(self, *args, **kwargs):
         super(PPFRML, self).__init__(self.calc, multiproc=False)
 
@@ -982,13 +1466,143 @@ class PPFRML(Updater):
 ###############################
 ##### Deprecated updaters #####
 ###############################
+_blas_syr, _blas_ger = scipy.linalg.blas.get_blas_funcs(('syr', 'ger'), dtype=np.float64)
+
+class BatchSuffStats(object):
+    '''
+    Running sums over the samples of a CLDA batch: X*X.T, Y*X.T, Y*Y.T and the sums of X and Y, where 
+    X is the intended kinematics and Y the neural observations. The learner updates them as each 
+    sample arrives (see Learner._append), so updaters which only need these statistics (e.g., 
+    KFSmoothbatch) compute the new parameters without going through the samples of the batch. 
+    Each sample costs rank-one (BLAS syr/ger) updates, which only fill the upper triangles of the 
+    symmetric sums.
+    '''
+    def __init__(self):
+        self.n = 0
+        self.R = None
+        self._upper = True
+
+    def _alloc(self, n_states, n_features):
+        self.R = np.zeros([n_states, n_states], order='F')
+        self.S = np.zeros([n_features, n_states], order='F')
+        self.T = np.zeros([n_features, n_features], order='F')
+        self.sum_x = np.zeros(n_states)
+        self.sum_y = np.zeros(n_features)
+
+    def _update(self, x, y, alpha):
+        x = np.asarray(x, dtype=np.float64).ravel()
+        y = np.asarray(y, dtype=np.float64).ravel()
+        if self.R is None:
+            self._alloc(len(x), len(y))
+        _blas_syr(alpha, x, a=self.R, overwrite_a=1)
+        _blas_ger(alpha, y, x, a=self.S, overwrite_a=1)
+        _blas_syr(alpha, y, a=self.T, overwrite_a=1)
+        self.sum_x += alpha*x
+        self.sum_y += alpha*y
+
+    def add(self, x, y):
+        '''
+        Add a sample (intended kinematics x, neural observation y)
+        '''
+        self._update(x, y, 1.)
+        self.n += 1
+
+    def remove(self, x, y):
+        '''
+        Remove a sample which was added before
+        '''
+        self._update(x, y, -1.)
+        self.n -= 1
+
+    def reset(self):
+        '''
+        Discard all the samples, keeping the allocated arrays
+        '''
+        self.n = 0
+        if self.R is not None:
+            for arr in [self.R, self.S, self.T, self.sum_x, self.sum_y]:
+                arr[:] = 0
+
+    @classmethod
+    def from_batch(cls, X, Y):
+        '''
+        Statistics of a complete batch
+
+        Parameters
+        ----------
+        X : np.ndarray of shape (n_states, T)
+            Intended kinematics
+        Y : np.ndarray of shape (n_features, T)
+            Neural observations
+
+        Returns
+        -------
+        BatchSuffStats instance
+        '''
+        X = np.asarray(X, dtype=np.float64)
+        Y = np.asarray(Y, dtype=np.float64)
+        stats = cls()
+        stats.R, stats.S, stats.T = np.dot(X, X.T), np.dot(Y, X.T), np.dot(Y, Y.T)
+        stats.sum_x, stats.sum_y = X.sum(axis=1), Y.sum(axis=1)
+        stats.n = X.shape[1]
+        stats._upper = False
+        return stats
+
+    def get(self, state_inds=slice(None)):
+        '''
+        Returns the statistics (R, S, T, sum_x, sum_y), i.e., (X*X.T, Y*X.T, Y*Y.T, sum of X, sum of Y), 
+        for a subset of the states of X
+
+        Parameters
+        ----------
+        state_inds : index array, boolean mask or slice, optional
+            States of X to keep. Defaults to all the states
+        '''
+        R, T = self.R, self.T
+        if self._upper:
+            R = np.triu(R) + np.triu(R, 1).T
+            T = np.triu(T) + np.triu(T, 1).T
+        inds = np.arange(R.shape[0])[state_inds]
+        return R[np.ix_(inds, inds)], self.S[:, inds], T, self.sum_x[inds], self.sum_y
+
+
+def _psd_pinv(M):
+    '''
+    Pseudo-inverse of a positive semi-definite matrix, e.g., the observation noise covariance Q. 
+    Rows/columns with zero variance (e.g., of units which did not fire) are zero in the result, 
+    as with np.linalg.pinv, and the rest of the matrix is inverted by Cholesky factorization, 
+    which costs a fraction of the SVD used by np.linalg.pinv. Falls back to np.linalg.pinv if that 
+    part of the matrix is not positive definite, or is singular up to round-off (e.g., the spike 
+    counts of two units are identical), in which case the factorization can succeed with a 
+    pivot which is only round-off error.
+    '''
+    M = np.asarray(M, dtype=np.float64)
+    nonzero, = np.nonzero(np.diag(M) > 0)
+    M_inv = np.zeros(M.shape)
+    M_nz = M[np.ix_(nonzero, nonzero)]
+    try:
+        chol = scipy.linalg.cho_factor(M_nz)
+    except (np.linalg.LinAlgError, ValueError):
+        return np.linalg.pinv(M)
+    if len(nonzero) > 0 and np.min(np.diag(chol[0]))**2 <= len(nonzero) * np.finfo(np.float64).eps * np.max(np.diag(M_nz)):
+        return np.linalg.pinv(M)
+    M_inv[np.ix_(nonzero, nonzero)] = scipy.linalg.cho_solve(chol, np.eye(len(nonzero)))
+    return M_inv
+
+
 class KFSmoothbatch(Updater):
     '''
     Deprecation Warning: This update method has not been used for quite long. See KFRML for an enhanced but similar method
 
     Calculate KF Parameter updates using the SmoothBatch method. See [Orsborn et al, 2012] for mathematical details
+
+    The maximum-likelihood estimates of the batch are computed in closed form from the sufficient 
+    statistics of the batch, which the learner accumulates as the samples arrive (see BatchSuffStats), 
+    so the time to compute an update does not grow with the length of the batch.
     '''
     update_kwargs = dict(steady_state=True)
+    suff_stats_cls = BatchSuffStats
+    param_names = ('kf.C', 'kf.Q', 'kf.C_xpose_Q_inv_C', 'kf.C_xpose_Q_inv', 'mFR', 'sdFR', 'rho')
     def __init__(self, batch_time, half_life):
         '''
         Constructor for KFSmoothbatch
@@ -1008,14 +1622,53 @@ class KFSmoothbatch(Updater):
         self.half_life = half_life
         self.batch_time = batch_time
         self.rho = np.exp(np.log(0.5) / (self.half_life/batch_time))
-        
-    def calc(self, intended_kin=None, spike_counts=None, decoder=None, half_life=None, **kwargs):
+
+    @staticmethod
+    def batch_mle(suff_stats, drives_obs):
+        '''
+        Maximum-likelihood observation model and firing-rate statistics of a batch, from its sufficient 
+        statistics. Same as kfdecoder.KalmanFilter.MLE_obs_model(intended_kin, spike_counts, include_offset=False, 
+        drives_obs=drives_obs) and the mean/standard deviation of the spike counts
+
+        Parameters
+        ----------
+        suff_stats : BatchSuffStats instance
+            Statistics of the batch
+        drives_obs : np.ndarray of booleans
+            States which drive the observations
+
+        Returns
+        -------
+        C_hat, Q_hat : np.ndarray of shape (n_features, n_states), (n_features, n_features)
+        mFR, sdFR : np.ndarray of shape (n_features,)
+        '''
+        R, S, T, sum_x, sum_y = suff_stats.get(drives_obs)
+        n = float(suff_stats.n)
+        try:
+            C_d = scipy.linalg.solve(R, S.T, sym_pos=True).T
+        except (np.linalg.LinAlgError, ValueError):
+            # minimum-norm solution, as np.linalg.lstsq gives for the samples
+            C_d = np.linalg.lstsq(R, S.T, rcond=-1)[0].T
+
+        # covariance of the residuals Y - C*X, after subtracting their mean
+        CS_t = np.dot(C_d, S.T)
+        resid_mean = (sum_y - np.dot(C_d, sum_x)) / n
+        Q_hat = (T - CS_t - CS_t.T + np.dot(np.dot(C_d, R), C_d.T)) / n - np.outer(resid_mean, resid_mean)
+
+        C_hat = np.zeros([C_d.shape[0], len(drives_obs)])
+        C_hat[:, drives_obs] = C_d
+
+        mFR = sum_y / n
+        sdFR = np.sqrt(np.maximum(np.diag(T) / n - mFR**2, 0))
+        return C_hat, Q_hat, mFR, sdFR
+
+    def calc(self, intended_kin=None, spike_counts=None, decoder=None, half_life=None, suff_stats=None, **kwargs):
         """
         Smoothbatch calculations
 
-        Run least-squares on (intended_kinematics, spike_counts) to 
-        determine the C_hat and Q_hat of new batch. Then combine with 
-        old parameters using step-size rho
+        Compute the least-squares C_hat and Q_hat of the new batch of (intended_kinematics, spike_counts) 
+        from its sufficient statistics (computed from the batch if the learner did not accumulate them). 
+        Then combine with old parameters using step-size rho
         """
         print "calculating new SB parameters"
         C_old          = decoder.kf.C
@@ -1024,8 +1677,9 @@ class KFSmoothbatch(Updater):
         mFR_old        = decoder.mFR
         sdFR_old       = decoder.sdFR
 
-        C_hat, Q_hat = kfdecoder.KalmanFilter.MLE_obs_model(
-            intended_kin, spike_counts, include_offset=False, drives_obs=drives_neurons)
+        if suff_stats is None or suff_stats.n == 0:
+            suff_stats = BatchSuffStats.from_batch(intended_kin, spike_counts)
+        C_hat, Q_hat, mFR_hat, sdFR_hat = self.batch_mle(suff_stats, drives_neurons)
 
         if not (half_life is None):
             rho = np.exp(np.log(0.5)/(half_life/self.batch_time))
@@ -1035,12 +1689,13 @@ class KFSmoothbatch(Updater):
         C = (1-rho)*C_hat + rho*C_old
         Q = (1-rho)*Q_hat + rho*Q_old
 
-        mFR = (1-rho)*np.mean(spike_counts.T, axis=0) + rho*mFR_old
-        sdFR = (1-rho)*np.std(spike_counts.T, axis=0) + rho*sdFR_old
+        mFR = (1-rho)*mFR_hat + rho*mFR_old
+        sdFR = (1-rho)*sdFR_hat + rho*sdFR_old
         
-        D = C.T * np.linalg.pinv(Q) * C
+        C_xpose_Q_inv = C.T * np.mat(_psd_pinv(Q))
+        D = C_xpose_Q_inv * C
         new_params = {'kf.C':C, 'kf.Q':Q, 
-            'kf.C_xpose_Q_inv_C':D, 'kf.C_xpose_Q_inv':C.T * np.linalg.pinv(Q),
+            'kf.C_xpose_Q_inv_C':D, 'kf.C_xpose_Q_inv':C_xpose_Q_inv,
             'mFR':mFR, 'sdFR':sdFR, 'rho':rho }
         return new_params
 
@@ -1078,39 +1733,44 @@ class KFOrthogonalPlantSmoothbatch(KFSmoothbatch):
 class PPFSmoothbatch(Updater):
     '''
     Deprecated: This updater as of 2015-Sept-19 was never used in an experiment. 
+
+    The Poisson GLMs of each batch are fit by a fixed number of Newton steps starting from the current 
+    decoder parameters (see ppfdecoder.refine_poisson_glm) instead of from scratch, so the time to 
+    compute an update is bounded and does not depend on how quickly the fits would converge.
     '''
-    def __init__(self, batch_time, half_life):
+    param_names = ('filt.C',)
+
+    def __init__(self, batch_time, half_life, n_newton_steps=2):
         super(PPFSmoothbatch, self).__init__(self.calc, multiproc=True)
         self.half_life = half_life
+        self.batch_time = batch_time
+        self.n_newton_steps = n_newton_steps
         self.rho = np.exp(np.log(0.5) / (self.half_life/batch_time))
 
     def calc(self, intended_kin=None, spike_counts=None, decoder=None, half_life=None, **kwargs):
         """
         Smoothbatch calculations
 
-        Run least-squares on (intended_kinematics, spike_counts) to 
-        determine the C_hat and Q_hat of new batch. Then combine with 
-        old parameters using step-size rho
+        Refine the GLM coefficients C_hat of the old parameters on the new batch of 
+        (intended_kinematics, spike_counts). Then combine with old parameters using step-size rho
         """
         if half_life is not None:
             rho = np.exp(np.log(0.5)/(half_life/self.batch_time))
         else:
             rho = self.rho 
 
-        C_old = decoder.filt.C
-        drives_neurons = decoder.drives_neurons
-        states = decoder.states
-        decoding_states = np.take(states, np.nonzero(drives_neurons)).ravel().tolist() #['hand_vx', 'hand_vz', 'offset'] 
+        C_old = np.array(decoder.filt.C)
+        drives_neurons = np.array(decoder.drives_neurons, dtype=bool)
 
-        C_hat, pvalues = ppfdecoder.PointProcessFilter.MLE_obs_model(
-            intended_kin, spike_counts, include_offset=False, drives_obs=drives_neurons)
-        C_hat = train.inflate(C_hat, decoding_states, states, axis=1)
-        pvalues = train.inflate(pvalues, decoding_states, states, axis=1)
-        pvalues[pvalues[:,:-1] == 0] = np.inf
+        C_hat = C_old.copy()
+        pvalues = np.ones(C_old.shape) * np.inf
+        C_hat[:, drives_neurons], pvalues[:, drives_neurons] = ppfdecoder.refine_poisson_glm(
+            np.asarray(intended_kin)[drives_neurons], np.asarray(spike_counts), C_old[:, drives_neurons], 
+            n_steps=self.n_newton_steps)
 
         mesh = np.nonzero(pvalues < 0.1)
-        C = np.array(C_old.copy())
-        C[mesh] = (1-rho)*C_hat[mesh] + rho*np.array(C_old)[mesh]
+        C = C_old.copy()
+        C[mesh] = (1-rho)*C_hat[mesh] + rho*C_old[mesh]
         C = np.mat(C)
 
         new_params = {'filt.C':C}
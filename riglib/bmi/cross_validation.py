@@ -0,0 +1,259 @@
+'''
+Cross-validation of Kalman filter observation models. The training data are split into contiguous
+folds and the sufficient statistics X*X.T, Y*X.T and Y*Y.T of each fold are computed once; the
+statistics of each training set are the totals minus those of the held-out fold, so the models
+for every fold and regularizer are fit without going back to the raw data.
+'''
+import numpy as np
+import scipy.linalg
+
+import state_space_models
+
+
+def contiguous_folds(n_samples, n_folds):
+    '''
+    Split the time points into contiguous blocks. Neural and kinematic data are correlated
+    over time, so randomly chosen folds would overstate the held-out performance
+
+    Parameters
+    ----------
+    n_samples : int
+        Number of time points
+    n_folds : int
+        Number of folds
+
+    Returns
+    -------
+    list of slice objects
+    '''
+    if n_folds < 2 or n_folds > n_samples:
+        raise ValueError("Cannot split %d samples into %d folds" % (n_samples, n_folds))
+    edges = np.linspace(0, n_samples, n_folds + 1).astype(int)
+    return [slice(edges[k], edges[k+1]) for k in range(n_folds)]
+
+
+def fold_suff_stats(X, Y, folds):
+    '''
+    Sufficient statistics of each fold (see clda.KFRML.compute_suff_stats)
+
+    Parameters
+    ----------
+    X : np.ndarray of shape (n_states, T)
+        Hidden states, including the offset row
+    Y : np.ndarray of shape (n_features, T)
+        Observations
+    folds : list of slice objects
+        Time points of each fold, see contiguous_folds
+
+    Returns
+    -------
+    R, S, T : np.ndarray of shape (n_folds, n_states, n_states), (n_folds, n_features, n_states), (n_folds, n_features, n_features)
+        X*X.T, Y*X.T and Y*Y.T of each fold
+    n : np.ndarray of shape (n_folds,)
+        Number of time points in each fold
+    '''
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    R = np.array([np.dot(X[:,sl], X[:,sl].T) for sl in folds])
+    S = np.array([np.dot(Y[:,sl], X[:,sl].T) for sl in folds])
+    T = np.array([np.dot(Y[:,sl], Y[:,sl].T) for sl in folds])
+    n = np.array([sl.stop - sl.start for sl in folds])
+    return R, S, T, n
+
+
+def _residual_outer(C, R, S, T):
+    '''
+    (Y - C*X)*(Y - C*X).T from the sufficient statistics
+    '''
+    CS_t = np.dot(C, S.T)
+    return T - CS_t - CS_t.T + np.dot(np.dot(C, R), C.T)
+
+
+def obs_model_from_suff_stats(R, S, T, n, regularizer=0.):
+    '''
+    Fit the observation model {C, Q} of a KF from sufficient statistics. Gives the same result
+    as kfdecoder.KalmanFilter.MLE_obs_model on the data the statistics were computed from
+
+    Parameters
+    ----------
+    R : np.ndarray of shape (n_states, n_states)
+        X*X.T. The last state must be the offset (a row of ones in X)
+    S : np.ndarray of shape (n_features, n_states)
+        Y*X.T
+    T : np.ndarray of shape (n_features, n_features)
+        Y*Y.T
+    n : int
+        Number of time points
+    regularizer : float, optional, default=0.
+        Ridge penalty: C = Y*X.T * (X*X.T + regularizer*I)^{-1}
+
+    Returns
+    -------
+    C : np.ndarray of shape (n_features, n_states)
+    Q : np.ndarray of shape (n_features, n_features)
+        Covariance of the residuals, Y - C*X
+    '''
+    R_reg = R + regularizer * np.eye(R.shape[0])
+    try:
+        C = scipy.linalg.solve(R_reg, S.T, sym_pos=True).T
+    except (np.linalg.LinAlgError, ValueError):
+        C = np.linalg.lstsq(R_reg, S.T, rcond=None)[0].T
+
+    # np.cov subtracts the mean of the residuals, which is not exactly zero if the fit is regularized.
+    # The sums of X and Y are the columns of R and S for the offset state
+    resid_mean = (S[:,-1] - np.dot(C, R[:,-1])) / n
+    Q = _residual_outer(C, R, S, T) / n - np.outer(resid_mean, resid_mean)
+    return C, Q
+
+
+def obs_loglik(C, Q, R, S, T, n):
+    '''
+    Average log-likelihood of observations under the model y_t ~ N(C*x_t, Q), from the
+    sufficient statistics of the (held-out) data
+
+    Parameters
+    ----------
+    C, Q : np.ndarray
+        Observation model
+    R, S, T, n : np.ndarray, np.ndarray, np.ndarray, int
+        Sufficient statistics of the data, see fold_suff_stats
+
+    Returns
+    -------
+    float
+        Log-likelihood per time point, or -inf if Q is singular
+    '''
+    try:
+        Q_chol = scipy.linalg.cho_factor(Q)
+    except np.linalg.LinAlgError:
+        return -np.inf
+    logdet_Q = 2 * np.sum(np.log(np.diag(Q_chol[0])))
+    mahal = np.trace(scipy.linalg.cho_solve(Q_chol, _residual_outer(C, R, S, T))) / n
+    return -0.5 * (Q.shape[0] * np.log(2*np.pi) + logdet_Q + mahal)
+
+
+def _decode_r2(C, Q, X_test, Y_test, decode_args):
+    '''
+    Decode held-out observations with the steady-state KF and return the average R^2 of the trained states
+    '''
+    from kfdecoder import KalmanFilter
+    A, W, is_stochastic, drives_obs_inds, train_inds, x0 = decode_args
+    C_full = np.zeros([C.shape[0], A.shape[0]])
+    C_full[:, drives_obs_inds] = C
+    try:
+        F, K = KalmanFilter(A, W, C_full, Q, is_stochastic=is_stochastic).get_sskf()
+    except np.linalg.LinAlgError:
+        return -np.inf
+    F, K = np.asarray(F), np.asarray(K)
+
+    Ky = np.dot(K, Y_test).T
+    x = x0.copy()
+    x_hat = np.zeros([len(train_inds), Y_test.shape[1]])
+    for t in range(Y_test.shape[1]):
+        x = np.dot(F, x) + Ky[t]
+        x_hat[:,t] = x[train_inds]
+
+    sse = np.sum((x_hat - X_test)**2, axis=1)
+    sst = np.sum((X_test - X_test.mean(axis=1)[:,np.newaxis])**2, axis=1)
+    return np.mean(1 - sse/sst)
+
+
+def _score_fold(args):
+    '''
+    Fit the models for all the regularizers on the training set of one fold and score them on the held-out data
+    '''
+    R_train, S_train, T_train, n_train, R_test, S_test, T_test, n_test, regularizers, score, X_test, Y_test, decode_args = args
+    scores = []
+    for regularizer in regularizers:
+        C, Q = obs_model_from_suff_stats(R_train, S_train, T_train, n_train, regularizer=regularizer)
+        if score == 'loglik':
+            scores.append(obs_loglik(C, Q, R_test, S_test, T_test, n_test))
+        else:
+            scores.append(_decode_r2(C, Q, X_test, Y_test, decode_args))
+    return scores
+
+
+def cross_validate_kf(ssm, kin, neural_features, update_rate, regularizers=(0.,), n_folds=5, score='loglik', n_processes=1):
+    '''
+    Cross-validate KF observation models over a grid of regularizers
+
+    Parameters
+    ----------
+    ssm : state_space_models.StateSpace instance
+        State space model of the decoder
+    kin : np.ndarray of shape (n_states or more, T)
+        Kinematics, as given to train.train_KFDecoder_abstract
+    neural_features : np.ndarray of shape (n_features, T)
+        Neural features, after any z-scoring
+    update_rate : float
+        Time in seconds between decoder updates
+    regularizers : iterable of float, optional, default=(0.,)
+        Ridge penalties to evaluate
+    n_folds : int, optional, default=5
+        Number of contiguous folds
+    score : string, optional, default='loglik'
+        'loglik' scores the observation model by its held-out log-likelihood, computed from the
+        sufficient statistics alone. 'decode' decodes the held-out neural data with the steady-state
+        KF and scores the average R^2 of the trained (stochastic) states
+    n_processes : int, optional, default=1
+        If greater than 1, the folds are evaluated in a pool of processes
+
+    Returns
+    -------
+    np.ndarray
+        Score table with one record per regularizer and fields 'regularizer', 'mean_score',
+        'std_score' and 'fold_scores'. Higher scores are better
+    '''
+    if score not in ['loglik', 'decode']:
+        raise ValueError("Unknown cross-validation score: %s" % score)
+    regularizers = [float(r) for r in regularizers]
+
+    train_inds = ssm.train_inds
+    X = np.asarray(kin, dtype=np.float64)[train_inds, :]
+    Y = np.asarray(neural_features, dtype=np.float64)
+    n_samples = X.shape[1]
+    X = np.vstack([X, np.ones([1, n_samples])])
+
+    folds = contiguous_folds(n_samples, n_folds)
+    R, S, T, n = fold_suff_stats(X, Y, folds)
+    R_tot, S_tot, T_tot, n_tot = R.sum(axis=0), S.sum(axis=0), T.sum(axis=0), n.sum()
+
+    decode_args = None
+    if score == 'decode':
+        A, B, W = ssm.get_ssm_matrices(update_rate=update_rate)
+        x0 = np.array([1. if state.name == state_space_models.offset_state.name else 0. for state in ssm.states])
+        decode_args = (np.asarray(A), np.asarray(W), ssm.is_stochastic, ssm.drives_obs_inds, train_inds, x0)
+
+    jobs = []
+    for k, sl in enumerate(folds):
+        X_test, Y_test = (X[:-1, sl], Y[:, sl]) if score == 'decode' else (None, None)
+        jobs.append((R_tot - R[k], S_tot - S[k], T_tot - T[k], n_tot - n[k], R[k], S[k], T[k], n[k],
+            regularizers, score, X_test, Y_test, decode_args))
+
+    if n_processes > 1:
+        import multiprocessing as mp
+        pool = mp.Pool(min(n_processes, n_folds))
+        try:
+            fold_scores = pool.map(_score_fold, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        fold_scores = map(_score_fold, jobs)
+    fold_scores = np.array(fold_scores).T # (n_regularizers, n_folds)
+
+    table = np.zeros(len(regularizers), dtype=[('regularizer', np.float64), ('mean_score', np.float64),
+        ('std_score', np.float64), ('fold_scores', np.float64, (n_folds,))])
+    table['regularizer'] = regularizers
+    table['mean_score'] = fold_scores.mean(axis=1)
+    table['std_score'] = fold_scores.std(axis=1)
+    table['fold_scores'] = fold_scores
+    return table
+
+
+def best_regularizer(table):
+    '''
+    Regularizer with the highest mean score in a table from cross_validate_kf. Ties go to the first listed
+    '''
+    mean_scores = np.where(np.isnan(table['mean_score']), -np.inf, table['mean_score'])
+    return table['regularizer'][np.argmax(mean_scores)]
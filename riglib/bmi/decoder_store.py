@@ -0,0 +1,302 @@
+'''
+Versioned binary storage for Decoder objects. A decoder file consists of
+    - a small JSON header with a description of the decoder (class, states, units,
+      feature extractor, etc.) which can be read without importing any decoder classes
+    - the pickled object graph of the decoder, with all the numpy arrays taken out
+    - the raw data of the numpy arrays, aligned so that they can be memory-mapped
+
+Loading a decoder memory-maps the file and creates the arrays as views into the mapping
+instead of deserializing them. The mapping is copy-on-write, so in-place modifications of
+the decoder parameters (e.g., by CLDA) are never written back to the file.
+'''
+import os
+import json
+import struct
+import tempfile
+import cPickle
+import cStringIO
+import numpy as np
+
+
+MAGIC = 'BMI3DDEC'
+FORMAT_VERSION = 1
+FILE_EXT = '.dec'
+
+_preamble = struct.Struct('<8sIQ') # magic, format version, header length
+_ALIGN = 64
+
+
+def _aligned(offset):
+    return int(np.ceil(float(offset) / _ALIGN) * _ALIGN)
+
+
+def _json_safe(obj):
+    '''
+    Convert an object to something that can be written to the JSON header
+    '''
+    if isinstance(obj, dict):
+        return dict((str(k), _json_safe(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return [_json_safe(x) for x in obj]
+    elif isinstance(obj, np.ndarray):
+        return _json_safe(obj.tolist())
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    elif isinstance(obj, type):
+        return '%s.%s' % (obj.__module__, obj.__name__)
+    elif obj is None or isinstance(obj, (bool, int, long, float, str, unicode)):
+        return obj
+    else:
+        return repr(obj)
+
+
+def _class_name(obj):
+    kls = obj.__class__
+    return '%s.%s' % (kls.__module__, kls.__name__)
+
+
+def _describe(decoder):
+    '''
+    Metadata stored in the header of a decoder file
+    '''
+    desc = dict(cls=_class_name(decoder))
+    if hasattr(decoder, 'filt'):
+        desc['filt_cls'] = _class_name(decoder.filt)
+    if hasattr(decoder, 'ssm'):
+        desc['ssm_cls'] = _class_name(decoder.ssm)
+    try:
+        desc['states'] = list(decoder.states)
+    except Exception:
+        pass
+
+    for attr in ['name', 'units', 'binlen', 'tslice', 'call_rate', 'zscore', 'te_id',
+                 'extractor_cls', 'extractor_kwargs']:
+        if hasattr(decoder, attr):
+            desc[attr] = _json_safe(getattr(decoder, attr))
+
+    if 'units' in desc:
+        desc['n_units'] = len(desc['units'])
+    return desc
+
+
+def _storable(obj):
+    '''
+    True for the arrays which are written as raw data rather than pickled
+    '''
+    return type(obj) in (np.ndarray, np.matrix, np.memmap) and obj.dtype.fields is None \
+        and not obj.dtype.hasobject
+
+
+def save_decoder(decoder, filename):
+    '''
+    Write a decoder to a file in the binary format
+
+    Parameters
+    ----------
+    decoder : riglib.bmi.Decoder instance
+        Decoder to save
+    filename : string
+        Name of the file to write
+
+    Returns
+    -------
+    filename : string
+    '''
+    arrays = []
+    array_ids = dict()
+    def persistent_id(obj):
+        if not _storable(obj):
+            return None
+        key = id(obj)
+        if key not in array_ids:
+            array_ids[key] = len(arrays)
+            arrays.append(obj)
+        return array_ids[key]
+
+    buf = cStringIO.StringIO()
+    pickler = cPickle.Pickler(buf, 2)
+    pickler.persistent_id = persistent_id
+    pickler.dump(decoder)
+    skeleton = buf.getvalue()
+
+    # lay out the array data after the pickled object graph. The header is written first, so
+    # its size is fixed by reserving space for the largest possible offset values
+    array_table = []
+    for arr in arrays:
+        fortran = arr.flags.f_contiguous and not arr.flags.c_contiguous
+        array_table.append(dict(dtype=arr.dtype.str, shape=list(arr.shape), fortran=bool(fortran),
+            matrix=isinstance(arr, np.matrix), offset=0, nbytes=int(arr.nbytes)))
+
+    header = dict(format='bmi3d-decoder', version=FORMAT_VERSION, decoder=_describe(decoder),
+        skeleton=dict(offset=0, nbytes=len(skeleton)), arrays=array_table)
+    placeholder = 2**62
+    header['skeleton']['offset'] = placeholder
+    for entry in array_table:
+        entry['offset'] = placeholder
+    header_len = len(json.dumps(header))
+
+    offset = _aligned(_preamble.size + header_len)
+    header['skeleton']['offset'] = offset
+    offset += len(skeleton)
+    for entry in array_table:
+        offset = _aligned(offset)
+        entry['offset'] = offset
+        offset += entry['nbytes']
+    header_str = json.dumps(header).ljust(header_len)
+
+    # write to a temporary file and rename it into place so that readers never see a partial file
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_fname = tempfile.mkstemp(prefix='.tmp_', dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(_preamble.pack(MAGIC, FORMAT_VERSION, header_len))
+            fh.write(header_str)
+            fh.seek(header['skeleton']['offset'])
+            fh.write(skeleton)
+            for arr, entry in zip(arrays, array_table):
+                fh.seek(entry['offset'])
+                fh.write(np.asarray(arr).tostring(order='F' if entry['fortran'] else 'C'))
+        os.rename(tmp_fname, filename)
+    except:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        raise
+    return filename
+
+
+def is_decoder_file(filename):
+    '''
+    Check whether a file is in the binary decoder format (as opposed to e.g. a pickle)
+    '''
+    with open(filename, 'rb') as fh:
+        return fh.read(len(MAGIC)) == MAGIC
+
+
+def read_header(filename):
+    '''
+    Read the header of a decoder file without loading the decoder
+
+    Parameters
+    ----------
+    filename : string
+        Name of a file written by save_decoder
+
+    Returns
+    -------
+    dict
+        The key 'decoder' contains the description of the decoder, see _describe
+    '''
+    with open(filename, 'rb') as fh:
+        preamble = fh.read(_preamble.size)
+        if len(preamble) < _preamble.size:
+            raise ValueError("%s is not a decoder file" % filename)
+        magic, version, header_len = _preamble.unpack(preamble)
+        if magic != MAGIC:
+            raise ValueError("%s is not a decoder file" % filename)
+        if version > FORMAT_VERSION:
+            raise ValueError("Decoder file %s has format version %d, only versions <= %d are supported" % (filename, version, FORMAT_VERSION))
+        return json.loads(fh.read(header_len))
+
+
+def load_decoder(filename, find_global=None, mmap=True):
+    '''
+    Load a decoder from a file in the binary format
+
+    Parameters
+    ----------
+    filename : string
+        Name of a file written by save_decoder
+    find_global : callable, optional
+        Function to look up classes by module and class name while unpickling, e.g.,
+        to handle classes which have been renamed. See db.tracker.models.decoder_unpickler
+    mmap : bool, optional, default=True
+        If true, the decoder arrays are views into a copy-on-write memory-mapping of the
+        file. Otherwise the file is read into memory.
+
+    Returns
+    -------
+    riglib.bmi.Decoder instance
+    '''
+    header = read_header(filename)
+    if mmap:
+        data = np.memmap(filename, dtype=np.uint8, mode='c')
+    else:
+        data = np.fromfile(filename, dtype=np.uint8)
+
+    arrays = [None] * len(header['arrays'])
+    def persistent_load(pid):
+        if arrays[pid] is None:
+            entry = header['arrays'][pid]
+            shape, dtype, order = tuple(entry['shape']), np.dtype(str(entry['dtype'])), 'F' if entry['fortran'] else 'C'
+            if entry['nbytes'] == 0:
+                arr = np.empty(shape, dtype=dtype, order=order)
+            else:
+                arr = np.ndarray(shape, dtype=dtype, buffer=data, offset=entry['offset'], order=order)
+            if entry['matrix']:
+                arr = arr.view(np.matrix)
+            arrays[pid] = arr
+        return arrays[pid]
+
+    skeleton = header['skeleton']
+    skeleton_str = data[skeleton['offset']:skeleton['offset'] + skeleton['nbytes']].tostring()
+    unpickler = cPickle.Unpickler(cStringIO.StringIO(skeleton_str))
+    unpickler.persistent_load = persistent_load
+    if find_global is not None:
+        unpickler.find_global = find_global
+    return unpickler.load()
+
+
+def load(filename, find_global=None, mmap=True):
+    '''
+    Load a decoder saved either in the binary format or as a pickle
+
+    Parameters
+    ----------
+    filename : string
+        Decoder file name
+    find_global : callable, optional
+        See load_decoder
+    mmap : bool, optional, default=True
+        See load_decoder. Ignored for pickled decoders
+
+    Returns
+    -------
+    riglib.bmi.Decoder instance
+    '''
+    if is_decoder_file(filename):
+        return load_decoder(filename, find_global=find_global, mmap=mmap)
+
+    with open(filename, 'rb') as fh:
+        unpickler = cPickle.Unpickler(fh)
+        if find_global is not None:
+            unpickler.find_global = find_global
+        return unpickler.load()
+
+
+def convert(pkl_filename, filename=None, find_global=None):
+    '''
+    Convert a pickled decoder to the binary format
+
+    Parameters
+    ----------
+    pkl_filename : string
+        Pickled decoder
+    filename : string, optional
+        Name of the new file. Defaults to the name of the pickle file with the extension replaced by FILE_EXT
+    find_global : callable, optional
+        See load_decoder
+
+    Returns
+    -------
+    filename : string
+    '''
+    if filename is None:
+        filename = os.path.splitext(pkl_filename)[0] + FILE_EXT
+    decoder = load(pkl_filename, find_global=find_global)
+    return save_decoder(decoder, filename)
+
+
+if __name__ == '__main__':
+    import sys
+    for pkl_filename in sys.argv[1:]:
+        print "%s -> %s" % (pkl_filename, convert(pkl_filename))
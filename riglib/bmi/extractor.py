@@ -5,10 +5,12 @@ Examples include spike rate estimation, LFP power, and EMG amplitude.
 import numpy as np
 import time
 import sim_neurons
-from scipy.signal import butter, lfilter
+from scipy.signal import butter, lfilter, sosfilt
 import math
 import os
+import multiprocessing as mp
 from itertools import izip
+from numpy.lib.stride_tricks import as_strided
 # try:
 #     import h5py
 # except:
@@ -75,6 +77,9 @@ class BinnedSpikeCountsExtractor(FeatureExtractor):
         self.extractor_kwargs = extractor_kwargs
         self.last_get_spike_counts_time = 0
 
+        # dense (channel, unit) -> column lookup table used to bin spikes every cycle
+        self.unit_lut = self.make_unit_lut(units)
+
     def set_n_subbins(self, n_subbins):
         '''
         Alter the # of subbins without changing the extractor kwargs of a decoder
@@ -131,6 +136,73 @@ class BinnedSpikeCountsExtractor(FeatureExtractor):
             max_ind = np.argmax(ts['ts'])
             bin_edges = np.array([ts[min_ind]['ts'], ts[max_ind]['ts']])
 
+    @staticmethod
+    def make_unit_lut(units):
+        '''
+        Build a dense lookup table mapping a (channel, unit) pair to the column of 
+        the feature vector in which spikes from that unit are counted
+
+        Parameters
+        ----------
+        units : np.ndarray of shape (N, 2)
+            Each row corresponds to (channel, unit)
+
+        Returns
+        -------
+        np.ndarray of shape (max_channel+1, max_unit+1)
+            lut[chan, unit] is the column index of the unit in 'units', or -1 if the unit is not used by the BMI
+        '''
+        units = np.asarray(units, dtype=np.intp).reshape(-1, 2)
+        if len(units) == 0:
+            return -np.ones((0, 0), dtype=np.intp)
+
+        lut = -np.ones((units[:,0].max() + 1, units[:,1].max() + 1), dtype=np.intp)
+        lut[units[:,0], units[:,1]] = np.arange(len(units))
+        return lut
+
+    @staticmethod
+    def bin_spikes_lut(ts, unit_lut, n_units, subbin_inds=None, n_subbins=1):
+        '''
+        Count up the number of BMI spikes in a list of spike timestamps using a 
+        precomputed unit lookup table (see make_unit_lut). All subbins are filled with a single bincount.
+
+        Parameters
+        ----------
+        ts : numpy record array
+            Must have fields 'chan' and 'unit'
+        unit_lut : np.ndarray
+            Lookup table created by make_unit_lut
+        n_units : int
+            Number of units (rows of the output)
+        subbin_inds : np.ndarray of shape (len(ts),), optional, default=None
+            0-based subbin index of each spike. Spikes with indices outside [0, n_subbins) are ignored. 
+            If None, all spikes are counted in a single bin.
+        n_subbins : int, optional, default=1
+            Number of subbins (columns of the output)
+
+        Returns
+        -------
+        np.ndarray of shape (n_units, n_subbins)
+            Counts of spike events for each unit in each subbin
+        '''
+        chan = np.asarray(ts['chan'], dtype=np.intp)
+        unit = np.asarray(ts['unit'], dtype=np.intp)
+        n_lut_chan, n_lut_unit = unit_lut.shape
+
+        cols = -np.ones(len(chan), dtype=np.intp)
+        in_table = (chan >= 0) & (chan < n_lut_chan) & (unit >= 0) & (unit < n_lut_unit)
+        cols[in_table] = unit_lut[chan[in_table], unit[in_table]]
+
+        if subbin_inds is None:
+            keep = cols >= 0
+            flat_inds = cols[keep]
+        else:
+            keep = (cols >= 0) & (subbin_inds >= 0) & (subbin_inds < n_subbins)
+            flat_inds = subbin_inds[keep] * n_units + cols[keep]
+
+        counts = np.bincount(flat_inds, minlength=n_units*n_subbins)
+        return counts.reshape(n_subbins, n_units).T
+
     @classmethod
     def bin_spikes(cls, ts, units, max_units_per_channel=13):
         '''
@@ -145,20 +217,14 @@ class BinnedSpikeCountsExtractor(FeatureExtractor):
             the unit index (an index to differentiate the possibly many units on the same electrode). These are 
             the units used in the BMI.
         max_units_per_channel : int, optional, default=13
-            This int is used to map from a (channel, unit) index to a single 'unit_ind' 
-            for faster binning of spike timestamps. Just set to a large number.
+            Unused, retained for backwards compatibility. Units are mapped to counts through the lookup table from 'make_unit_lut'
 
         Returns
         -------
-        np.ndarray of shape (N, 1)
-            Column vector of counts of spike events for each of the N units.
+        np.ndarray of shape (N,)
+            Counts of spike events for each of the N units.
         '''
-        unit_inds = units[:,0]*max_units_per_channel + units[:,1]
-        edges = np.sort(np.hstack([unit_inds - 0.5, unit_inds + 0.5]))
-
-        spiking_unit_inds = ts['chan']*max_units_per_channel + ts['unit']
-        counts, _ = np.histogram(spiking_unit_inds, edges)
-        return counts[::2]
+        return cls.bin_spikes_lut(ts, cls.make_unit_lut(units), len(units))[:,0]
 
     def __call__(self, start_time, *args, **kwargs):
         '''
@@ -188,10 +254,10 @@ class BinnedSpikeCountsExtractor(FeatureExtractor):
             # An acceptable delay is 1 sec or less. Realistically, most delays should be
             # on the millisecond order
             subbin_edges[0] -= 1
-            subbin_inds = np.digitize(ts['arrival_ts'], subbin_edges)
-            counts = np.vstack([self.bin_spikes(ts[subbin_inds == k], self.units) for k in range(1, self.n_subbins+1)]).T
+            subbin_inds = np.digitize(ts['arrival_ts'], subbin_edges) - 1
+            counts = self.bin_spikes_lut(ts, self.unit_lut, len(self.units), subbin_inds, self.n_subbins)
         else:
-            counts = self.bin_spikes(ts, self.units).reshape(-1, 1)
+            counts = self.bin_spikes_lut(ts, self.unit_lut, len(self.units))
 
         counts = np.array(counts, dtype=np.uint32)
         bin_edges = self.get_bin_edges(ts)
@@ -360,6 +426,116 @@ default_bands = []
 for freq in range(start, end, step):
     default_bands.append((freq, freq+step))
 
+class MTMPowerEngine(object):
+    '''
+    Batched multi-taper power estimator. The DPSS tapers for a window of 'n_pts' samples are 
+    computed once, all tapers are applied to all channels with a single real FFT and the 
+    band powers are computed with a single multiply by a precomputed band-weight matrix. 
+
+    The PSD estimate is the same as nitime.algorithms.multi_taper_psd(s, Fs=fs, NW=NW, 
+    adaptive=False, jackknife=False, low_bias=True, NFFT=nfft)
+    '''
+    def __init__(self, n_pts, NW, fs, nfft, fft_inds, epsilon=1e-9):
+        '''
+        Constructor for MTMPowerEngine
+
+        Parameters
+        ----------
+        n_pts : int
+            Number of time samples in each window
+        NW : float
+            Time-bandwidth product of the tapers
+        fs : float
+            Sampling rate of the time series, in Hz
+        nfft : int
+            Number of FFT points. Must be >= n_pts
+        fft_inds : dict
+            Keys are band indices, values are lists of the FFT frequency indices in the band
+        epsilon : float, optional, default=1e-9
+            Added to the PSD before taking the log of the power
+
+        Returns
+        -------
+        MTMPowerEngine instance
+        '''
+        self.n_pts = n_pts
+        self.NW = NW
+        self.fs = fs
+        self.nfft = max(nfft, n_pts)
+        self.epsilon = epsilon
+
+        # keep only the tapers with > 90% energy concentration (nitime's 'low_bias' option)
+        tapers, eigvals = tsa.dpss_windows(n_pts, NW, int(2*NW))
+        keepers = eigvals > 0.9
+        self.tapers = tapers[keepers]
+        self.eigvals = eigvals[keepers]
+
+        # non-adaptive weighting of the tapered spectra, scaled to a one-sided PSD
+        self.n_freqs = self.nfft // 2 + 1
+        self.taper_weights = self.eigvals / (np.sum(self.eigvals) * fs)
+        self.freq_scale = np.ones(self.n_freqs)
+        self.freq_scale[1:(self.nfft + 1) // 2] = 2
+
+        # band-averaging matrix; bands with no FFT bins have a NaN power, as with np.mean of an empty slice
+        n_bands = len(fft_inds)
+        self.band_weights = np.zeros((self.n_freqs, n_bands))
+        self.empty_bands = np.zeros(n_bands, dtype=bool)
+        for band_idx in range(n_bands):
+            inds = fft_inds[band_idx]
+            if len(inds) > 0:
+                self.band_weights[inds, band_idx] = 1. / len(inds)
+            else:
+                self.empty_bands[band_idx] = True
+
+    def psd(self, cont_samples):
+        '''
+        Multi-taper PSD estimate of each time series
+
+        Parameters
+        ----------
+        cont_samples : np.ndarray of shape (..., n_pts)
+            Time series, e.g., (n_channels, n_pts) or (n_windows, n_channels, n_pts)
+
+        Returns
+        -------
+        np.ndarray of shape (..., nfft/2 + 1)
+            One-sided PSD of each time series
+        '''
+        cont_samples = np.asarray(cont_samples, dtype=np.float64)
+        demeaned = cont_samples - np.mean(cont_samples, axis=-1)[..., np.newaxis]
+
+        # (tapers, ..., n_pts) array of tapered sequences
+        taper_shape = (len(self.tapers),) + (1,)*(demeaned.ndim - 1) + (self.n_pts,)
+        tapered = self.tapers.reshape(taper_shape) * demeaned
+        spectra = np.fft.rfft(tapered, n=self.nfft, axis=-1)
+        power = spectra.real**2 + spectra.imag**2
+
+        psd_est = np.tensordot(self.taper_weights, power, axes=(0, 0))
+        psd_est *= self.freq_scale
+        return psd_est
+
+    def band_power(self, psd_est, log=True):
+        '''
+        Average the PSD (or log10 of the PSD) over the FFT bins in each band
+
+        Parameters
+        ----------
+        psd_est : np.ndarray of shape (..., nfft/2 + 1)
+            Output of the 'psd' method
+        log : bool, optional, default=True
+            If true, average log10(psd + epsilon) instead of the PSD
+
+        Returns
+        -------
+        np.ndarray of shape (..., n_bands)
+        '''
+        if log:
+            psd_est = np.log10(psd_est + self.epsilon)
+        band_power = np.dot(psd_est, self.band_weights)
+        band_power[..., self.empty_bands] = np.nan
+        return band_power
+
+
 class LFPMTMPowerExtractor(object):
     '''
     Computes log power of the LFP in different frequency bands (for each 
@@ -420,6 +596,7 @@ class LFPMTMPowerExtractor(object):
         extractor_kwargs['fft_freqs']      = fft_freqs
         
         self.epsilon = 1e-9
+        self.mtm = MTMPowerEngine(self.n_pts, self.NW, self.fs, self.nfft, self.fft_inds, epsilon=self.epsilon)
 
         if extractor_kwargs['no_mean']: #Used in lfp 1D control task
             self.feature_dtype = ('lfp_power', 'f8', (len(channels)*len(fft_freqs), 1))
@@ -455,22 +632,15 @@ class LFPMTMPowerExtractor(object):
         lfp_power : np.ndarray of shape (n_channels * n_features, 1)
             Multi-band power estimates for each channel, for each band specified when the feature extractor was instantiated.
         '''
-        psd_est = tsa.multi_taper_psd(cont_samples, Fs=self.fs, NW=self.NW, jackknife=False, low_bias=True, NFFT=self.nfft)[1]
+        psd_est = self.mtm.psd(cont_samples)
         
         if (self.extractor_kwargs.has_key('no_mean')) and (self.extractor_kwargs['no_mean'] is True):
             return psd_est.reshape(psd_est.shape[0]*psd_est.shape[1], 1)
 
         else:
-            # compute average power of each band of interest
-            n_chan = len(self.channels)
-            lfp_power = np.zeros((n_chan * len(self.bands), 1))
-            for idx, band in enumerate(self.bands):
-                if self.extractor_kwargs['no_log']:
-                    lfp_power[idx*n_chan : (idx+1)*n_chan, 0] = np.mean(psd_est[:, self.fft_inds[idx]], axis=1)
-                else:
-                    lfp_power[idx*n_chan : (idx+1)*n_chan, 0] = np.mean(np.log10(psd_est[:, self.fft_inds[idx]] + self.epsilon), axis=1)
-            
-            return lfp_power
+            # compute average power of each band of interest, ordered by band and then by channel
+            band_power = self.mtm.band_power(psd_est, log=not self.extractor_kwargs['no_log'])
+            return band_power.T.reshape(-1, 1)
 
     def __call__(self, start_time, *args, **kwargs):
         '''
@@ -542,30 +712,9 @@ class LFPMTMPowerExtractor(object):
             f_extractor = LFPMTMPowerExtractor(None, **extractor_kwargs)
             extractor_kwargs = f_extractor.extractor_kwargs
 
-            win_len  = f_extractor.win_len
-            bands    = f_extractor.bands
-            channels = f_extractor.channels
-            fs       = f_extractor.fs
-            print 'bands:', bands
+            print 'bands:', f_extractor.bands
 
-            n_itrs = len(interp_rows)
-            n_chan = len(channels)
-            lfp_power = np.zeros((n_itrs, n_chan * len(bands)))
-            
-            # for i, t in enumerate(interp_rows):
-            #     cont_samples = plx.lfp[t-win_len:t].data[:, channels-1]
-            #     lfp_power[i, :] = f_extractor.extract_features(cont_samples.T).T
-            lfp = plx.lfp[:].data[:, channels-1]
-            n_pts = int(win_len * fs)
-            for i, t in enumerate(interp_rows):
-                try:
-                    sample_num = int(t * fs)
-                    cont_samples = lfp[sample_num-n_pts:sample_num, :]
-                    lfp_power[i, :] = f_extractor.extract_features(cont_samples.T).T
-                except:
-                    print "Error with LFP decoder training"
-                    print i, t
-                    pass
+            lfp_power = compute_mtm_power(plx.lfp, f_extractor, interp_rows)
 
 
             # TODO -- discard any channel(s) for which the log power in any frequency 
@@ -580,6 +729,81 @@ class LFPMTMPowerExtractor(object):
             raise NotImplementedError
 
 
+class SourceProcessFeatureExtractor(FeatureExtractor):
+    '''
+    Runs a feature extractor inside the process of its data source (see riglib.source.FeatureExtractionMixin) 
+    and reads the finished feature vectors out of the source's shared-memory feature ring. The per-cycle 
+    cost in the task process is then independent of how much raw data arrived, and expensive extractors 
+    (e.g., multitaper LFP power) no longer run in the task loop.
+    '''
+    def __init__(self, extractor, interval, n_slots=16):
+        '''
+        Constructor for SourceProcessFeatureExtractor
+
+        Parameters
+        ----------
+        extractor : FeatureExtractor instance
+            Extractor to run in the source process. Its 'source' must be a riglib.source.DataSource 
+            or MultiChanDataSource which has not yet been started
+        interval : float
+            Seconds between feature vectors computed in the source process, typically the task update rate
+        n_slots : int, optional, default=16
+            Number of feature vectors to keep in the shared ring
+
+        Returns
+        -------
+        SourceProcessFeatureExtractor instance
+        '''
+        self.extractor = extractor
+        self.source = extractor.source
+        self.feature_type = extractor.feature_type
+        self.feature_dtype = extractor.feature_dtype
+        self.source.set_feature_extractor(extractor, interval, n_slots=n_slots)
+
+        # Counts are computed over disjoint bins in the source process, so all the vectors computed 
+        # since the last cycle are summed. Other features (e.g., power over a sliding window) use the latest vector
+        self.accumulate = self.feature_type in ['spike_counts', 'cluster_counts']
+        self.last_features = np.zeros(1, dtype=self.source.features.dtype)[0]
+
+    def __getattr__(self, attr):
+        '''
+        Look up attributes (e.g., 'units', 'n_subbins') of the wrapped extractor
+        '''
+        if attr.startswith('__') or attr == 'extractor':
+            raise AttributeError(attr)
+        return getattr(self.extractor, attr)
+
+    def __call__(self, start_time, *args, **kwargs):
+        '''
+        Retrieve the features computed in the source process since the last call
+
+        Parameters
+        ----------
+        start_time : float
+            Absolute time from the task event loop. Unused, the features are timestamped in the source process
+        *args, **kwargs : optional positional/keyword arguments
+            Ignored
+
+        Returns
+        -------
+        dict
+            Extracted features to be saved in the task.
+        '''
+        data, ts = self.source.get_new_features()
+        if len(data) > 0:
+            self.last_features = data[-1]
+
+        features = dict()
+        for name in self.last_features.dtype.names:
+            features[name] = np.array(self.last_features[name])
+
+        if self.accumulate:
+            counts_dtype = self.last_features.dtype[self.feature_type].base
+            features[self.feature_type] = np.sum(data[self.feature_type], axis=0, dtype=counts_dtype) \
+                if len(data) > 0 else np.zeros_like(features[self.feature_type])
+        return features
+
+
 #########################################################
 ##### Reconstruction extractors, used in test cases #####
 #########################################################
@@ -609,6 +833,7 @@ class ReplaySpikeCountsExtractor(BinnedSpikeCountsExtractor):
         self.hdf_table = hdf_table
         self.source = source
         self.units = units
+        self.unit_lut = self.make_unit_lut(units)
         self.n_subbins = hdf_table[0][source].shape[1]
         self.last_get_spike_counts_time = 0
         self.cycle_rate = cycle_rate
@@ -726,6 +951,7 @@ class SimBinnedSpikeCountsExtractor(BinnedSpikeCountsExtractor):
         self.encoder = encoder
         self.n_subbins = n_subbins
         self.units = units
+        self.unit_lut = self.make_unit_lut(units)
         self.last_get_spike_counts_time = 0
         self.feature_dtype = [('spike_counts', 'f8', (len(units), n_subbins)), ('bin_edges', 'f8', 2),
             ('ctrl_input', 'f8', self.encoder.C.shape[1])]
@@ -765,7 +991,34 @@ class LFPButterBPFPowerExtractor(object):
 
     feature_type = 'lfp_power'
 
-    def __init__(self, source, channels=[], bands=default_bands, win_len=0.2, filt_order=5, fs=1000):
+    def __init__(self, source, channels=[], bands=default_bands, win_len=0.2, filt_order=5, fs=1000, streaming=False):
+        '''
+        Constructor for LFPButterBPFPowerExtractor
+
+        Parameters
+        ----------
+        source : riglib.source.MultiChanDataSource object
+            Object which yields new data when its 'get' (or 'get_new', if streaming) method is called
+        channels : list 
+            LFP electrode indices to use for feature extraction
+        bands : list of tuples
+            Each tuple defines a frequency band of interest as (start frequency, end frequency) 
+        win_len : float, optional, default=0.2
+            Length of the power estimation window, in seconds
+        filt_order : int, optional, default=5
+            Order of the Butterworth band-pass filters
+        fs : float, optional, default=1000
+            Sampling rate, used only if no source is specified
+        streaming : bool, optional, default=False
+            If true, filter only the new samples from the source every cycle, carrying the 
+            filter state across cycles, and keep a running sum of the squared filter 
+            outputs over the last 'win_len' seconds. Otherwise, the last 'win_len' seconds 
+            are re-filtered from zero initial state every cycle.
+
+        Returns
+        -------
+        LFPButterBPFPowerExtractor instance
+        '''
         self.feature_dtype = ('lfp_power', 'u4', (len(channels)*len(bands), 1))
 
         self.source = source
@@ -773,6 +1026,7 @@ class LFPButterBPFPowerExtractor(object):
         self.bands = bands
         self.win_len = win_len  # secs
         self.filt_order = filt_order
+        self.streaming = streaming
         if source is not None:
             self.fs = source.source.update_freq
         else:
@@ -784,23 +1038,71 @@ class LFPButterBPFPowerExtractor(object):
         extractor_kwargs['win_len']    = self.win_len
         extractor_kwargs['filt_order'] = self.filt_order
         extractor_kwargs['fs']         = self.fs
+        extractor_kwargs['streaming']  = self.streaming
         self.extractor_kwargs = extractor_kwargs
 
         self.n_pts = int(self.win_len * self.fs)
         self.filt_coeffs = dict()
+        self.filt_sos = dict()
         for band in bands:
             nyq = 0.5 * self.fs
             low = band[0] / nyq
             high = band[1] / nyq
             self.filt_coeffs[band] = butter(self.filt_order, [low, high], btype='band')  # returns (b, a)
+            self.filt_sos[band] = butter(self.filt_order, [low, high], btype='band', output='sos')
 
         self.epsilon = 1e-9
 
         self.last_get_lfp_power_time = 0  # TODO -- is this variable necessary for LFP?
 
+        if self.streaming:
+            self._init_streaming_state()
+
+    def _init_streaming_state(self):
+        '''
+        Allocate the per-band, per-channel filter state and the ring of squared filter outputs used in streaming mode
+        '''
+        n_chan = len(self.channels)
+        n_bands = len(self.bands)
+        n_sections = self.filt_sos[self.bands[0]].shape[0] if n_bands > 0 else 0
+
+        # filter state, in the format expected by scipy.signal.sosfilt for each band
+        self.sos_zi = np.zeros((n_bands, n_sections, n_chan, 2))
+
+        # ring of the squared filter outputs for the last n_pts samples, and their running sum
+        self.sq_ring = np.zeros((n_bands, n_chan, self.n_pts))
+        self.sq_sum = np.zeros((n_bands, n_chan))
+        self.ring_idx = 0
+
+        # samples which have arrived on some channels but not yet on all of them
+        self.pending = [np.zeros(0) for chan in self.channels]
+
     def get_cont_samples(self, *args, **kwargs):
         return self.source.get(self.n_pts, self.channels)
 
+    def get_new_samples(self, *args, **kwargs):
+        '''
+        Retreive the samples which have arrived on all channels since the last call, for streaming mode
+
+        Returns
+        -------
+        np.ndarray of shape (n_channels, n_new)
+        '''
+        new_data = self.source.get_new(self.channels)
+        n_configured = [len(data) for data in new_data if data is not None]
+        n_fill = max(n_configured) if len(n_configured) > 0 else 0
+
+        # channels the source does not stream from are zero, as in MultiChanDataSource.get
+        for k, data in enumerate(new_data):
+            if data is None:
+                data = np.zeros(n_fill)
+            self.pending[k] = np.hstack([self.pending[k], data])
+
+        n_new = min(len(data) for data in self.pending)
+        new_samples = np.vstack([data[:n_new] for data in self.pending])
+        self.pending = [data[n_new:] for data in self.pending]
+        return new_samples
+
     def extract_features(self, cont_samples):
         n_chan = len(self.channels)
         
@@ -812,9 +1114,53 @@ class LFPButterBPFPowerExtractor(object):
 
         return lfp_power
 
+    def extract_features_streaming(self, new_samples):
+        '''
+        Update the band power estimates with the samples which arrived since the last call. 
+        Work is proportional to the number of new samples rather than the window length.
+
+        Parameters
+        ----------
+        new_samples : np.ndarray of shape (n_channels, n_new)
+            Raw voltage time series (one per channel) which have not yet been filtered
+
+        Returns
+        -------
+        lfp_power : np.ndarray of shape (n_channels * n_bands, 1)
+            Log power in each band for each channel over the last 'win_len' seconds, in the same order as 'extract_features'
+        '''
+        n_new = new_samples.shape[1]
+        if n_new > 0:
+            # filter all channels of each band at once, carrying over the filter state from the last call
+            sq = np.empty((len(self.bands), new_samples.shape[0], n_new))
+            for i, band in enumerate(self.bands):
+                y, self.sos_zi[i] = sosfilt(self.filt_sos[band], new_samples, axis=-1, zi=self.sos_zi[i])
+                sq[i] = y**2
+
+            if n_new >= self.n_pts:
+                self.sq_ring[:] = sq[:, :, -self.n_pts:]
+                self.sq_sum = np.sum(self.sq_ring, axis=-1)
+                self.ring_idx = 0
+            else:
+                inds = (self.ring_idx + np.arange(n_new)) % self.n_pts
+                self.sq_sum += np.sum(sq, axis=-1) - np.sum(self.sq_ring[:, :, inds], axis=-1)
+                self.sq_ring[:, :, inds] = sq
+
+                # re-sum the ring once per window to keep round-off from accumulating in the running sum
+                if self.ring_idx + n_new >= self.n_pts:
+                    self.sq_sum = np.sum(self.sq_ring, axis=-1)
+                self.ring_idx = (self.ring_idx + n_new) % self.n_pts
+
+        lfp_power = np.log((1. / self.n_pts) * self.sq_sum + self.epsilon)
+        return lfp_power.reshape(-1, 1)
+
     def __call__(self, start_time, *args, **kwargs):
-        cont_samples = self.get_cont_samples(*args, **kwargs)  # dims of channels x time
-        lfp_power = self.extract_features(cont_samples)
+        if self.streaming:
+            new_samples = self.get_new_samples(*args, **kwargs)  # dims of channels x time
+            lfp_power = self.extract_features_streaming(new_samples)
+        else:
+            cont_samples = self.get_cont_samples(*args, **kwargs)  # dims of channels x time
+            lfp_power = self.extract_features(cont_samples)
 
         self.last_get_lfp_power_time = start_time
         
@@ -952,6 +1298,7 @@ class AIMTMPowerExtractor(LFPMTMPowerExtractor):
         extractor_kwargs['fft_freqs']      = fft_freqs
         
         self.epsilon = 1e-9
+        self.mtm = MTMPowerEngine(self.n_pts, self.NW, self.fs, self.nfft, self.fft_inds, epsilon=self.epsilon)
 
         if extractor_kwargs['no_mean']: #Used in lfp 1D control task
             self.feature_dtype = ('ai_power', 'f8', (len(channels)*len(fft_freqs), 1))
@@ -1009,30 +1356,9 @@ class AIMTMPowerExtractor(LFPMTMPowerExtractor):
             f_extractor = AIMTMPowerExtractor(None, **extractor_kwargs)
             extractor_kwargs = f_extractor.extractor_kwargs
 
-            win_len  = f_extractor.win_len
-            bands    = f_extractor.bands
-            channels = f_extractor.channels
-            fs       = f_extractor.fs
-            print 'bands:', bands
+            print 'bands:', f_extractor.bands
 
-            n_itrs = len(interp_rows)
-            n_chan = len(channels)
-            lfp_power = np.zeros((n_itrs, n_chan * len(bands)))
-            
-            # for i, t in enumerate(interp_rows):
-            #     cont_samples = plx.lfp[t-win_len:t].data[:, channels-1]
-            #     lfp_power[i, :] = f_extractor.extract_features(cont_samples.T).T
-            lfp = plx.lfp[:].data[:, channels-1]
-            n_pts = int(win_len * fs)
-            for i, t in enumerate(interp_rows):
-                try:
-                    sample_num = int(t * fs)
-                    cont_samples = lfp[sample_num-n_pts:sample_num, :]
-                    lfp_power[i, :] = f_extractor.extract_features(cont_samples.T).T
-                except:
-                    print "Error with LFP decoder training"
-                    print i, t
-                    pass
+            lfp_power = compute_mtm_power(plx.lfp, f_extractor, interp_rows)
 
 
             # TODO -- discard any channel(s) for which the log power in any frequency 
@@ -1087,9 +1413,277 @@ class AIAmplitudeExtractor(object):
         emg = self.extract_features(cont_samples)
         return emg, None
 
+class GMMWaveformClassifier(object):
+    '''
+    Scores spike waveforms against a Gaussian mixture model of the waveforms on each channel. 
+    The Cholesky factors of the component precisions and the log-normalizers of each component 
+    are computed once from the model parameters. The spikes of each cycle are grouped by channel 
+    and every spike is scored against all of its channel's components with batched matrix 
+    multiplies over blocks of channels, rather than one spike (or one channel) at a time.
+    '''
+    def __init__(self, gmm_model_params, units):
+        '''
+        Constructor for GMMWaveformClassifier
+
+        Parameters
+        ----------
+        gmm_model_params : dict
+            Keys are channel numbers. Each value is a dict with keys
+                'weights' : np.ndarray of shape (K,), mixing weights of the K components
+                'means'   : np.ndarray of shape (K, D), mean waveform of each component
+                'covars'  : np.ndarray of shape (K, D, D), or (K, D) for diagonal covariances
+                'units'   : np.ndarray of shape (K, 2), (channel, unit) represented by each component
+        units : np.ndarray of shape (N, 2)
+            Units whose counts make up the feature vector. Components of units not in this list are scored but not counted.
+
+        Returns
+        -------
+        GMMWaveformClassifier instance
+        '''
+        units = np.asarray(units).reshape(-1, 2)
+        unit_cols = dict(((chan, unit), k) for k, (chan, unit) in enumerate(units))
+        self.n_units = len(units)
+
+        chans = sorted(gmm_model_params.keys())
+        n_models = len(chans)
+        n_pts = set(np.asarray(gmm_model_params[chan]['means']).shape[1] for chan in chans)
+        if len(n_pts) > 1:
+            raise ValueError("All channels must have the same waveform length")
+        n_pts = n_pts.pop() if n_models > 0 else 0
+        self.n_pts = n_pts
+        self.max_components = max([len(gmm_model_params[chan]['weights']) for chan in chans] + [0])
+        n_comp_max = self.max_components
+
+        # channel -> model lookup table
+        self.chan_lut = -np.ones(int(max(chans + [0])) + 1, dtype=np.intp)
+
+        # parameters of all the channels' models, with the components padded out to 
+        # the largest model. Padded components have zero probability
+        self.prec_chol = np.zeros((n_models, n_pts, n_comp_max*n_pts))
+        self.mean_proj = np.zeros((n_models, n_comp_max*n_pts))
+        self.log_norm = -np.inf * np.ones((n_models, n_comp_max))
+        self.comp_cols = -np.ones((n_models, n_comp_max), dtype=np.intp)
+
+        for m, chan in enumerate(chans):
+            params = gmm_model_params[chan]
+            weights = np.asarray(params['weights'], dtype=np.float64)
+            means = np.asarray(params['means'], dtype=np.float64)
+            covars = np.asarray(params['covars'], dtype=np.float64)
+            n_comp = len(weights)
+            if covars.ndim == 2:
+                covars = np.array([np.diag(c) for c in covars])
+            elif covars.ndim != 3:
+                raise ValueError("GMMWaveformClassifier only supports 'full' or 'diag' covariances")
+
+            self.chan_lut[chan] = m
+            for k in range(n_comp):
+                # y = (x - mu_k) * P_k with P_k = inv(L_k).T gives ||y||^2 = (x - mu_k)' inv(Sigma_k) (x - mu_k)
+                L = np.linalg.cholesky(covars[k])
+                P = np.linalg.solve(L, np.eye(n_pts)).T
+                self.prec_chol[m, :, k*n_pts:(k+1)*n_pts] = P
+                self.mean_proj[m, k*n_pts:(k+1)*n_pts] = np.dot(means[k], P)
+                self.log_norm[m, k] = np.log(weights[k]) - 0.5*n_pts*np.log(2*np.pi) - np.sum(np.log(np.diag(L)))
+                self.comp_cols[m, k] = unit_cols.get(tuple(params['units'][k]), -1)
+
+    def _channel_blocks(self, counts):
+        '''
+        Split channel groups (ordered by increasing spike count) into blocks small enough that 
+        padding every channel in a block to the block's largest spike count at most doubles the work
+        '''
+        blocks = []
+        block = []
+        n_block = 0
+        for g in np.argsort(counts, kind='mergesort'):
+            c = counts[g]
+            if len(block) > 0 and (len(block) + 1) * c > 2 * (n_block + c) + 256:
+                blocks.append(block)
+                block = []
+                n_block = 0
+            block.append(g)
+            n_block += c
+        if len(block) > 0:
+            blocks.append(block)
+        return [np.array(block) for block in blocks]
+
+    def log_prob(self, chans, waveforms):
+        '''
+        Weighted log-likelihood of each spike under each component of its channel's model
+
+        Parameters
+        ----------
+        chans : np.ndarray of shape (n_spikes,)
+            Channel of each spike
+        waveforms : np.ndarray of shape (n_spikes, D)
+            Waveform of each spike
+
+        Returns
+        -------
+        model_inds : np.ndarray of shape (n_spikes,)
+            Index of the model of each spike's channel, or -1 if the channel has no model
+        log_prob : np.ndarray of shape (n_spikes, max_components)
+            -inf for padded components. Rows of spikes without a model are undefined
+        '''
+        chans = np.asarray(chans, dtype=np.intp)
+        waveforms = np.asarray(waveforms, dtype=np.float64)
+        n_spikes = len(chans)
+        n_pts = self.n_pts
+
+        model_inds = -np.ones(n_spikes, dtype=np.intp)
+        in_lut = (chans >= 0) & (chans < len(self.chan_lut))
+        model_inds[in_lut] = self.chan_lut[chans[in_lut]]
+        log_prob = np.zeros((n_spikes, self.max_components))
+
+        # group the spikes by channel
+        spike_inds, = np.nonzero(model_inds >= 0)
+        if len(spike_inds) == 0:
+            return model_inds, log_prob
+        order = spike_inds[np.argsort(model_inds[spike_inds], kind='mergesort')]
+        models, starts, counts = np.unique(model_inds[order], return_index=True, return_counts=True)
+
+        for block in self._channel_blocks(counts):
+            # (channels, spikes, D) array of the waveforms on each channel, zero-padded to the same number of spikes
+            block_counts = counts[block]
+            group = np.repeat(np.arange(len(block)), block_counts)
+            block_offsets = np.cumsum(block_counts) - block_counts
+            rank = np.arange(len(group)) - np.repeat(block_offsets, block_counts)
+            block_spikes = order[np.repeat(starts[block], block_counts) + rank]
+
+            x = np.zeros((len(block), np.max(block_counts), n_pts))
+            x[group, rank] = waveforms[block_spikes]
+
+            block_models = models[block]
+            y = np.matmul(x, self.prec_chol[block_models]) - self.mean_proj[block_models][:, np.newaxis, :]
+            sq = np.sum(y.reshape(y.shape[0], y.shape[1], -1, n_pts)**2, axis=-1)
+            lp = self.log_norm[block_models][:, np.newaxis, :] - 0.5 * sq
+            log_prob[block_spikes] = lp[group, rank]
+
+        return model_inds, log_prob
+
+    def predict(self, chans, waveforms):
+        '''
+        Most likely component of each spike
+
+        Parameters
+        ----------
+        chans : np.ndarray of shape (n_spikes,)
+            Channel of each spike
+        waveforms : np.ndarray of shape (n_spikes, D)
+            Waveform of each spike
+
+        Returns
+        -------
+        np.ndarray of shape (n_spikes,)
+            Index of the component of the spike's channel with the largest posterior probability, or -1 if the channel has no model
+        '''
+        model_inds, log_prob = self.log_prob(chans, waveforms)
+        labels = np.argmax(log_prob, axis=1)
+        labels[model_inds < 0] = -1
+        return labels
+
+    def predict_proba(self, chans, waveforms):
+        '''
+        Posterior probability of each component of the spike's channel, for each spike
+
+        Parameters
+        ----------
+        chans : np.ndarray of shape (n_spikes,)
+            Channel of each spike
+        waveforms : np.ndarray of shape (n_spikes, D)
+            Waveform of each spike
+
+        Returns
+        -------
+        model_inds : np.ndarray of shape (n_spikes,)
+            Index of the model of each spike's channel, or -1 if the channel has no model
+        prob : np.ndarray of shape (n_spikes, max_components)
+            Posterior probabilities. Zero for padded components and for spikes without a model
+        '''
+        model_inds, log_prob = self.log_prob(chans, waveforms)
+        log_prob -= np.max(log_prob, axis=1)[:, np.newaxis]
+        prob = np.exp(log_prob)
+        prob /= np.sum(prob, axis=1)[:, np.newaxis]
+        prob[model_inds < 0] = 0
+        return model_inds, prob
+
+    def cluster_counts(self, chans, waveforms, subbin_inds=None, n_subbins=1):
+        '''
+        Sum of the posterior probabilities of each unit over the spikes in each subbin
+
+        Parameters
+        ----------
+        chans : np.ndarray of shape (n_spikes,)
+            Channel of each spike
+        waveforms : np.ndarray of shape (n_spikes, D)
+            Waveform of each spike
+        subbin_inds : np.ndarray of shape (n_spikes,), optional, default=None
+            0-based subbin of each spike. Spikes outside [0, n_subbins) are ignored. If None, all spikes are in one bin
+        n_subbins : int, optional, default=1
+            Number of subbins
+
+        Returns
+        -------
+        np.ndarray of shape (n_units, n_subbins)
+        '''
+        if subbin_inds is None:
+            subbin_inds = np.zeros(len(chans), dtype=np.intp)
+
+        model_inds, prob = self.predict_proba(chans, waveforms)
+        cols = self.comp_cols[model_inds]
+        keep = (cols >= 0) & (model_inds >= 0)[:, np.newaxis] & ((subbin_inds >= 0) & (subbin_inds < n_subbins))[:, np.newaxis]
+        flat_inds = subbin_inds[:, np.newaxis] * self.n_units + cols
+
+        counts = np.bincount(flat_inds[keep], weights=prob[keep], minlength=self.n_units*n_subbins)
+        return counts.reshape(n_subbins, self.n_units).T
+
+def gmm_to_model_params(gmm, units):
+    '''
+    Convert a fitted sklearn Gaussian mixture (GaussianMixture, or the older GMM) with 'full' or 'diag' 
+    covariances into the per-channel parameter format used by GMMWaveformClassifier
+
+    Parameters
+    ----------
+    gmm : fitted sklearn.mixture model
+    units : np.ndarray of shape (K, 2)
+        (channel, unit) represented by each mixture component
+
+    Returns
+    -------
+    dict
+    '''
+    if hasattr(gmm, 'covariances_'):
+        covars = gmm.covariances_
+    else:
+        covars = gmm.covars_
+    return dict(weights=np.array(gmm.weights_), means=np.array(gmm.means_), covars=np.array(covars), units=np.array(units))
+
+
 class WaveformClusterCountExtractor(FeatureExtractor):
+    '''
+    Counts spikes of each unit by classifying the spike waveforms online against a Gaussian mixture model 
+    of the waveforms on each channel (rather than using the sorting of the recording system). Each spike 
+    contributes its posterior probability of belonging to each unit, as in the features used for training.
+    '''
     feature_type = 'cluster_counts'
     def __init__(self, source, gmm_model_params, n_subbins=1, units=[]):
+        '''
+        Constructor for WaveformClusterCountExtractor
+
+        Parameters
+        ----------
+        source : DataSource instance
+            Source whose 'get' method returns the batch of spikes received since the last call, 
+            with fields 'chan', 'arrival_ts', 'ts' and 'waveform' (e.g., riglib.plexon.SpikeWaveforms)
+        gmm_model_params : dict
+            Per-channel mixture model parameters, see GMMWaveformClassifier
+        n_subbins : int, optional, default=1
+            Number of bins into which to divide the observed counts
+        units : np.ndarray of shape (N, 2), optional, default=[]
+            Units whose counts make up the feature vector. Each row corresponds to (channel, unit)
+
+        Returns
+        -------
+        WaveformClusterCountExtractor instance
+        '''
         self.feature_dtype = [('cluster_counts', 'f8', (len(units), n_subbins)), ('bin_edges', 'f8', 2)]
 
         self.source = source
@@ -1104,11 +1698,12 @@ class WaveformClusterCountExtractor(FeatureExtractor):
         extractor_kwargs['gmm_model_params'] = gmm_model_params
         self.extractor_kwargs = extractor_kwargs
 
+        self.classifier = GMMWaveformClassifier(gmm_model_params, units)
         self.last_get_spike_counts_time = 0        
 
     def get_spike_data(self):
         '''
-        Get the spike timestamps from the neural data source. This function has no type checking, 
+        Get the spike timestamps and waveforms from the neural data source. This function has no type checking, 
         i.e., it is assumed that the Extractor object was created with the proper source
         '''
         return self.source.get()
@@ -1124,9 +1719,23 @@ class WaveformClusterCountExtractor(FeatureExtractor):
             min_ind = np.argmin(ts['ts'])
             max_ind = np.argmax(ts['ts'])
             bin_edges = np.array([ts[min_ind]['ts'], ts[max_ind]['ts']])
+        return bin_edges
 
     def __call__(self, start_time, *args, **kwargs):
+        '''
+        Classify the batch of spikes which arrived since the last call and sum up the unit probabilities
 
+        Parameters
+        ----------
+        start_time : float 
+            Absolute time from the task event loop. This is used only to subdivide 
+            the spikes into multiple bins, if desired (if the 'n_subbins' attribute is > 1)
+
+        Returns
+        -------
+        dict
+            Extracted features to be saved in the task. 
+        '''
         spike_data = self.get_spike_data()
         if len(spike_data) == 0:
             counts = np.zeros([len(self.units), self.n_subbins])
@@ -1135,33 +1744,24 @@ class WaveformClusterCountExtractor(FeatureExtractor):
 
             # Decrease the first subbin index to include any spikes that were
             # delayed in getting to the task layer due to threading issues
-            # An acceptable delay is 1 sec or less. Realistically, most delays should be
-            # on the millisecond order
-            # subbin_edges[0] -= 1
-            # subbin_inds = np.digitize(spike_data['arrival_ts'], subbin_edges)
-            # counts = np.vstack([bin_spikes(ts[subbin_inds == k], self.units) for k in range(1, self.n_subbins+1)]).T
-            raise NotImplementedError
+            # (see BinnedSpikeCountsExtractor.__call__)
+            subbin_edges[0] -= 1
+            subbin_inds = np.digitize(spike_data['arrival_ts'], subbin_edges) - 1
+            counts = self.classifier.cluster_counts(spike_data['chan'], spike_data['waveform'], subbin_inds, self.n_subbins)
         else:
-            # TODO pull the waveforms
-            waveforms = []
-
-            # TODO determine p(class) for each waveform against the model params
-            counts = np.zeros(self.n_units)
-            wf_class_probs = []
-            for wf in waveforms:
-                raise NotImplementedError
-            
-            # counts = bin_spikes(ts, self.units).reshape(-1, 1)
+            counts = self.classifier.cluster_counts(spike_data['chan'], spike_data['waveform'])
 
-        counts = np.array(counts, dtype=np.uint32)
-        bin_edges = self.get_bin_edges(ts)
+        bin_edges = self.get_bin_edges(spike_data)
         self.last_get_spike_counts_time = start_time
 
-        return dict(spike_counts=counts, bin_edges=bin_edges)        
+        return dict(cluster_counts=counts, bin_edges=bin_edges)        
 
     @classmethod
     def extract_from_file(cls, files, neurows, binlen, units, extractor_kwargs, strobe_rate=60.0):        
-        from sklearn.mixture import GMM
+        try:
+            from sklearn.mixture import GaussianMixture as GMM
+        except ImportError:
+            from sklearn.mixture import GMM
         if 'plexon' in files:
             from plexon import plexfile
             plx = plexfile.openFile(str(files['plexon']))        
@@ -1170,9 +1770,14 @@ class WaveformClusterCountExtractor(FeatureExtractor):
             channels = np.unique(channels)
             np.sort(channels)
 
-            spike_chans = plx.spikes[:].data['chan']
-            spike_times = plx.spikes[:].data['ts']
-            waveforms = plx.spikes[:].waveforms
+            spikes = plx.spikes[:]
+            spike_chans = spikes.data['chan']
+            spike_times = spikes.data['ts']
+
+            # plexfile divides the waveforms by the channel gain, but the waveforms 
+            # streamed online are in raw A/D units, so undo the scaling
+            gains = np.array(plx.gain, dtype=np.float64)
+            waveforms = spikes.waveforms * gains[spike_chans - 1][:, np.newaxis]
 
             # construct the feature matrix (n_timepoints, n_units)
             # interpolate between the rows to 180 Hz
@@ -1186,35 +1791,31 @@ class WaveformClusterCountExtractor(FeatureExtractor):
                 step = int(binlen/(1./strobe_rate)) # Downsample kinematic data according to decoder bin length (assumes non-overlapping bins)
                 interp_rows = neurows[::step]
 
-            # digitize the spike timestamps into interp_rows
-            spike_bin_ind = np.digitize(spike_times, interp_rows)
-            spike_counts = np.zeros(len(interp_rows), n_units)
+            # assign each spike to the bin (t - binlen, t] of each row time t, as psth.SpikeBin does
+            spike_bin_ind = np.searchsorted(interp_rows, spike_times, side='left')
+            in_bin = spike_bin_ind < len(interp_rows)
+            in_bin[in_bin] = spike_times[in_bin] > interp_rows[spike_bin_ind[in_bin]] - binlen
+            spike_bin_ind[~in_bin] = -1
 
+            # cluster the waveforms on each channel using a GMM
+            # TODO pick the number of components in an unsupervised way!
+            gmm_model_params = dict()
             for ch in channels:
-                ch_waveforms = waveforms[spike_chans == ch]
-
-                # cluster the waveforms using a GMM
-                # TODO pick the number of components in an unsupervised way!
-                n_components = len(np.nonzero(units[:,0] == ch)[0])
-                gmm = GMM(n_components=n_components)
-                gmm.fit(ch_waveforms)
-
-                # store the cluster probabilities back in the same order that the waveforms were extracted
-                wf_probs = gmm.predict_proba(ch_waveforms)
-
-                ch_spike_bin_inds = spike_bin_ind[spike_chans == ch]
-                ch_inds, = np.nonzero(units[:,0] == ch)
-
-                # TODO don't assume the units are sorted!
-                for bin_ind, wf_prob in izip(ch_spike_bin_inds, wf_probs):
-                    spike_counts[bin_ind, ch_inds] += wf_prob
+                ch_units = units[units[:,0] == ch]
+                gmm = GMM(n_components=len(ch_units), covariance_type='diag')
+                gmm.fit(waveforms[spike_chans == ch])
+                gmm_model_params[ch] = gmm_to_model_params(gmm, ch_units)
 
+            # sum the cluster probabilities in each bin with the same classifier used online
+            classifier = GMMWaveformClassifier(gmm_model_params, units)
+            spike_counts = classifier.cluster_counts(spike_chans, waveforms, spike_bin_ind, len(interp_rows)).T
 
             # discard units that never fired at all
             unit_inds, = np.nonzero(np.sum(spike_counts, axis=0))
             units = units[unit_inds,:]
             spike_counts = spike_counts[:, unit_inds]
             extractor_kwargs['units'] = units
+            extractor_kwargs['gmm_model_params'] = gmm_model_params
 
             return spike_counts, units, extractor_kwargs
         else:
@@ -1222,11 +1823,198 @@ class WaveformClusterCountExtractor(FeatureExtractor):
 
 
 
-def get_butter_bpf_lfp_power(plx, neurows, binlen, units, extractor_kwargs, strobe_rate=60.0):
+def _sliding_windows(x, n_pts):
     '''
-    Compute lfp power features -- corresponds to LFPButterBPFPowerExtractor.
+    Strided (no-copy) view of every length-n_pts window along the last axis of a 2D array
+
+    Parameters
+    ----------
+    x : np.ndarray of shape (n_rows, n_samples)
+    n_pts : int
+        Window length
+
+    Returns
+    -------
+    np.ndarray of shape (n_rows, n_samples - n_pts + 1, n_pts)
+        Element [i, k, :] is x[i, k:k+n_pts]
+    '''
+    x = np.ascontiguousarray(x)
+    n_rows, n_samples = x.shape
+    return as_strided(x, shape=(n_rows, n_samples - n_pts + 1, n_pts), strides=(x.strides[0], x.strides[1], x.strides[1]))
+
+def _butter_bpf_power_chunk(args):
+    '''
+    Butterworth band power of a block of channels at a set of window end samples. 
+    Module-level so that it can be run in a process pool. 
+
+    Returns an array of shape (n_windows, n_bands, n_channels). Windows which do not fit 
+    inside the record are left at 0.
+    '''
+    lfp, window_ends, n_pts, filt_coeffs, filt_sos, streaming, epsilon, window_chunk = args
+    x = np.ascontiguousarray(lfp.T, dtype=np.float64)
+    n_chan, n_samples = x.shape
+    n_bands = len(filt_coeffs)
+    power = np.zeros((len(window_ends), n_bands, n_chan))
+
+    if streaming:
+        # filter each channel once over the whole record, carrying state across windows as 
+        # the streaming extractor does, and take windowed sums of squares from a cumulative sum
+        valid, = np.nonzero((window_ends > 0) & (window_ends <= n_samples))
+        ends = window_ends[valid]
+        starts = np.maximum(ends - n_pts, 0)
+        for i in range(n_bands):
+            y = sosfilt(filt_sos[i], x, axis=-1)
+            csum = np.zeros((n_chan, n_samples + 1))
+            np.cumsum(y**2, axis=-1, out=csum[:, 1:])
+            sq_sum = csum[:, ends] - csum[:, starts]
+            power[valid, i, :] = np.log((1. / n_pts) * sq_sum.T + epsilon)
+    else:
+        # filter every window from zero initial state, as the windowed extractor does, 
+        # with one lfilter call over a stacked (channels, windows, n_pts) tensor per block of windows
+        valid, = np.nonzero((window_ends >= n_pts) & (window_ends <= n_samples))
+        if len(valid) == 0:
+            return power
+        windows = _sliding_windows(x, n_pts)
+        for k in range(0, len(valid), window_chunk):
+            inds = valid[k:k+window_chunk]
+            cont_samples = windows[:, window_ends[inds] - n_pts, :]
+            for i in range(n_bands):
+                b, a = filt_coeffs[i]
+                y = lfilter(b, a, cont_samples, axis=-1)
+                power[inds, i, :] = np.log((1. / n_pts) * np.sum(y**2, axis=-1) + epsilon).T
+
+    return power
+
+def _mtm_power_chunk(args):
+    '''
+    Multi-taper band power (or PSD) of a block of channels at a set of window end samples, using 
+    the batched MTMPowerEngine over a stacked (windows, channels, n_pts) tensor. Module-level so 
+    that it can be run in a process pool. 
+
+    Returns an array of shape (n_windows, n_features, n_channels), where the features are the 
+    bands (or the FFT frequencies if 'no_mean'). Windows which do not fit inside the record are left at 0.
+    '''
+    lfp, window_ends, mtm, no_log, no_mean, window_chunk = args
+    x = np.ascontiguousarray(lfp.T, dtype=np.float64)
+    n_chan, n_samples = x.shape
+    n_pts = mtm.n_pts
+    n_feats = mtm.n_freqs if no_mean else mtm.band_weights.shape[1]
+    power = np.zeros((len(window_ends), n_feats, n_chan))
+
+    valid, = np.nonzero((window_ends >= n_pts) & (window_ends <= n_samples))
+    if len(valid) == 0:
+        return power
+    windows = _sliding_windows(x, n_pts)
+    for k in range(0, len(valid), window_chunk):
+        inds = valid[k:k+window_chunk]
+        cont_samples = windows[:, window_ends[inds] - n_pts, :].transpose(1, 0, 2)
+        psd_est = mtm.psd(cont_samples)
+        if no_mean:
+            power[inds] = psd_est.transpose(0, 2, 1)
+        else:
+            power[inds] = mtm.band_power(psd_est, log=not no_log).transpose(0, 2, 1)
+
+    return power
+
+def _power_over_channel_chunks(cont, channels, chunk_fn, chunk_args, chan_chunk_size, n_workers):
+    '''
+    Read a continuous-data file object (e.g., plx.lfp) a block of channels at a time and apply 
+    'chunk_fn' to each block. With n_workers > 1, up to n_workers blocks at a time are processed 
+    in a local process pool, so at most n_workers blocks of raw data are in memory at once.
+
+    Returns the per-block outputs of 'chunk_fn' concatenated along the last (channel) axis
+    '''
+    channels = np.asarray(channels)
+    chan_blocks = [channels[k:k+chan_chunk_size] for k in range(0, len(channels), chan_chunk_size)]
+    pool = mp.Pool(n_workers) if n_workers > 1 else None
+    results = []
+    try:
+        for k in range(0, len(chan_blocks), max(n_workers, 1)):
+            jobs = [(cont[:, list(chans - 1)].data,) + chunk_args for chans in chan_blocks[k:k+max(n_workers, 1)]]
+            if pool is None:
+                results += map(chunk_fn, jobs)
+            else:
+                results += pool.map(chunk_fn, jobs)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return np.concatenate(results, axis=-1)
+
+def compute_butter_bpf_power(cont, f_extractor, interp_rows, chan_chunk_size=16, n_workers=1, window_chunk=1000):
+    '''
+    Compute LFPButterBPFPowerExtractor features over a whole recording, vectorized over the training bins
+
+    Parameters
+    ----------
+    cont : continuous-data file object, e.g., plx.lfp
+        Must support cont[:, chans].data to read the (n_samples, len(chans)) record of the 0-based channel indices 'chans'
+    f_extractor : LFPButterBPFPowerExtractor instance
+        Extractor defining the channels, bands, window length and filters
+    interp_rows : np.ndarray of shape (T,)
+        Times (in the recording time reference) at which each training window ends
+    chan_chunk_size : int, optional, default=16
+        Number of channels read from the file and processed at once
+    n_workers : int, optional, default=1
+        Number of local processes across which to spread the channel blocks
+    window_chunk : int, optional, default=1000
+        Number of windows stacked into one tensor (non-streaming extractors only)
+
+    Returns
+    -------
+    np.ndarray of shape (T, n_channels * n_bands)
+        Same layout as the output of the extractor on each window
+    '''
+    window_ends = (np.asarray(interp_rows) * f_extractor.fs).astype(int)
+    filt_coeffs = [f_extractor.filt_coeffs[band] for band in f_extractor.bands]
+    filt_sos = [f_extractor.filt_sos[band] for band in f_extractor.bands]
+    chunk_args = (window_ends, f_extractor.n_pts, filt_coeffs, filt_sos, f_extractor.streaming, f_extractor.epsilon, window_chunk)
+
+    power = _power_over_channel_chunks(cont, f_extractor.channels, _butter_bpf_power_chunk, chunk_args, chan_chunk_size, n_workers)
+    return power.reshape(len(window_ends), -1)
 
+def compute_mtm_power(cont, f_extractor, interp_rows, chan_chunk_size=16, n_workers=1, window_chunk=500):
+    '''
+    Compute LFPMTMPowerExtractor (or AIMTMPowerExtractor) features over a whole recording, 
+    using the batched multi-taper engine over stacked windows of the training bins
+
+    Parameters
+    ----------
+    cont : continuous-data file object, e.g., plx.lfp
+        Must support cont[:, chans].data to read the (n_samples, len(chans)) record of the 0-based channel indices 'chans'
+    f_extractor : LFPMTMPowerExtractor instance
+        Extractor defining the channels, bands, window length and tapers
+    interp_rows : np.ndarray of shape (T,)
+        Times (in the recording time reference) at which each training window ends
+    chan_chunk_size : int, optional, default=16
+        Number of channels read from the file and processed at once
+    n_workers : int, optional, default=1
+        Number of local processes across which to spread the channel blocks
+    window_chunk : int, optional, default=500
+        Number of windows stacked into one tensor for the multi-taper engine
+
+    Returns
+    -------
+    np.ndarray of shape (T, n_features)
+        Same layout as the output of the extractor on each window
+    '''
+    window_ends = (np.asarray(interp_rows) * f_extractor.fs).astype(int)
+    no_log = f_extractor.extractor_kwargs['no_log']
+    no_mean = f_extractor.extractor_kwargs['no_mean']
+    chunk_args = (window_ends, f_extractor.mtm, no_log, no_mean, window_chunk)
+
+    power = _power_over_channel_chunks(cont, f_extractor.channels, _mtm_power_chunk, chunk_args, chan_chunk_size, n_workers)
+    if no_mean:
+        # PSD features are ordered by channel, then by frequency
+        power = power.transpose(0, 2, 1)
+    return power.reshape(len(window_ends), -1)
+
+def get_butter_bpf_lfp_power(plx, neurows, binlen, units, extractor_kwargs, strobe_rate=60.0, chan_chunk_size=16, n_workers=1):
+    '''
+    Compute lfp power features -- corresponds to LFPButterBPFPowerExtractor.
 
+    Channels are read from the file and filtered 'chan_chunk_size' at a time, optionally 
+    across 'n_workers' local processes. See compute_butter_bpf_power
     '''
     
     # interpolate between the rows to 180 Hz
@@ -1242,26 +2030,11 @@ def get_butter_bpf_lfp_power(plx, neurows, binlen, units, extractor_kwargs, stro
 
 
     # create extractor object
-    f_extractor = extractor.LFPButterBPFPowerExtractor(None, **extractor_kwargs)
+    f_extractor = LFPButterBPFPowerExtractor(None, **extractor_kwargs)
     extractor_kwargs = f_extractor.extractor_kwargs
 
-    win_len  = f_extractor.win_len
-    bands    = f_extractor.bands
-    channels = f_extractor.channels
-    fs       = f_extractor.fs
-        
-    n_itrs = len(interp_rows)
-    n_chan = len(channels)
-    lfp_power = np.zeros((n_itrs, n_chan * len(bands)))
-    # for i, t in enumerate(interp_rows):
-    #     cont_samples = plx.lfp[t-win_len:t].data[:, channels-1]
-    #     lfp_power[i, :] = f_extractor.extract_features(cont_samples.T).T
-    lfp = plx.lfp[:].data[:, channels-1]
-    n_pts = int(win_len * fs)
-    for i, t in enumerate(interp_rows):
-        sample_num = int(t * fs)
-        cont_samples = lfp[sample_num-n_pts:sample_num, :]
-        lfp_power[i, :] = f_extractor.extract_features(cont_samples.T).T
+    lfp_power = compute_butter_bpf_power(plx.lfp, f_extractor, interp_rows, 
+        chan_chunk_size=chan_chunk_size, n_workers=n_workers)
     
     # TODO -- discard any channel(s) for which the log power in any frequency 
     #   bands was ever equal to -inf (i.e., power was equal to 0)
@@ -1272,11 +2045,12 @@ def get_butter_bpf_lfp_power(plx, neurows, binlen, units, extractor_kwargs, stro
     return lfp_power, units, extractor_kwargs
 
 
-def get_mtm_lfp_power(plx, neurows, binlen, units, extractor_kwargs, strobe_rate=60.0):
+def get_mtm_lfp_power(plx, neurows, binlen, units, extractor_kwargs, strobe_rate=60.0, chan_chunk_size=16, n_workers=1):
     '''
     Compute lfp power features -- corresponds to LFPMTMPowerExtractor.
 
-
+    Channels are read from the file 'chan_chunk_size' at a time, optionally across 
+    'n_workers' local processes. See compute_mtm_power
     '''
     
     # interpolate between the rows to 180 Hz
@@ -1292,28 +2066,13 @@ def get_mtm_lfp_power(plx, neurows, binlen, units, extractor_kwargs, strobe_rate
 
 
     # create extractor object
-    f_extractor = extractor.LFPMTMPowerExtractor(None, **extractor_kwargs)
+    f_extractor = LFPMTMPowerExtractor(None, **extractor_kwargs)
     extractor_kwargs = f_extractor.extractor_kwargs
 
-    win_len  = f_extractor.win_len
-    bands    = f_extractor.bands
-    channels = f_extractor.channels
-    fs       = f_extractor.fs
-    print 'bands:', bands
+    print 'bands:', f_extractor.bands
 
-    n_itrs = len(interp_rows)
-    n_chan = len(channels)
-    lfp_power = np.zeros((n_itrs, n_chan * len(bands)))
-    
-    # for i, t in enumerate(interp_rows):
-    #     cont_samples = plx.lfp[t-win_len:t].data[:, channels-1]
-    #     lfp_power[i, :] = f_extractor.extract_features(cont_samples.T).T
-    lfp = plx.lfp[:].data[:, channels-1]
-    n_pts = int(win_len * fs)
-    for i, t in enumerate(interp_rows):
-        sample_num = int(t * fs)
-        cont_samples = lfp[sample_num-n_pts:sample_num, :]
-        lfp_power[i, :] = f_extractor.extract_features(cont_samples.T).T
+    lfp_power = compute_mtm_power(plx.lfp, f_extractor, interp_rows, 
+        chan_chunk_size=chan_chunk_size, n_workers=n_workers)
 
 
     # TODO -- discard any channel(s) for which the log power in any frequency 
@@ -0,0 +1,263 @@
+'''
+Content-addressed disk cache for offline feature extraction. Decoders are often re-trained
+from the same block with different state spaces, regularizers or kinematic extractors, and
+the neural feature extraction (parsing the .plx/.nev file, binning spikes, computing LFP power)
+dominates the training time. Results are keyed by the identity of the data files and the
+feature extraction parameters and stored as .npy files which are memory-mapped when loaded.
+'''
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import cPickle
+import numpy as np
+
+
+def _canonical(obj):
+    '''
+    Convert an object to a nested structure of builtin types with a deterministic repr,
+    for hashing. Dict keys are sorted and numpy arrays are reduced to (dtype, shape, digest).
+    '''
+    if isinstance(obj, dict):
+        return tuple((repr(k), _canonical(obj[k])) for k in sorted(obj.keys(), key=repr))
+    elif isinstance(obj, (list, tuple)):
+        return tuple(_canonical(x) for x in obj)
+    elif isinstance(obj, np.ndarray):
+        arr = np.ascontiguousarray(obj)
+        return ('ndarray', str(arr.dtype), arr.shape, hashlib.sha1(arr.tostring()).hexdigest())
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    elif isinstance(obj, type):
+        return '%s.%s' % (obj.__module__, obj.__name__)
+    elif hasattr(obj, '__module__') and hasattr(obj, '__name__'): # functions, methods
+        im_class = getattr(obj, 'im_self', None)
+        if im_class is not None:
+            return '%s.%s' % (_canonical(im_class), obj.__name__)
+        return '%s.%s' % (obj.__module__, obj.__name__)
+    elif isinstance(obj, float):
+        return repr(obj)
+    else:
+        return obj
+
+
+def file_identity(files):
+    '''
+    Identify the data files used for training by name, size and modification time, so that
+    a cache entry is invalidated if a file is re-written.
+
+    Parameters
+    ----------
+    files : dict
+        Keys are file types (e.g., 'hdf', 'plexon', 'blackrock'), values are a file name or a list of file names
+
+    Returns
+    -------
+    tuple
+    '''
+    ident = []
+    for system in sorted(files.keys()):
+        fnames = files[system]
+        if isinstance(fnames, (str, unicode)):
+            fnames = [fnames]
+        for fname in sorted(fnames):
+            fname = str(fname)
+            try:
+                st = os.stat(fname)
+                ident.append((system, os.path.abspath(fname), st.st_size, st.st_mtime))
+            except OSError:
+                ident.append((system, os.path.abspath(fname), None, None))
+    return tuple(ident)
+
+
+class FeatureCache(object):
+    '''
+    Size-bounded, least-recently-used disk cache of feature extraction results. Each entry is a
+    directory named by the hash of its key; numpy arrays in the result are saved as .npy files
+    and loaded copy-on-write memory-mapped, everything else is pickled.
+    '''
+    def __init__(self, cache_dir, max_size_mb=4096):
+        '''
+        Constructor for FeatureCache
+
+        Parameters
+        ----------
+        cache_dir : string
+            Directory in which to store the cache entries. Created if it does not exist
+        max_size_mb : float, optional, default=4096
+            Least-recently-used entries are removed once the cache grows larger than this
+
+        Returns
+        -------
+        FeatureCache instance
+        '''
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        if not os.path.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # another process may have created it
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    @classmethod
+    def default(cls):
+        '''
+        Cache configured by the optional [feature_cache] section of the config file (keys 'path' and
+        'max_size_mb'). Defaults to a directory in the system temporary directory.
+        '''
+        settings = dict()
+        try:
+            from config import config
+            settings = config.feature_cache
+        except Exception:
+            pass
+        cache_dir = settings.get('path', os.path.join(tempfile.gettempdir(), 'bmi3d_feature_cache'))
+        max_size_mb = float(settings.get('max_size_mb', 4096))
+        return cls(cache_dir, max_size_mb=max_size_mb)
+
+    @staticmethod
+    def make_key(*key_parts):
+        '''
+        Hash the key parts into the name of a cache entry
+        '''
+        return hashlib.sha1(repr(_canonical(key_parts))).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, key):
+        '''
+        Load a cache entry
+
+        Parameters
+        ----------
+        key : string
+            Name of the entry, from 'make_key'
+
+        Returns
+        -------
+        tuple or None
+            The cached result, or None if there is no entry for the key
+        '''
+        entry_dir = self._entry_dir(key)
+        index_fname = os.path.join(entry_dir, 'index.pkl')
+        if not os.path.exists(index_fname):
+            return None
+
+        try:
+            index = cPickle.load(open(index_fname, 'rb'))
+            result = []
+            for k, (kind, value) in enumerate(index):
+                if kind == 'ndarray':
+                    result.append(np.load(os.path.join(entry_dir, '%d.npy' % k), mmap_mode='c'))
+                else:
+                    result.append(value)
+        except Exception as e:
+            print "FeatureCache: unable to load entry %s, recomputing" % key
+            print e
+            return None
+
+        # mark the entry as recently used
+        os.utime(entry_dir, None)
+        return tuple(result)
+
+    def save(self, key, result):
+        '''
+        Store a result in the cache and evict the least-recently-used entries if the cache is over size
+
+        Parameters
+        ----------
+        key : string
+            Name of the entry, from 'make_key'
+        result : tuple
+            Values to store. Numpy arrays (of non-object dtype) are saved as .npy files
+
+        Returns
+        -------
+        None
+        '''
+        # write into a temporary directory and rename it into place, so readers never see a partial entry
+        tmp_dir = tempfile.mkdtemp(prefix='.tmp_', dir=self.cache_dir)
+        try:
+            index = []
+            for k, value in enumerate(result):
+                if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+                    np.save(os.path.join(tmp_dir, '%d.npy' % k), value)
+                    index.append(('ndarray', None))
+                else:
+                    index.append(('pickle', value))
+            cPickle.dump(index, open(os.path.join(tmp_dir, 'index.pkl'), 'wb'), 2)
+            os.rename(tmp_dir, self._entry_dir(key))
+        except OSError:
+            # an entry for the same key was written concurrently
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        except:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        self.evict()
+
+    def get(self, key_parts, fn, *args, **kwargs):
+        '''
+        Return the cached result of fn(*args, **kwargs) for the given key, computing and storing it if necessary
+
+        Parameters
+        ----------
+        key_parts : tuple
+            Everything that determines the result of 'fn', e.g., file identities and extractor parameters
+        fn : callable
+            Function to compute the result. Must return a tuple
+        *args, **kwargs : optional positional/keyword arguments
+            Passed to fn
+
+        Returns
+        -------
+        tuple
+        '''
+        key = self.make_key(*key_parts)
+        result = self.load(key)
+        if result is None:
+            result = tuple(fn(*args, **kwargs))
+            self.save(key, result)
+        return result
+
+    def entries(self):
+        '''
+        List the cache entries, most recently used first
+
+        Returns
+        -------
+        list of (key, last_used_time, size_in_bytes) tuples
+        '''
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry_dir = self._entry_dir(key)
+            if key.startswith('.') or not os.path.isdir(entry_dir):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry_dir, fname)) for fname in os.listdir(entry_dir))
+                entries.append((key, os.path.getmtime(entry_dir), size))
+            except OSError:
+                # removed by another process
+                pass
+        entries.sort(key=lambda x: x[1], reverse=True)
+        return entries
+
+    def evict(self):
+        '''
+        Remove least-recently-used entries until the cache is no larger than its maximum size
+        '''
+        total = 0
+        for key, last_used, size in self.entries():
+            total += size
+            if total > self.max_size:
+                shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+    def clear(self):
+        '''
+        Remove all the cache entries
+        '''
+        for key, last_used, size in self.entries():
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
@@ -18,6 +18,31 @@ class FeedbackController(object):
     def calc_next_state(self, current_state, target_state, mode=None):
         raise NotImplementedError
 
+    def calc_next_state_batch(self, current_states, target_states, mode=None):
+        '''
+        Calculate the next state for each column of a trajectory. By default, calls 'calc_next_state' 
+        for each column; child classes can replace this with a vectorized calculation
+
+        Parameters
+        ----------
+        current_states : np.ndarray of shape (N, T)
+            States of the system, one column per time point
+        target_states : np.ndarray of shape (N, T)
+            Target state for each time point
+        mode : object, default=None
+            Operational mode of the feedback controller, common to all time points
+
+        Returns
+        -------
+        np.ndarray of shape (N, T)
+        '''
+        current_states = np.asarray(current_states)
+        target_states = np.asarray(target_states)
+        next_states = np.zeros(current_states.shape)
+        for k in range(current_states.shape[1]):
+            next_states[:,k] = np.asarray(self.calc_next_state(current_states[:,k], target_states[:,k], mode=mode)).ravel()
+        return next_states
+
     def __call__(self, current_state, target_state, mode=None):
         raise NotImplementedError
 
@@ -71,11 +96,45 @@ class LinearFeedbackController(FeedbackController):
         np.matrix
         '''
         # explicitly cast current_state and target_state to column vectors
-        current_state = np.mat(current_state).reshape(-1,1)
-        target_state = np.mat(target_state).reshape(-1,1)
-        ns = self.A * current_state + self.B * self.F * (target_state - current_state)
+        current_state = np.asarray(current_state).reshape(-1,1)
+        target_state = np.asarray(target_state).reshape(-1,1)
+        A_BF, BF = self._closed_loop_matrices()
+        ns = np.dot(A_BF, current_state) + np.dot(BF, target_state)
+
+        return np.asmatrix(ns)
+
+    def calc_next_state_batch(self, current_states, target_states, mode=None):
+        '''
+        Returns x_{t+1} = Ax_t + BF(x* - x_t) for each column of a trajectory
 
-        return ns
+        Parameters
+        ----------
+        current_states : np.ndarray of shape (N, T)
+            States of the system, one column per time point
+        target_states : np.ndarray of shape (N, T)
+            Target state for each time point
+        mode : object, default=None
+            Select the operational mode of the feedback controller. Ignored in this class
+
+        Returns
+        -------
+        np.ndarray of shape (N, T)
+        '''
+        A_BF, BF = self._closed_loop_matrices()
+        return np.dot(A_BF, np.asarray(current_states)) + np.dot(BF, np.asarray(target_states))
+
+    def _closed_loop_matrices(self):
+        '''
+        (A - B*F, B*F), cached until A, B or F is replaced
+        '''
+        cache = getattr(self, '_closed_loop', dict())
+        cached = cache.get(id(self.F), None)
+        if cached is None or cached[0] is not self.A or cached[1] is not self.B or cached[2] is not self.F:
+            BF = np.dot(np.asarray(self.B), np.asarray(self.F))
+            cached = (self.A, self.B, self.F, np.asarray(self.A) - BF, BF)
+            cache[id(self.F)] = cached
+            self._closed_loop = cache
+        return cached[3:]
 
     def __call__(self, current_state, target_state, mode=None):
         '''
@@ -223,14 +282,21 @@ class MultiModalLFC(LinearFeedbackController):
         See LinearFeedbackController.calc_next_state for docs
         '''
         self.F = self.F_dict[mode]
-        super(MultiModalLFC, self).calc_next_state(current_state, target_state, mode=mode)
+        return super(MultiModalLFC, self).calc_next_state(current_state, target_state, mode=mode)
+
+    def calc_next_state_batch(self, current_states, target_states, mode=None):
+        '''
+        See LinearFeedbackController.calc_next_state_batch for docs
+        '''
+        self.F = self.F_dict[mode]
+        return super(MultiModalLFC, self).calc_next_state_batch(current_states, target_states, mode=mode)
 
     def __call__(self, current_state, target_state, mode=None):
         '''
         See LinearFeedbackController.__call__ for docs
         '''        
         self.F = self.F_dict[mode]
-        super(MultiModalLFC, self).__call__(current_state, target_state, mode=mode)        
+        return super(MultiModalLFC, self).__call__(current_state, target_state, mode=mode)
 
 
 class PIDController(FeedbackController):
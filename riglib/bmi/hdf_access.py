@@ -0,0 +1,318 @@
+'''
+Access to the HDF files used for training decoders. The training functions only need a few
+columns of the 'task' table (e.g., 'cursor' or 'plant_pos'), so the columns are read on their
+own, and only over the rows that are used, instead of reading the whole table into memory.
+Open files are shared through a pool, so that the helper functions called during one training
+run use one handle per file and all the handles are closed when the run is done.
+'''
+import os
+import time
+import threading
+import contextlib
+import numpy as np
+import tables
+
+
+def _open_file(fname, mode='r'):
+    if hasattr(tables, 'open_file'): # function name depends on version
+        return tables.open_file(fname, mode=mode)
+    else:
+        return tables.openFile(fname, mode=mode)
+
+
+class HDFHandlePool(object):
+    '''
+    Reference-counted pool of read-only HDF file handles. A handle is closed when it is no longer
+    used, unless a session is active, in which case it stays open (and is shared by everyone
+    opening the same file) until the session ends.
+    '''
+    def __init__(self):
+        '''
+        Constructor for HDFHandlePool
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        HDFHandlePool instance
+        '''
+        self._handles = dict() # absolute file name -> [handle, reference count]
+        self._n_sessions = 0
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _key(fname):
+        return os.path.abspath(str(fname))
+
+    def acquire(self, fname):
+        '''
+        Get the open handle of a file, opening the file if necessary. Each call must be matched by a call to 'release'
+        '''
+        key = self._key(fname)
+        with self._lock:
+            entry = self._handles.get(key, None)
+            if entry is None or not entry[0].isopen:
+                entry = [_open_file(key, mode='r'), 0]
+                self._handles[key] = entry
+            entry[1] += 1
+            return entry[0]
+
+    def release(self, fname):
+        '''
+        Give back a handle obtained from 'acquire'
+        '''
+        key = self._key(fname)
+        with self._lock:
+            entry = self._handles.get(key, None)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] <= 0 and self._n_sessions == 0:
+                self._close(key)
+
+    def _close(self, key):
+        handle, refcount = self._handles.pop(key)
+        if handle.isopen:
+            handle.close()
+
+    @contextlib.contextmanager
+    def open(self, fname):
+        '''
+        Context manager giving the shared read-only handle of a file
+
+        Parameters
+        ----------
+        fname : string
+            HDF file name
+
+        Returns
+        -------
+        tables.File instance
+        '''
+        handle = self.acquire(fname)
+        try:
+            yield handle
+        finally:
+            self.release(fname)
+
+    @contextlib.contextmanager
+    def session(self):
+        '''
+        Context manager which keeps the files opened inside it open until it exits, so that
+        they are opened only once. Sessions can be nested
+        '''
+        with self._lock:
+            self._n_sessions += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._n_sessions -= 1
+                if self._n_sessions == 0:
+                    for key in [key for key, entry in self._handles.items() if entry[1] <= 0]:
+                        self._close(key)
+
+    @property
+    def open_files(self):
+        '''
+        Names of the files which currently have an open handle
+        '''
+        with self._lock:
+            return sorted(key for key, entry in self._handles.items() if entry[0].isopen)
+
+    def close_all(self):
+        '''
+        Close all the handles, including the ones which are still in use
+        '''
+        with self._lock:
+            for key in self._handles.keys():
+                self._close(key)
+
+
+pool = HDFHandlePool()
+
+def open_hdf(fname):
+    '''
+    Shared read-only handle of an HDF file, from the module-level pool. Use as a context manager
+    '''
+    return pool.open(fname)
+
+def session():
+    '''
+    Keep the files opened through open_hdf open until the returned context manager exits
+    '''
+    return pool.session()
+
+
+def read_column(table, name, start=None, stop=None):
+    '''
+    Read one column of a table, optionally over a range of rows only
+
+    Parameters
+    ----------
+    table : tables.Table instance
+        Table to read from, e.g., hdf.root.task
+    name : string
+        Column name
+    start, stop : int, optional
+        Range of rows to read. Defaults to all the rows. Rows past the end of the table are ignored
+
+    Returns
+    -------
+    np.ndarray of shape (n_rows,) + shape of the column
+    '''
+    return table.read(start=start, stop=stop, field=name)
+
+
+def read_column_rows(table, name, inds):
+    '''
+    Read the values of one column at the given rows. Only the range of rows spanned by 'inds' is read
+
+    Parameters
+    ----------
+    table : tables.Table instance
+        Table to read from
+    name : string
+        Column name
+    inds : np.ndarray of int
+        Rows to read. All must be less than table.nrows
+
+    Returns
+    -------
+    np.ndarray of shape (len(inds),) + shape of the column
+    '''
+    inds = np.asarray(inds, dtype=int)
+    if len(inds) == 0:
+        return read_column(table, name, start=0, stop=0)
+    start = inds.min()
+    if inds.max() >= table.nrows:
+        raise IndexError("Row %d is out of range for table of %d rows" % (inds.max(), table.nrows))
+    return read_column(table, name, start=start, stop=inds.max() + 1)[inds - start]
+
+
+################################################################################
+## Benchmark
+################################################################################
+def make_benchmark_file(fname, n_rows=216000, n_units=256):
+    '''
+    Write an HDF file with a 'task' table resembling the ones saved by BMI tasks, for the benchmark.
+    The default size corresponds to one hour of data at 60 Hz
+
+    Parameters
+    ----------
+    fname : string
+        Name of the file to write
+    n_rows : int, optional, default=216000
+        Number of rows of the table
+    n_units : int, optional, default=256
+        Number of units in the 'spike_counts' column
+
+    Returns
+    -------
+    fname : string
+    '''
+    dtype = np.dtype([('cursor', np.float64, (3,)), ('decoder_state', np.float64, (7,1)),
+        ('target', np.float64, (3,)), ('spike_counts', np.uint16, (n_units,1)),
+        ('loop_time', np.float64, (1,))])
+    h5file = _open_file(fname, mode='w')
+    try:
+        table = h5file.create_table('/', 'task', dtype) if hasattr(h5file, 'create_table') else h5file.createTable('/', 'task', dtype)
+        block = 10000
+        for k in range(0, n_rows, block):
+            data = np.zeros(min(block, n_rows - k), dtype=dtype)
+            data['cursor'] = np.random.randn(len(data), 3)
+            data['decoder_state'] = np.random.randn(len(data), 7, 1)
+            data['spike_counts'] = np.random.poisson(0.5, size=(len(data), n_units, 1))
+            table.append(data)
+    finally:
+        h5file.close()
+    return fname
+
+
+def _peak_rss_mb():
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _read_full_table(fname, columns, table_path):
+    # the previous approach: the whole table is read and the columns are taken from the record array
+    h5file = _open_file(fname)
+    try:
+        table = h5file.get_node(table_path) if hasattr(h5file, 'get_node') else h5file.getNode(table_path)
+        return [table[:][name] for name in columns]
+    finally:
+        h5file.close()
+
+
+def _read_columns(fname, columns, table_path):
+    with open_hdf(fname) as h5file:
+        table = h5file.get_node(table_path) if hasattr(h5file, 'get_node') else h5file.getNode(table_path)
+        return [read_column(table, name) for name in columns]
+
+
+def _benchmark_worker(method, fname, columns, table_path, queue):
+    baseline = _peak_rss_mb()
+    t_start = time.time()
+    data = method(fname, columns, table_path)
+    read_time = time.time() - t_start
+    queue.put((read_time, _peak_rss_mb(), baseline, sum(x.nbytes for x in data) / 1024.**2))
+
+
+def benchmark_column_reads(fname, columns=['cursor'], table_path='/task', n_repeats=3):
+    '''
+    Compare reading columns of an HDF table by reading the whole table (as the training functions
+    used to) with the column reads of this module. Each read runs in a fresh process so that the
+    peak resident memory of each method can be measured
+
+    Parameters
+    ----------
+    fname : string
+        HDF file name
+    columns : list of string, optional, default=['cursor']
+        Columns to read
+    table_path : string, optional, default='/task'
+        Table to read from
+    n_repeats : int, optional, default=3
+        Number of times to run each method. The fastest time and the largest memory are reported
+
+    Returns
+    -------
+    dict
+        For each method ('full_table' and 'columns'), a dict with the read time in seconds ('time'),
+        the peak resident memory of the process in MB ('peak_rss_mb'), the increase of the peak memory
+        caused by the read ('read_rss_mb') and the size of the data returned ('data_mb')
+    '''
+    import multiprocessing as mp
+    results = dict()
+    for label, method in [('full_table', _read_full_table), ('columns', _read_columns)]:
+        runs = []
+        for k in range(n_repeats):
+            queue = mp.Queue()
+            proc = mp.Process(target=_benchmark_worker, args=(method, fname, columns, table_path, queue))
+            proc.start()
+            runs.append(queue.get())
+            proc.join()
+        results[label] = dict(time=min(run[0] for run in runs), peak_rss_mb=max(run[1] for run in runs),
+            read_rss_mb=max(run[1] - run[2] for run in runs), data_mb=runs[0][3])
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+    import tempfile
+    if len(sys.argv) > 1:
+        fname = sys.argv[1]
+        columns = sys.argv[2:] if len(sys.argv) > 2 else ['cursor']
+    else:
+        fname = os.path.join(tempfile.mkdtemp(), 'benchmark.hdf')
+        print "Writing benchmark file %s" % fname
+        make_benchmark_file(fname)
+        columns = ['cursor']
+
+    results = benchmark_column_reads(fname, columns)
+    print "%-12s %10s %14s %14s %10s" % ('method', 'time (s)', 'peak RSS (MB)', 'read RSS (MB)', 'data (MB)')
+    for label in ['full_table', 'columns']:
+        res = results[label]
+        print "%-12s %10.3f %14.1f %14.1f %10.1f" % (label, res['time'], res['peak_rss_mb'], res['read_rss_mb'], res['data_mb'])
@@ -21,6 +21,14 @@ class KalmanFilter(bmi.GaussianStateHMM):
     model_attrs = ['A', 'W', 'C', 'Q', 'C_xpose_Q_inv', 'C_xpose_Q_inv_C']
     attrs_to_pickle = ['A', 'W', 'C', 'Q', 'C_xpose_Q_inv', 'C_xpose_Q_inv_C', 'R', 'S', 'T', 'ESS']
 
+    # Once the Kalman gain stops changing (relative change below 'steady_state_tol'), 
+    # the filter switches to the steady-state update x_t = F*x_{t-1} + K*y_t. Setting any of the 
+    # model attributes (e.g., by CLDA) switches back to the full update.
+    steady_state_tol = 1e-10
+    _ss_active = False
+    _last_gains = (None, None)
+    _ss_invalidating_attrs = set(['A', 'W', 'C', 'Q', 'C_xpose_Q_inv', 'C_xpose_Q_inv_C'])
+
     def __init__(self, A=None, W=None, C=None, Q=None, is_stochastic=None):
         '''
         Constructor for KalmanFilter    
@@ -83,6 +91,99 @@ class KalmanFilter(bmi.GaussianStateHMM):
             n_states = self.A.shape[0]
             self.is_stochastic = np.ones(n_states, dtype=bool)
 
+    def __setattr__(self, attr, value):
+        if attr in self._ss_invalidating_attrs:
+            self.__dict__['_ss_active'] = False
+            self.__dict__['_last_gains'] = (None, None)
+        super(KalmanFilter, self).__setattr__(attr, value)
+
+    def invalidate_steady_state(self):
+        '''
+        Switch back to the full KF update, e.g., after the model parameters have been modified in place. 
+        The steady state is re-detected once the estimator covariance converges again.
+        '''
+        self._ss_active = False
+        self._last_gains = (None, None)
+
+    def get_steady_state_gains(self):
+        '''
+        Gains of the steady-state update x_t = F*x_{t-1} + K*y_t, if the filter is currently using it. 
+        Used by Decoder.decode_batch
+
+        Returns
+        -------
+        tuple of (F, K) np.ndarrays, or None if the filter is not in steady state
+        '''
+        # subclasses which modify the update (e.g., drift correction) must be run one step at a time
+        if type(self)._forward_infer.im_func is not KalmanFilter._forward_infer.im_func:
+            return None
+        if self._ss_active and self.state.cov is self._ss_P_post:
+            return self._ss_F, self._ss_K
+        return None
+
+    def _init_steady_state(self, KC, K, P_post):
+        '''
+        Precompute and preallocate everything needed for the steady-state update
+
+        Parameters
+        ----------
+        KC : np.mat of shape (n_states, n_states)
+            Kalman gain times the observation matrix
+        K : np.mat of shape (n_states, n_obs)
+            Steady-state Kalman gain
+        P_post : np.mat of shape (n_states, n_states)
+            Posterior covariance, cov(x_t | y_1, ..., y_t), when the gains converged. It is held 
+            fixed while the steady-state update is used
+
+        Returns
+        -------
+        None
+        '''
+        nS = self.A.shape[0]
+        A = np.asarray(self.A)
+        KC = np.asarray(KC)
+        self._ss_F = A - np.dot(KC, A)             # (I - KC)*A
+        self._ss_I_KC = np.eye(nS) - KC
+        self._ss_K = np.array(K)
+        self._ss_P_post = P_post
+
+        # two output buffers are used alternately, so the state passed in is never overwritten
+        self._ss_states = [bmi.GaussianState(np.mat(np.zeros([nS, 1])), P_post) for k in range(2)]
+        self._ss_means = [state.mean for state in self._ss_states]
+        self._ss_bufs = [np.asarray(mean) for mean in self._ss_means]
+        self._ss_Ky = np.zeros([nS, 1])
+        self._ss_tmp = np.zeros([nS, 1])
+        self._ss_idx = 0
+        self._ss_active = True
+
+    def _forward_infer_steady_state(self, st, obs_t, Bu=None, u=None, obs_is_control_independent=True):
+        '''
+        Steady-state version of _forward_infer, with a fixed Kalman gain. Arguments are the same as _forward_infer
+        '''
+        x = np.asarray(st.mean)
+        idx = 1 - self._ss_idx
+        if np.may_share_memory(x, self._ss_bufs[idx]):
+            idx = self._ss_idx
+        self._ss_idx = idx
+        post_state = self._ss_states[idx]
+        x_new = self._ss_bufs[idx]
+
+        np.dot(self._ss_K, np.asarray(obs_t, dtype=np.float64), out=self._ss_Ky)
+        np.dot(self._ss_F, x, out=x_new)
+        x_new += self._ss_Ky
+        if Bu is not None or u is not None:
+            c_t = np.asarray(Bu) if Bu is not None else np.asarray(self.B * u)
+            if obs_is_control_independent:
+                x_new += c_t
+            else:
+                np.dot(self._ss_I_KC, c_t, out=self._ss_tmp)
+                x_new += self._ss_tmp
+
+        # the mean/cov attributes may have been replaced by code outside the filter (e.g., assist or state bounding)
+        post_state.mean = self._ss_means[idx]
+        post_state.cov = self._ss_P_post
+        return post_state
+
     def _obs_prob(self, state):
         '''
         Predict the observations based on the model parameters:
@@ -127,6 +228,12 @@ class KalmanFilter(bmi.GaussianStateHMM):
             New state estimate incorporating the most recent observation
 
         '''
+        # The estimator covariance does not depend on the observations or on the control input 
+        # (unless the control input changes the dynamics, as for target_state), so once it has
+        # converged the gain is fixed
+        if self._ss_active and x_target is None and st.cov is self._ss_P_post:
+            return self._forward_infer_steady_state(st, obs_t, Bu=Bu, u=u, obs_is_control_independent=obs_is_control_independent)
+
         using_control_input = (Bu is not None) or (u is not None) or (x_target is not None)
         pred_state = self._ssm_pred(st, target_state=x_target, Bu=Bu, u=u, F=F)
 
@@ -152,6 +259,18 @@ class KalmanFilter(bmi.GaussianStateHMM):
 
         post_state.cov = (I - KC) * P 
 
+        # Switch to the steady-state update once the gains stop changing. The covariance itself 
+        # need not converge, e.g., for unobserved position states which integrate velocity
+        if x_target is None and self.steady_state_tol > 0:
+            last_K, last_KC = getattr(self, '_last_gains', (None, None))
+            if last_K is not None and last_K.shape == K.shape and \
+                np.max(np.abs(K - last_K)) <= self.steady_state_tol * np.max(np.abs(K)) and \
+                np.max(np.abs(KC - last_KC)) <= self.steady_state_tol * np.max(np.abs(KC)):
+                self._init_steady_state(KC, K, post_state.cov)
+                self._last_gains = (None, None)
+            else:
+                self._last_gains = (K, KC)
+
         return post_state
 
     def set_state_cov(self, n_steps):
@@ -191,18 +310,220 @@ class KalmanFilter(bmi.GaussianStateHMM):
         K = P * (I - D*P*(I + D*P).I) * L
         return K
 
+    def _partition_states(self):
+        '''
+        Split the states into three groups for the steady-state gain computation:
+            'zero' : deterministic states (e.g., the offset) whose estimator covariance stays 0
+            'downstream' : states which are not observed and do not affect any other state (e.g., 
+                position in a velocity-only decoder). Their covariance may grow without bound, 
+                but it does not affect the gains
+            'core' : all the other states. The Riccati equation is solved for this block only
+
+        Returns
+        -------
+        tuple of np.ndarray
+            Indices of the (zero, downstream, core) states
+        '''
+        A, W = np.asarray(self.A), np.asarray(self.W)
+        D = np.asarray(self.C_xpose_Q_inv_C)
+        nS = A.shape[0]
+
+        zero = set(np.nonzero(np.all(W == 0, axis=0) & np.all(W == 0, axis=1))[0])
+        changed = True
+        while changed:
+            keep = set(k for k in zero if np.all(A[k, list(set(range(nS)) - zero)] == 0))
+            changed = keep != zero
+            zero = keep
+
+        downstream = set(np.nonzero(np.all(D == 0, axis=0))[0]) - zero
+        changed = True
+        while changed:
+            others = list(set(range(nS)) - downstream)
+            keep = set(k for k in downstream if np.all(A[others, k] == 0))
+            changed = keep != downstream
+            downstream = keep
+
+        core = set(range(nS)) - zero - downstream
+        return tuple(np.array(sorted(x), dtype=int) for x in [zero, downstream, core])
+
+    def _sskf_from_posterior_cov(self, S_core, S_down, zero, downstream, core):
+        '''
+        Assemble the steady-state KC and K matrices from the posterior covariance blocks
+        '''
+        nS = self.A.shape[0]
+        D = np.asarray(self.C_xpose_Q_inv_C)
+        L = np.asarray(self.C_xpose_Q_inv)
+        KC = np.zeros([nS, nS])
+        K = np.zeros([nS, L.shape[1]])
+        KC[core] = np.dot(S_core, D[core])
+        K[core] = np.dot(S_core, L[core])
+        if len(downstream) > 0:
+            KC[downstream] = np.dot(S_down, D[core])
+            K[downstream] = np.dot(S_down, L[core])
+        return KC, K
+
+    def _solve_sskf_dare(self):
+        '''
+        Steady-state KC and K from a discrete algebraic Riccati equation solve on the 'core' states 
+        (see _partition_states). The observations enter only through C_xpose_Q_inv_C, so the cost 
+        of the solve does not depend on the number of observations.
+
+        Returns
+        -------
+        KC : np.ndarray of shape (n_states, n_states)
+        K : np.ndarray of shape (n_states, n_obs)
+        diagnostics : dict
+        '''
+        import scipy.linalg
+        zero, downstream, core = self._partition_states()
+        A, W = np.asarray(self.A), np.asarray(self.W)
+        D = np.asarray(self.C_xpose_Q_inv_C)
+
+        A_c = A[np.ix_(core, core)]
+        W_c = W[np.ix_(core, core)]
+        D_c = D[np.ix_(core, core)]
+        D_c = 0.5*(D_c + D_c.T)
+
+        # factor D_c = L_c*L_c.T, keeping only its range, so the "input" dimension is at most the number of core states
+        eigvals, eigvecs = np.linalg.eigh(D_c)
+        rank = eigvals > max(np.max(eigvals), 0) * 1e-12
+        L_c = eigvecs[:, rank] * np.sqrt(eigvals[rank])
+        n_r = L_c.shape[1]
+
+        # P = A_c*S*A_c.T + W_c, S = P - P*L_c*inv(I + L_c.T*P*L_c)*L_c.T*P is the prediction covariance
+        P = scipy.linalg.solve_discrete_are(A_c.T, L_c, W_c, np.eye(n_r))
+        P = 0.5*(P + P.T)
+        G = np.eye(len(core)) - np.dot(L_c, np.linalg.solve(np.eye(n_r) + np.dot(L_c.T, np.dot(P, L_c)), np.dot(L_c.T, P)))
+        S_c = np.dot(P, G)
+        S_c = 0.5*(S_c + S_c.T)
+
+        residual = np.dot(A_c, np.dot(S_c, A_c.T)) + W_c - P
+        rel_residual = np.linalg.norm(residual) / max(np.linalg.norm(P), 1e-300)
+
+        # Cross-covariance of the downstream states with the core states solves the Stein equation
+        #   P_dc = A_dd*P_dc*(G*A_c.T) + A_dc*S_c*A_c.T + W_dc
+        S_down = None
+        if len(downstream) > 0:
+            A_dd = A[np.ix_(downstream, downstream)]
+            A_dc = A[np.ix_(downstream, core)]
+            W_dc = W[np.ix_(downstream, core)]
+            B = np.dot(G, A_c.T)
+            rhs = np.dot(A_dc, np.dot(S_c, A_c.T)) + W_dc
+            n_d, n_c = len(downstream), len(core)
+            # vec(A_dd*X*B) = kron(B.T, A_dd)*vec(X) for column-major vec
+            kron_BA = np.kron(B.T, A_dd)
+            if np.max(np.abs(np.linalg.eigvals(kron_BA))) >= 1:
+                raise ValueError("Cross-covariance of the downstream states does not converge")
+            lhs = np.eye(n_d*n_c) - kron_BA
+            P_dc = np.linalg.solve(lhs, rhs.ravel(order='F')).reshape(n_d, n_c, order='F')
+            S_down = np.dot(P_dc, G)
+            rel_residual = max(rel_residual, 
+                np.linalg.norm(np.dot(A_dd, np.dot(P_dc, B)) + rhs - P_dc) / max(np.linalg.norm(P_dc), 1e-300))
+
+        KC, K = self._sskf_from_posterior_cov(S_c, S_down, zero, downstream, core)
+        diagnostics = dict(method='dare', residual=rel_residual, n_iter=0, 
+            n_core_states=len(core), n_downstream_states=len(downstream), n_zero_states=len(zero))
+        return KC, K, diagnostics
+
+    def _solve_sskf_iterative(self, tol=1e-15, max_iter=4000):
+        '''
+        Steady-state KC and K from iterating the Riccati recursion. Only state-sized matrices 
+        are used inside the loop (K is computed once at the end), so the cost per iteration does 
+        not depend on the number of observations
+
+        Returns
+        -------
+        KC : np.ndarray of shape (n_states, n_states)
+        K : np.ndarray of shape (n_states, n_obs)
+        diagnostics : dict
+        '''
+        A, W = np.asarray(self.A), np.asarray(self.W)
+        D = np.asarray(self.C_xpose_Q_inv_C)
+        nS = A.shape[0]
+        I = np.eye(nS)
+
+        P = np.zeros([nS, nS])
+        S = P
+        KC = np.zeros([nS, nS])
+        change = np.inf
+        n_iter = 0
+        while change > tol and n_iter < max_iter:
+            P = np.dot(A, np.dot(S, A.T)) + W
+            # S = P*(I - D*P*inv(I + D*P)) = P*inv(I + D*P)
+            S = np.linalg.solve((I + np.dot(D, P)).T, P.T).T
+            last_KC = KC
+            KC = np.dot(S, D)
+            change = np.linalg.norm(KC - last_KC)
+            n_iter += 1
+
+        K = np.dot(S, np.asarray(self.C_xpose_Q_inv))
+        diagnostics = dict(method='iterative', residual=change, n_iter=n_iter)
+        return KC, K, diagnostics
+
     def get_sskf(self, tol=1e-15, return_P=False, dtype=np.array, max_iter=4000,
-        verbose=False, return_Khist=False, alt=True):
+        verbose=False, return_Khist=False, alt=True, method='dare'):
         """Calculate the steady-state KF matrices
 
         value of P returned is the posterior error cov, i.e. P_{t|t}
 
         Parameters
         ----------
+        tol : float, optional, default=1e-15
+            Convergence tolerance of the Riccati iteration
+        return_P : bool, optional, default=False
+            Also return the estimator covariance. Requires the iteration
+        dtype : callable, optional, default=np.array
+            Type conversion applied to the outputs
+        max_iter : int, optional, default=4000
+            Maximum number of Riccati iterations
+        verbose : bool, optional, default=False
+            Print convergence information
+        return_Khist : bool, optional, default=False
+            Also return the Kalman gain at each iteration. Requires the iteration
+        method : string, optional, default='dare'
+            'dare' solves the Riccati equation directly and falls back to the iteration if the solve 
+            fails or is inaccurate (e.g., ill-conditioned models). 'iterative' always iterates.
+            Diagnostics of the computation are saved in the 'sskf_diagnostics' attribute
 
         Returns
         -------        
+        F : steady-state state transition matrix, (I - KC)*A
+        K : steady-state Kalman gain
         """ 
+        if return_P or return_Khist:
+            return self._get_sskf_riccati_iter(tol=tol, return_P=return_P, dtype=dtype, max_iter=max_iter,
+                verbose=verbose, return_Khist=return_Khist)
+
+        diagnostics = None
+        if method == 'dare':
+            try:
+                KC, K, diagnostics = self._solve_sskf_dare()
+                if not (diagnostics['residual'] < 1e-8 and np.all(np.isfinite(K))):
+                    diagnostics['fallback_reason'] = 'residual %g' % diagnostics['residual']
+            except (np.linalg.LinAlgError, ValueError) as e:
+                diagnostics = dict(method='dare', fallback_reason=str(e))
+
+        if diagnostics is None or 'fallback_reason' in diagnostics:
+            fallback_reason = None if diagnostics is None else diagnostics['fallback_reason']
+            KC, K, diagnostics = self._solve_sskf_iterative(tol=tol, max_iter=max_iter)
+            diagnostics['converged'] = diagnostics['residual'] <= tol
+            if fallback_reason is not None:
+                diagnostics['fallback_reason'] = fallback_reason
+        else:
+            diagnostics['converged'] = True
+
+        self.sskf_diagnostics = diagnostics
+        if verbose: print "get_sskf: %s" % diagnostics
+
+        A = np.asarray(self.A)
+        F = A - np.dot(KC, A)
+        return dtype(np.mat(F)), dtype(np.mat(K))
+
+    def _get_sskf_riccati_iter(self, tol=1e-15, return_P=False, dtype=np.array, max_iter=4000,
+        verbose=False, return_Khist=False):
+        """
+        Steady-state KF matrices by iterating the Riccati recursion, see get_sskf
+        """
         A, W, C, Q = np.mat(self.A), np.mat(self.W), np.mat(self.C), np.mat(self.Q)
 
         nS = A.shape[0]
@@ -666,6 +987,7 @@ class KFDecoder(bmi.BMI, bmi.Decoder):
         Update the decoder parameters if new parameters are available (e.g., by CLDA). See Decoder.update_params
         '''
         super(KFDecoder, self).update_params(new_params)
+        self.filt.invalidate_steady_state()
 
         # set the KF to the new steady state
         if steady_state:
@@ -810,6 +1132,75 @@ class KFDecoder(bmi.BMI, bmi.Decoder):
         return dec_new
         #self._save_new_dec(dec_new, '_subset')
 
+    def _proc_units(self, units, mode):
+        '''
+        Parse a list of units into the indices of the decoder units to keep
+
+        Parameters
+        ----------
+        units : string or np.ndarray of shape (N,2)
+            Units as (channel, unit) pairs, or as a comma-separated string, e.g., '12a, 13b'
+        mode : string
+            'keep' to keep the listed units or 'remove' to keep all the others
+
+        Returns
+        -------
+        list of int
+        '''
+        if isinstance(units, (str, unicode)):
+            units = [(int(ch), ord(u) - 96) for ch, u in re.findall(r'(\d+)\s*([a-z])', units)]
+        units = set(tuple(unit) for unit in np.asarray(units, dtype=int).reshape(-1, 2))
+
+        if mode == 'keep':
+            return [k for k, unit in enumerate(self.units) if tuple(unit) in units]
+        elif mode == 'remove':
+            return [k for k, unit in enumerate(self.units) if tuple(unit) not in units]
+        else:
+            raise ValueError("Unknown mode: %s" % mode)
+
+    def _return_proc_units_decoder(self, inds_to_keep):
+        '''
+        Copy of the decoder with only the specified units. The rows of C, block of Q and the 
+        sufficient statistics of the kept units are the same as if the decoder were retrained on them
+
+        Parameters
+        ----------
+        inds_to_keep : list of int
+            Indices of the units to keep
+
+        Returns
+        -------
+        KFDecoder
+        '''
+        import copy
+        inds_to_keep = np.asarray(inds_to_keep, dtype=int)
+        dec_new = copy.deepcopy(self)
+        filt = dec_new.filt
+
+        filt.C = np.mat(np.asarray(self.filt.C)[inds_to_keep, :])
+        filt.Q = np.mat(np.asarray(self.filt.Q)[np.ix_(inds_to_keep, inds_to_keep)])
+        Q_inv = np.linalg.pinv(filt.Q)
+        filt.C_xpose_Q_inv = filt.C.T * Q_inv
+        filt.C_xpose_Q_inv_C = filt.C.T * Q_inv * filt.C
+        filt.obs_noise = bmi.GaussianState(0.0, filt.Q)
+        filt.alt = filt.A.shape[0] < filt.C.shape[0]
+        if hasattr(filt, 'S'):
+            filt.S = np.asarray(self.filt.S)[inds_to_keep, :]
+            filt.T = np.asarray(self.filt.T)[np.ix_(inds_to_keep, inds_to_keep)]
+        filt.invalidate_steady_state()
+
+        dec_new.units = np.asarray(self.units)[inds_to_keep]
+        dec_new.n_features = len(inds_to_keep)
+        if np.ndim(self.mFR) > 0:
+            dec_new.mFR = np.asarray(self.mFR).ravel()[inds_to_keep]
+        if np.ndim(self.sdFR) > 0:
+            dec_new.sdFR = np.asarray(self.sdFR).ravel()[inds_to_keep]
+        if self.zeromeanunits is not None:
+            dec_new.zeromeanunits, = np.nonzero(np.in1d(inds_to_keep, self.zeromeanunits))
+        if 'units' in getattr(dec_new, 'extractor_kwargs', dict()):
+            dec_new.extractor_kwargs['units'] = dec_new.units
+        return dec_new
+
 def project_Q(C_v, Q_hat):
     """ 
     Deprecated! See clda.KFRML_IVC
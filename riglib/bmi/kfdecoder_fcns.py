@@ -7,6 +7,7 @@ import numpy as np
 import scipy
 from kfdecoder import KalmanFilter, KFDecoder
 import train
+import decoder_store
 import pickle
 import re
 import tables
@@ -30,7 +31,7 @@ def add_rm_units(task_entry_id, units, add_or_rm, flag_added_for_adaptation, nam
 
     '''
     if 'decoder_path' in kwargs:
-        kfdec = pickle.load(open(kwargs['decoder_path']))
+        kfdec = decoder_store.load(kwargs['decoder_path'])
     else:
         kfdec = get_decoder_corr(task_entry_id, decoder_entry_id)
 
@@ -83,7 +84,7 @@ def zscore_units(task_entry_id, calc_zscore_from_te, pos_key = 'cursor', decoder
     Output param: 
     '''
     if 'decoder_path' in kwargs:
-        decoder = pickle.load(open(kwargs['decoder_path']))
+        decoder = decoder_store.load(kwargs['decoder_path'])
     else:
         decoder = get_decoder_corr(task_entry_id, decoder_entry_id)
 
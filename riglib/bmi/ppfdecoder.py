@@ -3,6 +3,9 @@ Classes for BMI decoding using the Point-process filter.
 '''
 
 import numpy as np
+import scipy.linalg
+import scipy.linalg.lapack
+import scipy.stats
 
 import bmi
 from bmi import GaussianState
@@ -13,6 +16,206 @@ import feedback_controllers
 import pickle
 import train
 
+_potrf, _potrs = scipy.linalg.lapack.get_lapack_funcs(('potrf', 'potrs'), dtype=np.float64)
+
+def _spd_inv(M, I):
+    '''
+    Inverse of a symmetric positive-definite matrix by Cholesky factorization. Calls LAPACK directly 
+    since the scipy.linalg wrappers cost more than the factorization for state-sized matrices.
+    Falls back to the general inverse if M is not numerically positive definite.
+    '''
+    c, info = _potrf(M, lower=1)
+    if info == 0:
+        M_inv, info = _potrs(c, I, lower=1)
+    if info != 0:
+        M_inv = np.linalg.inv(M)
+    return M_inv
+
+def _poisson_info(mu, XX, iu, n_states):
+    '''
+    Fisher information X*diag(mu[k])*X.T of the Poisson GLM of each unit k, computed as one matrix 
+    product from XX, the products of the pairs (iu) of rows of X
+    '''
+    info = np.zeros([mu.shape[0], n_states, n_states])
+    info[:, iu[0], iu[1]] = np.dot(mu, XX.T)
+    info[:, iu[1], iu[0]] = info[:, iu[0], iu[1]]
+    return info
+
+def _fit_poisson_glm_units(args):
+    '''
+    Batched IRLS for the Poisson GLMs of a group of units with a shared design matrix. Follows the 
+    iteration of statsmodels' GLM.fit (same starting point and deviance-based convergence test), 
+    but each step solves the weighted least-squares problems of all the units not yet converged at once.
+    '''
+    X, Y, max_iter, tol = args
+    n_units, T = Y.shape
+    n_states = X.shape[0]
+
+    # products of pairs of rows of X, so that the X*diag(mu)*X.T of all the units is one matrix product
+    iu = np.triu_indices(n_states)
+    XX = X[iu[0]] * X[iu[1]]
+
+    C = np.zeros([n_units, n_states])
+    pvalues = np.ones([n_units, n_states]) * np.nan
+    converged = np.zeros(n_units, dtype=bool)
+    n_iter = np.zeros(n_units, dtype=int)
+    deviance = np.ones(n_units) * np.nan
+
+    # The deviance 2*sum(y*log(y/mu) - (y - mu)) only needs sum(mu) per iteration, since 
+    # sum(y*log(mu)) = beta*(X*y) and the other terms are constant
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ylogy = np.sum(np.where(Y > 0, Y*np.log(Y), 0), axis=1)
+    sum_y = np.sum(Y, axis=1)
+    XY = np.dot(Y, X.T)
+
+    # units which never fire have no finite maximum-likelihood estimate
+    active, = np.nonzero(sum_y > 0)
+    Y_a = Y[active]
+    mu = (Y_a + np.mean(Y_a, axis=1)[:,np.newaxis]) / 2.
+    eta = np.log(mu)
+    dev = 2*(ylogy[active] - np.sum(Y_a*eta, axis=1) - sum_y[active] + np.sum(mu, axis=1))
+    del Y_a
+    for k in range(max_iter):
+        if len(active) == 0:
+            break
+
+        # weighted least-squares step, with weights mu and working response eta + (y - mu)/mu
+        info = _poisson_info(mu, XX, iu, n_states)
+        rhs = np.dot(mu*eta - mu, X.T) + XY[active]
+        try:
+            beta = np.linalg.solve(info, rhs[:,:,np.newaxis])[:,:,0]
+        except np.linalg.LinAlgError:
+            beta = np.vstack([np.linalg.lstsq(H, b, rcond=None)[0] for H, b in zip(info, rhs)])
+
+        eta = np.dot(beta, X)
+        mu = np.exp(eta)
+        dev_new = 2*(ylogy[active] - np.sum(beta*XY[active], axis=1) - sum_y[active] + np.sum(mu, axis=1))
+        n_iter[active] = k + 1
+        C[active] = beta
+        deviance[active] = dev_new
+
+        done = np.abs(dev_new - dev) <= tol + tol*np.abs(dev_new)
+        failed = ~np.all(np.isfinite(beta), axis=1)
+        converged[active[done & ~failed]] = True
+
+        # standard errors from the Fisher information of the last weighted least-squares step
+        fin = done & ~failed
+        if np.any(fin):
+            cov = np.array([np.linalg.pinv(H) for H in info[fin]])
+            se = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+            pvalues[active[fin]] = 2*scipy.stats.norm.sf(np.abs(beta[fin]) / se)
+
+        keep = ~done & ~failed
+        active, mu, eta, dev = active[keep], mu[keep], eta[keep], dev_new[keep]
+
+    C[~converged & ~np.all(np.isfinite(C), axis=1)] = 0
+    return C, pvalues, converged, n_iter, deviance
+
+def fit_poisson_glm(X, Y, max_iter=100, tol=1e-8, n_processes=1):
+    '''
+    Maximum-likelihood fit of a Poisson GLM with log link, log(E[y_k]) = C[k]*x, for each unit k. 
+    All the units share the design matrix X, so the fits are run together as batched IRLS steps 
+    instead of one unit at a time.
+
+    Parameters
+    ----------
+    X : np.ndarray of shape (n_states, T)
+        Design matrix (e.g., kinematics, with a row of 1's for the offset)
+    Y : np.ndarray of shape (n_units, T)
+        Spike counts
+    max_iter : int, optional, default=100
+        Maximum number of IRLS iterations
+    tol : float, optional, default=1e-8
+        A unit has converged once its deviance changes by less than tol*(1 + |deviance|)
+    n_processes : int, optional, default=1
+        If greater than 1, the units are split into this many groups which are fit in a pool of processes
+
+    Returns
+    -------
+    C : np.ndarray of shape (n_units, n_states)
+        Estimated coefficients. Units which never fire are assigned 0's
+    pvalues : np.ndarray of shape (n_units, n_states)
+        Wald test p-values of the coefficients, NaN for units which did not converge
+    info : dict
+        Per-unit convergence information: 'converged' (bool array), 'n_iter' (int array) and 'deviance'. 
+        'silent' (bool array) marks the units which never fire. They are not fit, so they are also 
+        not 'converged', but unlike the other units which did not converge this is not a failure of the fit
+    '''
+    X = np.array(X, dtype=np.float64)
+    Y = np.array(Y, dtype=np.float64)
+    n_units = Y.shape[0]
+    if n_processes > 1 and n_units > 1:
+        import multiprocessing as mp
+        groups = np.array_split(np.arange(n_units), min(n_processes, n_units))
+        pool = mp.Pool(len(groups))
+        try:
+            results = pool.map(_fit_poisson_glm_units, [(X, Y[inds], max_iter, tol) for inds in groups])
+        finally:
+            pool.close()
+            pool.join()
+        C, pvalues, converged, n_iter, deviance = [np.concatenate(x) for x in zip(*results)]
+    else:
+        C, pvalues, converged, n_iter, deviance = _fit_poisson_glm_units((X, Y, max_iter, tol))
+    silent = ~(np.sum(Y, axis=1) > 0)
+    return C, pvalues, dict(converged=converged, n_iter=n_iter, deviance=deviance, silent=silent)
+
+def refine_poisson_glm(X, Y, C_init, n_steps=2):
+    '''
+    Newton steps for the Poisson GLMs of fit_poisson_glm, starting from previous estimates of the 
+    coefficients (e.g., the current parameters of a decoder being adapted). Close to the optimum the 
+    number of correct digits roughly doubles with each step, so a few steps from a good starting point 
+    give the fit at a fixed cost, instead of iterating until convergence from scratch.
+
+    Parameters
+    ----------
+    X : np.ndarray of shape (n_states, T)
+        Design matrix
+    Y : np.ndarray of shape (n_units, T)
+        Spike counts
+    C_init : np.ndarray of shape (n_units, n_states)
+        Starting point
+    n_steps : int, optional, default=2
+        Number of Newton steps
+
+    Returns
+    -------
+    C : np.ndarray of shape (n_units, n_states)
+        Coefficients after the Newton steps. Units which never fire (no finite estimate) keep their starting values
+    pvalues : np.ndarray of shape (n_units, n_states)
+        Wald test p-values of the coefficients, NaN for the units which never fire
+    '''
+    X = np.array(X, dtype=np.float64)
+    Y = np.array(Y, dtype=np.float64)
+    C = np.array(C_init, dtype=np.float64)
+    n_states = X.shape[0]
+    iu = np.triu_indices(n_states)
+    XX = X[iu[0]] * X[iu[1]]
+    pvalues = np.ones(C.shape) * np.nan
+
+    active, = np.nonzero(np.sum(Y, axis=1) > 0)
+    XY = np.dot(Y[active], X.T)
+    for k in range(n_steps + 1):
+        mu = np.exp(np.dot(C[active], X))
+        info = _poisson_info(mu, XX, iu, n_states)
+        if k == n_steps:
+            break
+
+        grad = XY - np.dot(mu, X.T)
+        try:
+            step = np.linalg.solve(info, grad[:,:,np.newaxis])[:,:,0]
+        except np.linalg.LinAlgError:
+            step = np.vstack([np.linalg.lstsq(H, g, rcond=None)[0] for H, g in zip(info, grad)])
+
+        # a unit whose step overflows keeps its previous estimate
+        C_new = C[active] + step
+        ok = np.all(np.isfinite(C_new), axis=1)
+        C[active[ok]] = C_new[ok]
+
+    cov = np.array([np.linalg.pinv(H) for H in info]).reshape(-1, n_states, n_states)
+    se = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+    pvalues[active] = 2*scipy.stats.norm.sf(np.abs(C[active]) / se)
+    return C, pvalues
+
 class PointProcessFilter(bmi.GaussianStateHMM):
     """
     Low-level Point-process filter, agnostic to application
@@ -27,6 +230,16 @@ class PointProcessFilter(bmi.GaussianStateHMM):
     """
     model_attrs = ['A', 'W', 'C']
 
+    # attributes from which the per-step matrices in _obs_model_cache are derived
+    _cache_invalidating_attrs = set(['C', 'is_stochastic'])
+    _obs_cache = None
+
+    # Sparse update mode (see _sparse_obs_terms). The summed predicted rates are approximated by a 
+    # 2nd-order expansion around a reference state which is moved once the log-rate of any unit 
+    # could have changed by more than 'sparse_update_tol' (relative rate error < tol**3/6)
+    sparse_update = False
+    sparse_update_tol = 0.05
+
     def __init__(self, A=None, W=None, C=None, dt=None, is_stochastic=None, B=0, F=0):
         '''
         Constructor for PointProcessFilter
@@ -90,6 +303,105 @@ class PointProcessFilter(bmi.GaussianStateHMM):
         if not hasattr(self, 'B'): self.B = 0
         if not hasattr(self, 'F'): self.F = 0
 
+    def __setattr__(self, attr, value):
+        if attr in self._cache_invalidating_attrs:
+            self.__dict__['_obs_cache'] = None
+        super(PointProcessFilter, self).__setattr__(attr, value)
+
+    def _obs_model_cache(self):
+        '''
+        Index arrays and observation matrices used by every call to _forward_infer, rebuilt only
+        when 'C' or 'is_stochastic' are re-assigned. Call 'invalidate_cache' after modifying C in place.
+        '''
+        if self._obs_cache is None:
+            inds, = np.nonzero(self.is_stochastic)
+            C = np.asarray(self.C, dtype=np.float64)
+            drives_inds, = np.nonzero(np.any(C != 0, axis=0))
+            C_drives = np.ascontiguousarray(C[:,drives_inds])
+            self.__dict__['_obs_cache'] = dict(inds=inds, mesh=np.ix_(inds, inds), C=C, 
+                C_stoch=np.ascontiguousarray(C[:,inds]), I_stoch=np.eye(len(inds)),
+                drives_inds=drives_inds, C_drives=C_drives, 
+                max_abs_C_drives=np.max(np.abs(C_drives), axis=0) if C.shape[0] > 0 else np.zeros(len(drives_inds)),
+                expansion=None)
+        return self._obs_cache
+
+    def _dense_obs_terms(self, x_pred, obs_t, cache):
+        '''
+        Observation terms of the PPF update, evaluated for every unit
+
+        Parameters
+        ----------
+        x_pred : np.ndarray of shape (n_states, 1)
+            Predicted state
+        obs_t : np.ndarray of shape (n_units,)
+            Spike counts in the current bin
+        cache : dict
+            See _obs_model_cache
+
+        Returns
+        -------
+        obs_proj : np.ndarray of shape (n_stoch,)
+            C.T*obs_t, restricted to the stochastic states
+        rate_proj : np.ndarray of shape (n_stoch,)
+            C.T*(lambda*dt), restricted to the stochastic states
+        info : np.ndarray of shape (n_stoch, n_stoch)
+            C.T*diag(lambda*dt)*C, restricted to the stochastic states
+        '''
+        C_stoch = cache['C_stoch']
+        lambda_dt = np.exp(np.dot(cache['C'], x_pred)).ravel()
+        return np.dot(obs_t, C_stoch), np.dot(lambda_dt, C_stoch), np.dot(C_stoch.T, lambda_dt[:,None] * C_stoch)
+
+    def _sparse_obs_terms(self, x_pred, obs_t, cache):
+        '''
+        Same as _dense_obs_terms, but the work per bin scales with the number of spikes rather than 
+        the number of units. With a = C*(x - x_ref), the rates are expanded as 
+            lambda*dt = exp(C*x_ref) * (1 + a + a**2/2)
+        so the sums over units of the rate terms reduce to moments of the rows of C weighted by 
+        exp(C*x_ref), which are precomputed in the (small) space of the states that drive the units. 
+        The reference state is moved to x_pred when |a| may exceed sparse_update_tol for any unit.
+        '''
+        x_pred = x_pred.ravel()
+        drives_inds = cache['drives_inds']
+        expansion = cache['expansion']
+        if expansion is not None:
+            delta = x_pred[drives_inds] - expansion['x_ref']
+            if np.dot(cache['max_abs_C_drives'], np.abs(delta)) > self.sparse_update_tol:
+                expansion = None
+
+        if expansion is None:
+            C_stoch, C_drives = cache['C_stoch'], cache['C_drives']
+            n_units, n_stoch = C_stoch.shape
+            lambda_dt_ref = np.exp(np.dot(cache['C'], x_pred))
+            # rows of C weighted by the reference rates, for the rate and information terms
+            left = np.hstack([C_stoch, (C_stoch[:,:,None] * C_stoch[:,None,:]).reshape(n_units, -1)]) * lambda_dt_ref[:,None]
+            # 0th, 1st and 2nd order terms of the expansion
+            right = np.hstack([np.ones([n_units, 1]), C_drives, (C_drives[:,:,None] * C_drives[:,None,:]).reshape(n_units, -1)])
+            n_drives = len(drives_inds)
+            phi = np.zeros(1 + n_drives + n_drives**2)
+            phi[0] = 1
+            expansion = dict(x_ref=x_pred[drives_inds].copy(), moments=np.dot(left.T, right), n_stoch=n_stoch, 
+                phi=phi, phi_1=phi[1:1+n_drives], phi_2=phi[1+n_drives:].reshape(n_drives, n_drives))
+            cache['expansion'] = expansion
+            delta = np.zeros(n_drives)
+
+        # phi = [1, delta, vec(delta*delta.T)/2]
+        expansion['phi_1'][:] = delta
+        np.multiply.outer(0.5*delta, delta, out=expansion['phi_2'])
+        terms = np.dot(expansion['moments'], expansion['phi'])
+        n_stoch = expansion['n_stoch']
+        rate_proj = terms[:n_stoch]
+        info = terms[n_stoch:].reshape(n_stoch, n_stoch)
+
+        spiking, = np.nonzero(obs_t)
+        obs_proj = np.dot(obs_t[spiking], cache['C_stoch'][spiking])
+        return obs_proj, rate_proj, info
+
+    def invalidate_cache(self):
+        '''
+        Discard the cached observation matrices, e.g., after C has been modified in place
+        '''
+        self.__dict__['_obs_cache'] = None
+
     def init_noise_models(self):
         '''
         see bmi.GaussianStateHMM.init_noise_models for documentation
@@ -157,44 +469,40 @@ class PointProcessFilter(bmi.GaussianStateHMM):
             x_target = np.mat(x_target[:,0].reshape(-1,1))
         target_state = x_target
 
-        obs_t = np.mat(obs_t.reshape(-1,1))
-        C = self.C
-        n_obs, n_states = C.shape
-        
-        dt = self.spike_rate_dt
-        inds, = np.nonzero(self.is_stochastic)
-        mesh = np.ix_(inds, inds)
-        A = self.A
-        W = self.W
-        C = C[:,inds]
-
+        cache = self._obs_model_cache()
+        inds, mesh = cache['inds'], cache['mesh']
+        obs_t = np.asarray(obs_t, dtype=np.float64)
+        n_states = self.A.shape[0]
 
-        # print np.array(x_target).ravel()
         pred_state = self._ssm_pred(st, target_state=x_target, Bu=Bu, u=u, F=F)
         x_pred, P_pred = pred_state.mean, pred_state.cov
-        P_pred = P_pred[mesh]
-
-        Loglambda_predict = self.C * x_pred 
-        exp = np.vectorize(lambda x: np.real(cmath.exp(x)))
-        lambda_predict = exp(np.array(Loglambda_predict).ravel())/dt
-
-        Q_inv = np.mat(np.diag(lambda_predict*dt))
-
-        if np.linalg.cond(P_pred) > 1e5:
-            P_est = P_pred;
+        P_pred = np.asarray(P_pred)[mesh]
+
+        # C.T*obs_t, C.T*(lambda*dt) and C.T*diag(lambda*dt)*C for the stochastic states, where lambda*dt 
+        # is the expected number of spikes in the bin
+        obs_terms = self._sparse_obs_terms if self.sparse_update else self._dense_obs_terms
+        obs_proj, rate_proj, info = obs_terms(np.asarray(x_pred), obs_t.ravel(), cache)
+
+        # Posterior covariance in information form, inv(inv(P_pred) + C.T*diag(lambda*dt)*C), unless 
+        # the predicted covariance is poorly conditioned. P_pred is symmetric, so its 2-norm condition 
+        # number is the ratio of the extreme eigenvalue magnitudes (same test as np.linalg.cond)
+        abs_eigvals = np.abs(np.linalg.eigvalsh(P_pred))
+        if abs_eigvals.max() > 1e5 * abs_eigvals.min():
+            P_est_stoch = P_pred
         else:
-            P_est = (P_pred.I + C.T*np.mat(np.diag(lambda_predict*dt))*C).I
+            I = cache['I_stoch']
+            P_est_stoch = _spd_inv(_spd_inv(P_pred, I) + info, I)
 
         # inflate P_est
-        P_est_full = np.mat(np.zeros([n_states, n_states]))
-        P_est_full[mesh] = P_est
-        P_est = P_est_full 
+        P_est = np.mat(np.zeros([n_states, n_states]))
+        P_est[mesh] = P_est_stoch
 
-        unpred_spikes = obs_t - np.mat(lambda_predict*dt).reshape(-1,1)
+        x_est = np.matrix(x_pred, dtype=np.float64, copy=True)
+        x_est[inds] += np.dot(P_est_stoch, obs_proj - rate_proj).reshape(-1,1)
 
-        x_est = np.mat(np.zeros([n_states, 1]))
-        x_est = x_pred + P_est*self.C.T*unpred_spikes
-        self.neural_push = P_est*self.C.T*obs_t
+        neural_push = np.mat(np.zeros([n_states, 1]))
+        neural_push[inds] = np.dot(P_est_stoch, obs_proj).reshape(-1,1)
+        self.neural_push = neural_push
         self.P_est = P_est
         post_state = GaussianState(x_est, P_est)
         return post_state
@@ -228,17 +536,30 @@ class PointProcessFilter(bmi.GaussianStateHMM):
         return np.vstack([beta_mat[1:,:], beta_mat[0,:]]).T
 
     @classmethod
-    def MLE_obs_model(cls, hidden_state, obs, include_offset=True, drives_obs=None):
+    def MLE_obs_model(cls, hidden_state, obs, include_offset=True, drives_obs=None, n_processes=1, return_info=False):
         """
         Unconstrained ML estimator of {C, } given observations and
-        the corresponding hidden states
-        Docstring    
+        the corresponding hidden states. The Poisson GLMs of all the units are fit together, see fit_poisson_glm
         
         Parameters
         ----------
+        hidden_state : np.ndarray of shape (n_states, T)
+            Hidden state (kinematics) at each time point
+        obs : np.ndarray of shape (n_units, T)
+            Spike counts at each time point
+        include_offset : bool, optional, default=True
+            If true, a state of all 1's is added to the hidden state to fit the baseline firing rates
+        drives_obs : np.ndarray of booleans, optional
+            Which of the states (excluding the offset) to use in the fit
+        n_processes : int, optional, default=1
+            Number of processes over which to split the units
+        return_info : bool, optional, default=False
+            If true, also return the per-unit convergence information of fit_poisson_glm
         
         Returns
         -------            
+        C : np.ndarray of shape (n_units, n_states)
+        pvalues : np.ndarray of shape (n_units, n_states)
         """
         assert hidden_state.shape[1] == obs.shape[1]
     
@@ -267,22 +588,16 @@ class PointProcessFilter(bmi.GaussianStateHMM):
             X = X[drives_obs, :]
         Y = np.array(Y)
 
-        # ML estimate of C and Q
-        n_units = Y.shape[0]
-        n_states = X.shape[0]
-        C = np.zeros([n_units, n_states])
-        pvalues = np.zeros([n_units, n_states])
-        import statsmodels.api as sm
-        glm_family = sm.families.Poisson()
-        for k in range(n_units):
-            model = sm.GLM(Y[k,:], X.T, family=glm_family)
-            try:
-                model_fit = model.fit()
-                C[k,:] = model_fit.params
-                pvalues[k,:] = model_fit.pvalues                
-            except:
-                pvalues[k,:] = np.nan
+        # ML estimate of C
+        C, pvalues, info = fit_poisson_glm(X, Y, n_processes=n_processes)
+        failed = ~info['converged'] & ~info['silent']
+        if np.any(failed):
+            print "MLE_obs_model: GLM fit did not converge for units", np.nonzero(failed)[0]
+        if np.any(info['silent']):
+            print "MLE_obs_model: units", np.nonzero(info['silent'])[0], "never fire, their coefficients are set to 0"
 
+        if return_info:
+            return C, pvalues, info
         return C, pvalues
 
 
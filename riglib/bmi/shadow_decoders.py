@@ -0,0 +1,222 @@
+'''
+Shadow decoders are candidate decoders (e.g., different unit subsets, regularizers or CLDA
+half-lives) which are run during an experiment on the same neural features as the live decoder,
+without controlling the plant, so that they can be compared offline on identical data.
+'''
+import time
+from collections import deque
+import numpy as np
+
+
+class ShadowDecoderBank(object):
+    '''
+    Runs a set of shadow decoders on the observations decoded by the live decoder.
+
+    Decoders whose filter is in steady state (x_t = F*x_{t-1} + K*y_t, see Decoder.decode_batch) are
+    stacked into one block-diagonal F and one gain K which acts directly on the live decoder's
+    features (with the z-scoring of each decoder folded in), so that updating all of them costs
+    about as much as updating one decoder. The remaining decoders are run one at a time with 'predict'
+    and are moved into the stack once their filter reaches steady state.
+
+    The shadow decoders must never delay the live decoder, so the decoders which are not stacked
+    are only run for as long as the time budget allows in each cycle. Observations which they could
+    not get to are queued, and the oldest ones are dropped (and counted in 'n_skipped') once the
+    queue is full. The parameters of the shadow decoders are assumed to be fixed.
+    '''
+    def __init__(self, decoders, live_units, time_budget=0.002, max_backlog=60, stack=True):
+        '''
+        Constructor for ShadowDecoderBank
+
+        Parameters
+        ----------
+        decoders : list of riglib.bmi.Decoder instances
+            Shadow decoders. Their units must be a subset of the live decoder's units and they
+            must run at the same rate as the live decoder
+        live_units : np.ndarray of shape (n_features, 2)
+            Units of the live decoder, i.e., the order of the features given to 'run'
+        time_budget : float, optional, default=0.002
+            Time (in seconds) per cycle for running the decoders which are not stacked
+        max_backlog : int, optional, default=60
+            Maximum number of observations queued for each decoder which is not stacked
+        stack : bool or list of bool, optional, default=True
+            Whether the decoders are stacked once their filters reach steady state, for all the decoders 
+            or for each one. Decoders which are not stacked are always run one observation at a time
+
+        Returns
+        -------
+        ShadowDecoderBank instance
+        '''
+        self.decoders = list(decoders)
+        self.time_budget = time_budget
+        self.max_backlog = max_backlog
+        if isinstance(stack, bool):
+            stack = [stack] * len(self.decoders)
+        if len(stack) != len(self.decoders):
+            raise ValueError("'stack' must be a bool or a list with one bool per decoder")
+        self.stack = list(stack)
+
+        live_index = dict((tuple(np.asarray(unit).ravel()), k) for k, unit in enumerate(live_units))
+        self.n_live_features = len(live_units)
+        self.feature_inds = []
+        for k, decoder in enumerate(self.decoders):
+            try:
+                inds = [live_index[tuple(np.asarray(unit).ravel())] for unit in decoder.units]
+            except KeyError as e:
+                raise ValueError("Shadow decoder %d uses unit %s, which is not decoded by the live decoder" % (k, e.args[0]))
+            self.feature_inds.append(np.array(inds, dtype=int))
+
+        self.n_states = [len(decoder.states) for decoder in self.decoders]
+        max_states = max(self.n_states) if len(self.decoders) > 0 else 0
+
+        # most recent state of each decoder, padded with NaN's
+        self.states = np.ones([len(self.decoders), max_states]) * np.nan
+        for k, decoder in enumerate(self.decoders):
+            self.states[k, :self.n_states[k]] = np.asarray(decoder.filt.get_mean()).ravel()
+        self.n_skipped = np.zeros(len(self.decoders), dtype=int)
+
+        self._queues = [deque() for decoder in self.decoders]
+        self._stack_queue = []
+        self._stacked = []
+        self._build_stack()
+
+    @property
+    def state_shape(self):
+        '''
+        Shape of the 'states' array, for declaring the HDF table columns
+        '''
+        return self.states.shape
+
+    def _steady_state_gains(self, k):
+        '''
+        Gains of the steady-state update of decoder k, or None if it cannot be stacked (yet)
+        '''
+        if not self.stack[k]:
+            return None
+        get_steady_state_gains = getattr(self.decoders[k].filt, 'get_steady_state_gains', None)
+        if get_steady_state_gains is None:
+            return None
+        return get_steady_state_gains()
+
+    def _build_stack(self):
+        '''
+        (Re-)build the stacked steady-state update from all the decoders which can be stacked
+        '''
+        # hand the current state of the stacked decoders back to their filters
+        for k, sl in zip(self._stacked, getattr(self, '_stack_slices', [])):
+            self.decoders[k].filt.state.mean = np.mat(self._x[sl].reshape(-1,1))
+
+        stacked = []
+        gains = []
+        for k in range(len(self.decoders)):
+            if len(self._queues[k]) > 0:
+                continue
+            ss_gains = self._steady_state_gains(k)
+            if ss_gains is not None:
+                stacked.append(k)
+                gains.append(ss_gains)
+
+        n_stacked_states = sum(self.n_states[k] for k in stacked)
+        F = np.zeros([n_stacked_states, n_stacked_states])
+        K = np.zeros([n_stacked_states, self.n_live_features])
+        b = np.zeros(n_stacked_states)
+        x = np.zeros(n_stacked_states)
+        slices = []
+        bounded = []
+        offset = 0
+        for k, (F_k, K_k) in zip(stacked, gains):
+            decoder = self.decoders[k]
+            sl = slice(offset, offset + self.n_states[k])
+            offset += self.n_states[k]
+            slices.append(sl)
+
+            K_k = np.array(K_k, dtype=np.float64)
+            b_k = np.zeros(K_k.shape[0])
+            if hasattr(decoder, 'zscore') and decoder.zscore:
+                # K*((y - mFR)/sdFR), with the z-scored observation of each zero-mean unit replaced by its mean
+                mFR = np.asarray(decoder.mFR, dtype=np.float64).ravel()
+                zeromean = np.zeros(len(mFR), dtype=bool)
+                zeromean[decoder.zeromeanunits] = True
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    K_z = K_k * (1./np.asarray(decoder.sdFR, dtype=np.float64).ravel())
+                K_z[:, zeromean] = 0
+                b_k = -np.dot(K_z, mFR) + np.dot(K_k[:, zeromean], mFR[zeromean])
+                K_k = K_z
+
+            F[sl, sl] = F_k
+            K[sl, self.feature_inds[k]] = K_k
+            b[sl] = b_k
+            x[sl] = np.asarray(decoder.filt.state.mean).ravel()
+            if hasattr(decoder, 'bounder'):
+                bounded.append((sl, decoder.bounder, decoder.states))
+
+        self._stacked = stacked
+        self._stack_slices = slices
+        self._stack_bounded = bounded
+        self._stack_rows = np.hstack([[k]*self.n_states[k] for k in stacked] + [[]]).astype(int)
+        self._stack_cols = np.hstack([np.arange(self.n_states[k]) for k in stacked] + [[]]).astype(int)
+        self._F, self._K, self._b, self._x = F, K, b, x
+
+    def _run_stack(self):
+        '''
+        Run the stacked decoders on all the queued observations
+        '''
+        Y = np.vstack(self._stack_queue).T
+        self._stack_queue = []
+        Ky = (np.dot(self._K, Y) + self._b[:,np.newaxis]).T
+
+        F, x = self._F, self._x
+        for t in range(Ky.shape[0]):
+            x = np.dot(F, x) + Ky[t]
+            for sl, bounder, states in self._stack_bounded:
+                x[sl] = np.asarray(bounder(np.mat(x[sl].reshape(-1,1)), states)).ravel()
+        self._x = x
+        self.states[self._stack_rows, self._stack_cols] = x
+
+    def run(self, decoded_obs):
+        '''
+        Run the shadow decoders on new observations. Called once per cycle of the task, after the plant has been driven
+
+        Parameters
+        ----------
+        decoded_obs : list of np.ndarray
+            Observations decoded by the live decoder since the last call, each of shape (n_features,)
+
+        Returns
+        -------
+        np.ndarray of shape (n_decoders, max_n_states)
+            Most recent state of each decoder, padded with NaN's
+        '''
+        t_start = time.time()
+        stacked = set(self._stacked)
+        for obs in decoded_obs:
+            obs = np.asarray(obs, dtype=np.float64).ravel()
+            if len(stacked) > 0:
+                self._stack_queue.append(obs)
+            for k, queue in enumerate(self._queues):
+                if k in stacked:
+                    continue
+                if len(queue) >= self.max_backlog:
+                    queue.popleft()
+                    self.n_skipped[k] += 1
+                queue.append(obs)
+
+        if len(self._stack_queue) > 0:
+            self._run_stack()
+
+        # run the other decoders, one observation at a time in turn, for as long as the budget allows
+        pending = [k for k, queue in enumerate(self._queues) if len(queue) > 0]
+        while len(pending) > 0 and time.time() - t_start < self.time_budget:
+            for k in pending:
+                decoder = self.decoders[k]
+                decoder.predict(self._queues[k].popleft()[self.feature_inds[k]])
+                self.states[k, :self.n_states[k]] = np.asarray(decoder.filt.get_mean()).ravel()
+                if time.time() - t_start >= self.time_budget:
+                    break
+            pending = [k for k in pending if len(self._queues[k]) > 0]
+
+        # decoders which have caught up and reached steady state join the stack
+        for k in range(len(self.decoders)):
+            if k not in stacked and len(self._queues[k]) == 0 and self._steady_state_gains(k) is not None:
+                self._build_stack()
+                break
+        return self.states
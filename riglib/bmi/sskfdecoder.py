@@ -94,6 +94,12 @@ class SteadyStateKalmanFilter(bmi.GaussianStateHMM):
         '''
         return self.F, self.K
 
+    def get_steady_state_gains(self):
+        '''
+        Gains of the update x_t = F*x_{t-1} + K*y_t, as np.ndarrays. Used by Decoder.decode_batch
+        '''
+        return np.asarray(self.F), np.asarray(self.K)
+
     def _forward_infer(self, st, obs_t, Bu=None, u=None, target_state=None, 
                        obs_is_control_independent=True, bias_comp=False, **kwargs):
         '''
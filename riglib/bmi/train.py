@@ -11,6 +11,8 @@ from riglib.dio import parse
 
 import tables
 import kfdecoder, ppfdecoder
+import decoder_store
+import hdf_access
 import pdb
 import state_space_models
 from itertools import izip
@@ -58,7 +60,12 @@ FAKE_BLACKROCK_TMASK = False
 ########################################
 ## Neural data synchronization functions
 ########################################
-def _get_tmask(files, tslice, sys_name='task'):
+def _get_tmask(files, tslice, sys_name='task', cache=None):
+    if cache is not None:
+        from feature_cache import file_identity
+        key = ('tmask', file_identity(files), tslice, sys_name, FAKE_BLACKROCK_TMASK)
+        return cache.get(key, _get_tmask, files, tslice, sys_name=sys_name)
+
     if 'plexon' in files:
         fn = _get_tmask_plexon
         fname = str(files['plexon'])
@@ -154,14 +161,14 @@ def _get_tmask_blackrock(nev_fname, tslice, sys_name='task'):
         
     #import h5py
     #nev_hdf = h5py.File(nev_hdf_fname, 'r')
-    nev_hdf = tables.openFile(nev_hdf_fname)
-
     #path = 'channel/digital00001/digital_set'
     #ts = nev_hdf.get(path).value['TimeStamp']
     #msgs = nev_hdf.get(path).value['Value']
 
-    ts = nev_hdf.root.channel.digital0001.digital_set[:]['TimeStamp']
-    msgs = nev_hdf.root.channel.digital0001.digital_set[:]['Value'] + 2**16
+    with hdf_access.open_hdf(nev_hdf_fname) as nev_hdf:
+        digital_set = nev_hdf.root.channel.digital0001.digital_set
+        ts = hdf_access.read_column(digital_set, 'TimeStamp')
+        msgs = hdf_access.read_column(digital_set, 'Value') + 2**16
 
     msgtype = np.right_shift(np.bitwise_and(msgs, parse.msgtype_mask), 8).astype(np.uint8)
     # auxdata = np.right_shift(np.bitwise_and(msgs, auxdata_mask), 8).astype(np.uint8)
@@ -210,9 +217,8 @@ def _get_tmask_blackrock_fake(hdf_fname, tslice, **kwargs):
     
     binlen = 0.1
     strobe_rate = 10
-    hdf = tables.openFile(hdf_fname)
-
-    n_rows = hdf.root.task[:]['plant_pos'].shape[0]
+    with hdf_access.open_hdf(hdf_fname) as hdf:
+        n_rows = hdf.root.task.nrows
     first_ts = binlen
     rows = np.linspace(first_ts, first_ts + (n_rows-1)*(1./strobe_rate), num=n_rows)
     lower, upper = 0 < rows, rows < rows.max() + 1
@@ -254,8 +260,6 @@ def _get_neural_features_plx(files, binlen, extractor_fn, extractor_kwargs, tsli
         Keyword arguments used to construct the feature extractor used online
     '''
 
-    hdf = tables.openFile(files['hdf'])
-
     plx_fname = str(files['plexon']) 
     from plexon import plexfile
     try:
@@ -308,18 +312,45 @@ def _get_neural_features_blackrock(files, binlen, extractor_fn, extractor_kwargs
 def _get_neural_features_tdt(files, binlen, extractor_fn, extractor_kwargs, tslice=None, units=None, source='task', strobe_rate=10.):
     raise NotImplementedError
 
-def get_neural_features(files, binlen, extractor_fn, extractor_kwargs, units=None, tslice=None, source='task', strobe_rate=60):
+def get_neural_features(files, binlen, extractor_fn, extractor_kwargs, units=None, tslice=None, source='task', strobe_rate=60, cache=None):
     '''
-    Docstring
+    Extract the neural features used to train the decoder from the neural data files of a block
 
     Parameters
     ----------
+    files: dict
+        keys of the dictionary are file-types (e.g., hdf, plexon, etc.), values are file names
+    binlen: float
+        Specifies the temporal resolution of the feature extraction
+    extractor_fn: callable
+        Typically the 'extract_from_file' method of the feature extractor class
+    extractor_kwargs: dictionary
+        Additional keyword arguments to the extractor_fn (specific to each feature extractor)
+    units: np.ndarray of shape (N, 2), optional, default=None
+        Units (or channels) to extract features from. All units are used if None
+    tslice: iterable of length 2, optional, default=None
+        Start and end times of the training data to use
+    source: string, optional, default='task'
+        Name of the system whose sync events give the times of the feature bins
+    strobe_rate: float, optional, default=60
+        Rate of the sync events
+    cache: feature_cache.FeatureCache instance, optional, default=None
+        If specified, the features are loaded from (or stored in) the cache
 
     Returns
     -------
+    neural_features: np.ndarray of shape (n_timepoints, n_features)
+        Values of each feature to be used in training the decoder parameters
+    units: np.ndarray of shape (N, -1)
+        Specifies identty of each neural feature
+    extractor_kwargs: dictionary
+        Keyword arguments used to construct the feature extractor used online
     '''
-    
-    hdf = tables.openFile(files['hdf'])
+    if cache is not None:
+        from feature_cache import file_identity
+        key = ('neural_features', file_identity(files), extractor_fn, extractor_kwargs, binlen, tslice, units, source, strobe_rate)
+        return cache.get(key, get_neural_features, files, binlen, extractor_fn, extractor_kwargs, 
+            units=units, tslice=tslice, source=source, strobe_rate=strobe_rate)
 
     if 'plexon' in files:
         fn = _get_neural_features_plx
@@ -339,8 +370,8 @@ def get_neural_features(files, binlen, extractor_fn, extractor_kwargs, units=Non
 ## Kinematic data retrieval
 ################################################################################
 def null_kin_extractor(files, binlen, tmask, update_rate_hz=60., pos_key='cursor', vel_key=None):
-    hdf = tables.openFile(files['hdf'])    
-    kin = np.squeeze(hdf.root.task[:][pos_key])
+    with hdf_access.open_hdf(files['hdf']) as hdf:
+        kin = np.squeeze(hdf_access.read_column(hdf.root.task, pos_key))
 
     inds, = np.nonzero(tmask)
     step_fl = binlen/(1./update_rate_hz)
@@ -372,50 +403,43 @@ def get_plant_pos_vel(files, binlen, tmask, update_rate_hz=60., pos_key='cursor'
     if pos_key == 'plant_pos':  # used for ibmi tasks
         vel_key = 'plant_vel'
 
-    hdf = tables.openFile(files['hdf'])    
-    kin = hdf.root.task[:][pos_key]
-
     inds, = np.nonzero(tmask)
     step_fl = binlen/(1./update_rate_hz)
-    if step_fl < 1: # more than one spike bin per kinematic obs
-        if vel_key is not None:
-            velocity = hdf.root.task[:][vel_key]
-        else:
-            velocity = np.diff(kin, axis=0) * update_rate_hz
-            velocity = np.vstack([np.zeros(kin.shape[1]), velocity])
-        kin = np.hstack([kin, velocity])
-
-        n_repeats = int((1./update_rate_hz)/binlen)
-        inds = np.sort(np.hstack([inds]*n_repeats))
-        kin = kin[inds]
-    else:
-        step = int(binlen/(1./update_rate_hz))
-        inds = inds[::step]
-        try:
-            kin = kin[inds]
+    with hdf_access.open_hdf(files['hdf']) as hdf:
+        task = hdf.root.task
+        if step_fl < 1: # more than one spike bin per kinematic obs
+            # only the rows in the tslice are read, plus the row before them for the velocity
+            start = max(inds.min() - 1, 0) if len(inds) > 0 else 0
+            stop = inds.max() + 1 if len(inds) > 0 else 0
+            kin = hdf_access.read_column(task, pos_key, start=start, stop=stop)
             if vel_key is not None:
-                velocity = hdf.root.task[inds][vel_key]
+                velocity = hdf_access.read_column(task, vel_key, start=start, stop=stop)
             else:
-                velocity = np.diff(kin, axis=0) * 1./binlen
-                velocity = np.vstack([np.zeros(kin.shape[1]), velocity])        
+                velocity = np.diff(kin, axis=0) * update_rate_hz
+                velocity = np.vstack([np.zeros(kin.shape[1]), velocity])
+            kin = np.hstack([kin, velocity])
 
-        except: 
-            kin2 = np.zeros((len(inds), kin.shape[1]))
-            vel2 = np.zeros((len(inds), kin.shape[1]))
+            n_repeats = int((1./update_rate_hz)/binlen)
+            inds = np.sort(np.hstack([inds]*n_repeats))
+            kin = kin[inds - start]
+        else:
+            step = int(binlen/(1./update_rate_hz))
+            inds = inds[::step]
 
-            ix = np.nonzero(inds < len(kin))[0]
-            kin2[ix, :] = kin[inds[ix], :]
-            kin = kin2.copy()
+            # rows past the end of the table (if the neural data outlasts the task data) are filled with zeros
+            ix, = np.nonzero(inds < task.nrows)
+            kin_rows = hdf_access.read_column_rows(task, pos_key, inds[ix])
+            kin = np.zeros((len(inds),) + kin_rows.shape[1:], dtype=kin_rows.dtype)
+            kin[ix] = kin_rows
 
             if vel_key is not None:
-                vel2[ix, :] = hdf.root.task[inds[ix]][vel_key]
+                vel_rows = hdf_access.read_column_rows(task, vel_key, inds[ix])
+                velocity = np.zeros((len(inds),) + vel_rows.shape[1:], dtype=vel_rows.dtype)
+                velocity[ix] = vel_rows
             else:
-                vel2 = np.diff(kin, axis=0) * 1./binlen
-                vel2 = np.vstack([np.zeros(kin.shape[1]), vel2])    
-
-            velocity = vel2.copy()
-
-        kin = np.hstack([kin, velocity])
+                velocity = np.diff(kin, axis=0) * 1./binlen
+                velocity = np.vstack([np.zeros(kin.shape[1]), velocity])
+            kin = np.hstack([kin, velocity])
 
     return kin
 
@@ -549,8 +573,7 @@ def add_fa_dict_to_decoder(decoder_training_te, dec_ix, fa_te):
     from tasks.factor_analysis_tasks import FactorBMIBase
     FA_dict = FactorBMIBase.generate_FA_matrices(fa_te)
 
-    import pickle
-    dec = pickle.load(open(decoder_old.filename))
+    dec = decoder_store.load(decoder_old.filename)
     dec.trained_fa_dict = FA_dict
     dec_n_units = dec.n_units
 
@@ -639,7 +662,7 @@ def conv_KF_to_splitFA_dec(decoder_training_te, dec_ix, fa_te, search_suffix = '
         ix = te.path.find('_')
         if search_flag:
             if int(te.path[ix+1:ix+3]) == dec_ix:
-                decoder = pickle.load(open(te.filename))
+                decoder = decoder_store.load(te.filename)
                 if hasattr(decoder, 'trained_fa_dict'):
                     ix = te.path.find('w_fa_dict_from_')
                     if ix > 1:
@@ -653,7 +676,7 @@ def conv_KF_to_splitFA_dec(decoder_training_te, dec_ix, fa_te, search_suffix = '
     # else:
     print 'Using old decoder: ', decoder_old.path
 
-    decoder = pickle.load(open(decoder_old.filename))
+    decoder = decoder_store.load(decoder_old.filename)
     if hasattr(decoder, 'trained_fa_dict'):
         FA_dict = decoder.trained_fa_dict
     else:
@@ -715,7 +738,7 @@ def conv_KF_to_splitFA_dec(decoder_training_te, dec_ix, fa_te, search_suffix = '
 
 def train_KFDecoder(files, extractor_cls, extractor_kwargs, kin_extractor, ssm, units, update_rate=0.1, tslice=None, 
     kin_source='task', pos_key='cursor', vel_key=None, zscore=False, filter_kin=True, simple_lin_reg=False, 
-    use_data_kwargs=None, **kwargs):
+    use_data_kwargs=None, feature_cache=None, **kwargs):
     '''
     Create a new KFDecoder using maximum-likelihood, from kinematic observations and neural observations
 
@@ -746,6 +769,8 @@ def train_KFDecoder(files, extractor_cls, extractor_kwargs, kin_extractor, ssm,
         Column of HDF table to use for velocity data. Default is None; velocity is computed by single-step numerical differencing (or alternate method )
     zscore : Bool 
         Determines whether to zscore neural_data or not
+    feature_cache : feature_cache.FeatureCache instance, optional
+        If specified, the neural features and task timing are loaded from (or stored in) the cache. default=None
     kwargs:
         mFR: mean firing rate to use to zscore units
         sdFR: standard dev. to use to zscore units
@@ -764,18 +789,20 @@ def train_KFDecoder(files, extractor_cls, extractor_kwargs, kin_extractor, ssm,
 
     from config import config
 
-    ## get kinematic data
-    tmask, rows = _get_tmask(files, tslice, sys_name=kin_source)
-    kin = kin_extractor(files, binlen, tmask, pos_key=pos_key, vel_key=vel_key, update_rate_hz=config.hdf_update_rate_hz)
+    # the HDF files read by the helpers below are opened once and closed when done
+    with hdf_access.session():
+        ## get kinematic data
+        tmask, rows = _get_tmask(files, tslice, sys_name=kin_source, cache=feature_cache)
+        kin = kin_extractor(files, binlen, tmask, pos_key=pos_key, vel_key=vel_key, update_rate_hz=config.hdf_update_rate_hz)
 
-    ## get neural features
-    if 'blackrock' in files.keys():
-        strobe_rate = 20.
-    else:
-        strobe_rate = 60.
+        ## get neural features
+        if 'blackrock' in files.keys():
+            strobe_rate = 20.
+        else:
+            strobe_rate = 60.
 
-    neural_features, units, extractor_kwargs = get_neural_features(files, binlen, extractor_cls.extract_from_file, 
-        extractor_kwargs, tslice=tslice, units=units, source=kin_source, strobe_rate=strobe_rate)
+        neural_features, units, extractor_kwargs = get_neural_features(files, binlen, extractor_cls.extract_from_file, 
+            extractor_kwargs, tslice=tslice, units=units, source=kin_source, strobe_rate=strobe_rate, cache=feature_cache)
 
     # Remove 1st kinematic sample and last neural features sample to align the 
     # velocity with the neural features
@@ -882,13 +909,14 @@ def train_KFDecoderDrift(files, extractor_cls, extractor_kwargs, kin_extractor,
 
     from config import config
 
-    ## get kinematic data
-    tmask, rows = _get_tmask(files, tslice, sys_name=kin_source)
-    kin = kin_extractor(files, binlen, tmask, pos_key=pos_key, vel_key=vel_key, update_rate_hz=config.hdf_update_rate_hz)
+    with hdf_access.session():
+        ## get kinematic data
+        tmask, rows = _get_tmask(files, tslice, sys_name=kin_source)
+        kin = kin_extractor(files, binlen, tmask, pos_key=pos_key, vel_key=vel_key, update_rate_hz=config.hdf_update_rate_hz)
 
-    ## get neural features
-    neural_features, units, extractor_kwargs = get_neural_features(files, binlen, extractor_cls.extract_from_file, 
-        extractor_kwargs, tslice=tslice, units=units, source=kin_source)
+        ## get neural features
+        neural_features, units, extractor_kwargs = get_neural_features(files, binlen, extractor_cls.extract_from_file, 
+            extractor_kwargs, tslice=tslice, units=units, source=kin_source)
 
     # Remove 1st kinematic sample and last neural features sample to align the 
     # velocity with the neural features
@@ -905,7 +933,15 @@ def train_KFDecoderDrift(files, extractor_cls, extractor_kwargs, kin_extractor,
     return decoder
 
 def train_KFDecoder_abstract(ssm, kin, neural_features, units, update_rate, tslice=None, regularizer=0., 
-    zscore=False, **kwargs):
+    zscore=False, cv_regularizers=None, cv_folds=5, cv_score='loglik', n_processes=1, **kwargs):
+    '''
+    Create a new KFDecoder from kinematics and neural features
+
+    If 'cv_regularizers' is specified, the regularizer of the observation model is chosen from 
+    those values by cross-validation (see cross_validation.cross_validate_kf), with the folds 
+    evaluated in 'n_processes' processes, and the score table is saved as the 'cv_scores' 
+    attribute of the decoder. Otherwise 'regularizer' is used.
+    '''
     print kwargs
     print 'end of kwargs'
     
@@ -951,6 +987,16 @@ def train_KFDecoder_abstract(ssm, kin, neural_features, units, update_rate, tsli
 
     n_features = len(mFR)
 
+    cv_scores = None
+    if cv_regularizers is not None:
+        import cross_validation
+        cv_scores = cross_validation.cross_validate_kf(ssm, kin, neural_features, update_rate, regularizers=cv_regularizers, 
+            n_folds=cv_folds, score=cv_score, n_processes=n_processes)
+        regularizer = cross_validation.best_regularizer(cv_scores)
+        for row in cv_scores:
+            print 'regularizer %g: score %g +/- %g' % (row['regularizer'], row['mean_score'], row['std_score'])
+        print 'cross-validated regularizer:', regularizer
+
     # C should be trained on all of the stochastic state variables, excluding the offset terms
     C = np.zeros((n_features, ssm.n_states))
     C[:, ssm.drives_obs_inds], Q = kfdecoder.KalmanFilter.MLE_obs_model(kin[ssm.train_inds, :], neural_features, regularizer=regularizer)
@@ -995,13 +1041,15 @@ def train_KFDecoder_abstract(ssm, kin, neural_features, units, update_rate, tsli
     decoder.filt.noise_rej = kwargs['noise_rej']
     decoder.filt.noise_rej_cutoff = kwargs['noise_rej_cutoff']
     decoder.filt.noise_rej_mFR = mFR
+    if cv_scores is not None:
+        decoder.cv_scores = cv_scores
     # decoder.extractor_cls = extractor_cls
     # decoder.extractor_kwargs = extractor_kwargs
 
     return decoder
 
 def train_PPFDecoder(files, extractor_cls, extractor_kwargs, kin_extractor, ssm, units, update_rate=0.1, tslice=None, kin_source='task',
-    pos_key='cursor', vel_key=None, zscore=False):
+    pos_key='cursor', vel_key=None, zscore=False, feature_cache=None, n_processes=1):
     '''
     Create a new PPFDecoder using maximum-likelihood, from kinematic observations and neural observations
 
@@ -1030,6 +1078,10 @@ def train_PPFDecoder(files, extractor_cls, extractor_kwargs, kin_extractor, ssm,
         Column of HDF table to use for position data. Default is 'cursor', recognized options are {'cursor', 'joint_angles', 'plant_pos'}
     vel_key : string
         Column of HDF table to use for velocity data. Default is None; velocity is computed by single-step numerical differencing (or alternate method )
+    feature_cache : feature_cache.FeatureCache instance, optional
+        If specified, the neural features and task timing are loaded from (or stored in) the cache. default=None
+    n_processes : int, optional
+        Number of processes over which to split the per-unit GLM fits. default=1
 
     Returns
     -------
@@ -1037,26 +1089,28 @@ def train_PPFDecoder(files, extractor_cls, extractor_kwargs, kin_extractor, ssm,
     '''
     binlen = 1./180 #update_rate
 
-    ## get kinematic data
-    tmask, rows = _get_tmask(files, tslice, sys_name=kin_source)
-    kin = kin_extractor(files, binlen, tmask, pos_key=pos_key, vel_key=vel_key)
+    with hdf_access.session():
+        ## get kinematic data
+        tmask, rows = _get_tmask(files, tslice, sys_name=kin_source, cache=feature_cache)
+        kin = kin_extractor(files, binlen, tmask, pos_key=pos_key, vel_key=vel_key)
 
-    ## get neural features
-    neural_features, units, extractor_kwargs = get_neural_features(files, binlen, extractor_cls.extract_from_file, extractor_kwargs, tslice=tslice, units=units, source=kin_source)
+        ## get neural features
+        neural_features, units, extractor_kwargs = get_neural_features(files, binlen, extractor_cls.extract_from_file, extractor_kwargs, 
+            tslice=tslice, units=units, source=kin_source, cache=feature_cache)
 
     # Remove 1st kinematic sample and last neural features sample to align the 
     # velocity with the neural features
     kin = kin[1:].T
     neural_features = neural_features[:-1].T
 
-    decoder = train_PPFDecoder_abstract(ssm, kin, neural_features, units, update_rate, tslice=tslice)
+    decoder = train_PPFDecoder_abstract(ssm, kin, neural_features, units, update_rate, tslice=tslice, n_processes=n_processes)
 
     decoder.extractor_cls = extractor_cls
     decoder.extractor_kwargs = extractor_kwargs
 
     return decoder
 
-def train_PPFDecoder_abstract(ssm, kin, neural_features, units, update_rate, tslice=None):
+def train_PPFDecoder_abstract(ssm, kin, neural_features, units, update_rate, tslice=None, n_processes=1):
     binlen = 1./180 #update_rate
     # squash any spike counts greater than 1 (doesn't work with PPF model)
     neural_features[neural_features > 1] = 1
@@ -1066,7 +1120,8 @@ def train_PPFDecoder_abstract(ssm, kin, neural_features, units, update_rate, tsl
 
     # C should be trained on all of the stochastic state variables, excluding the offset terms
     C = np.zeros([n_features, ssm.n_states])
-    C[:, ssm.drives_obs_inds], pvals = ppfdecoder.PointProcessFilter.MLE_obs_model(kin[ssm.train_inds, :], neural_features)
+    C[:, ssm.drives_obs_inds], pvals = ppfdecoder.PointProcessFilter.MLE_obs_model(kin[ssm.train_inds, :], neural_features, 
+        n_processes=n_processes)
 
     # Set state space model
     A, B, W = ssm.get_ssm_matrices(update_rate=update_rate)
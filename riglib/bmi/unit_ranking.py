@@ -0,0 +1,181 @@
+'''
+Ranking of the units of a KF decoder by their contribution to decoding accuracy, e.g., for
+neuron-dropping curves or for choosing which units to keep (see kfdecoder.KFDecoder.subselect_units).
+
+The maximum-likelihood observation model of a subset of units is the corresponding rows of C and
+block of Q (each row of C = S*R^{-1} only depends on its own unit), so no refitting is needed to
+evaluate a unit subset. Removing unit i from the decoder changes the information matrix
+J = C^T Q^{-1} C by a rank-one term,
+
+    J_{-i} = J - (C^T p_i)(C^T p_i)^T / P_ii,    P = Q^{-1}, p_i = column i of P
+
+and P itself is updated by a rank-one downdate, so each step of a greedy ranking costs O(n_units^2)
+instead of a full retraining per candidate.
+'''
+import numpy as np
+
+
+def steady_state_error_cov(A, W, J, P_init=None, tol=1e-10, max_iter=2000):
+    '''
+    Steady-state posterior covariance of the KF state estimate, P = ((A*P*A^T + W)^{-1} + J)^{-1},
+    for one or more information matrices J = C^T Q^{-1} C
+
+    Parameters
+    ----------
+    A : np.ndarray of shape (n_states, n_states)
+        State transition matrix
+    W : np.ndarray of shape (n_states, n_states)
+        State noise covariance
+    J : np.ndarray of shape (n_states, n_states) or (n_models, n_states, n_states)
+        Information matrix of the observations, for each model
+    P_init : np.ndarray of shape (n_states, n_states), optional
+        Starting point of the Riccati iteration, e.g., the solution for a similar model. The
+        iteration converges fastest when starting below the solution. Defaults to zeros
+    tol : float, optional, default=1e-10
+        Convergence tolerance, relative to the largest element of P
+    max_iter : int, optional, default=2000
+        Maximum number of iterations
+
+    Returns
+    -------
+    np.ndarray of the same shape as J
+    '''
+    A = np.asarray(A, dtype=np.float64)
+    W = np.asarray(W, dtype=np.float64)
+    J = np.asarray(J, dtype=np.float64)
+    single = J.ndim == 2
+    if single:
+        J = J[np.newaxis]
+
+    n_states = A.shape[0]
+    I = np.eye(n_states)
+    P = np.zeros(J.shape)
+    if P_init is not None:
+        P += P_init
+
+    for k in range(max_iter):
+        P_pred = np.matmul(np.matmul(A, P), A.T) + W
+        # (P_pred^{-1} + J)^{-1}, without inverting P_pred, which is singular if W is
+        P_new = np.linalg.solve(I + np.matmul(P_pred, J), P_pred)
+        P_new = 0.5 * (P_new + np.swapaxes(P_new, -1, -2))
+        converged = np.max(np.abs(P_new - P)) <= tol * max(np.max(np.abs(P_new)), 1e-300)
+        P = P_new
+        if converged:
+            break
+
+    if single:
+        P = P[0]
+    return P
+
+
+def rank_units(decoder, target_states=None, refresh_interval=50):
+    '''
+    Rank the units of a KF decoder by greedy backward elimination: the unit whose removal increases
+    the decoding error the least is removed first, until one unit is left.
+
+    The decoding error is the model-predicted steady-state error variance of the decoder, averaged
+    over the target states, computed for the states which drive the observations (e.g., velocity
+    and offset). Positions which are integrated from those states have unbounded error and are not used.
+
+    Parameters
+    ----------
+    decoder : kfdecoder.KFDecoder instance
+        Decoder to rank the units of
+    target_states : list of string, optional
+        Names of the states whose error is minimized. Defaults to the stochastic states which drive
+        the observations (e.g., the velocity states)
+    refresh_interval : int, optional, default=50
+        Number of rank-one downdates after which Q^{-1} and C^T Q^{-1} C are recomputed from scratch, to
+        keep round-off errors from accumulating
+
+    Returns
+    -------
+    ranked_units : np.ndarray of shape (n_units, 2)
+        Units of the decoder, most important first. decoder.subselect_units(ranked_units[:k]) gives the best k-unit decoder found
+    info : dict
+        'n_units' and 'error': the neuron-dropping curve, i.e., decoding error with the n best units.
+        'contribution': increase in error when each unit (in the order of decoder.units) is removed from the full decoder.
+        'incremental_contribution': increase in error when each unit was removed during the elimination (inf for the last unit)
+    '''
+    ssm = decoder.ssm
+    filt = decoder.filt
+    A = np.asarray(filt.A, dtype=np.float64)
+    W = np.asarray(filt.W, dtype=np.float64)
+    C_full = np.asarray(filt.C, dtype=np.float64)
+    Q = np.asarray(filt.Q, dtype=np.float64)
+    n_units = C_full.shape[0]
+
+    # states which drive the observations, if their dynamics do not depend on the other states
+    sub = np.array(ssm.drives_obs_inds)
+    others = np.setdiff1d(np.arange(A.shape[0]), sub)
+    if len(others) > 0 and np.any(A[np.ix_(sub, others)] != 0):
+        sub = np.arange(A.shape[0])
+    A_s = A[np.ix_(sub, sub)]
+    W_s = W[np.ix_(sub, sub)]
+    C = C_full[:, sub]
+
+    if target_states is None:
+        target_inds = [k for k in ssm.train_inds if k in sub]
+    else:
+        target_inds = [list(ssm.state_names).index(name) for name in target_states]
+    target = np.array([list(sub).index(k) for k in target_inds])
+
+    def error(P):
+        return np.mean(np.diagonal(P, axis1=-2, axis2=-1)[..., target], axis=-1)
+
+    remaining = np.ones(n_units, dtype=bool)
+    def refresh():
+        # P = Q^{-1} of the remaining units, zero for the removed units
+        inds = np.nonzero(remaining)[0]
+        P = np.zeros([n_units, n_units])
+        P[np.ix_(inds, inds)] = np.linalg.pinv(Q[np.ix_(inds, inds)])
+        G = np.dot(C.T, P)
+        return P, G, np.dot(G, C)
+
+    P, G, J = refresh()
+    P_post = steady_state_error_cov(A_s, W_s, J)
+    err = error(P_post)
+
+    removal_order = []
+    errors = [err]
+    contribution = None
+    incremental_contribution = np.zeros(n_units)
+    for step in range(n_units - 1):
+        inds = np.nonzero(remaining)[0]
+        V = G[:, inds] / np.sqrt(np.diag(P)[inds])
+        J_cand = J - np.einsum('ik,jk->kij', V, V)
+        # removing a unit only increases the error, so the iteration starts below the solution
+        P_post_cand = steady_state_error_cov(A_s, W_s, J_cand, P_init=P_post)
+        err_cand = error(P_post_cand)
+        if contribution is None:
+            contribution = np.zeros(n_units)
+            contribution[inds] = err_cand - err
+
+        best = np.argmin(err_cand)
+        i = inds[best]
+        incremental_contribution[i] = err_cand[best] - err
+        removal_order.append(i)
+        remaining[i] = False
+        err = err_cand[best]
+        errors.append(err)
+        P_post = P_post_cand[best]
+
+        if (step + 1) % refresh_interval == 0:
+            P, G, J = refresh()
+        else:
+            p_i = P[:, i].copy()
+            G -= np.outer(G[:, i], p_i) / p_i[i]
+            P -= np.outer(p_i, p_i) / p_i[i]
+            P[i, :] = 0
+            P[:, i] = 0
+            J = J - np.outer(V[:, best], V[:, best])
+
+    last = np.nonzero(remaining)[0]
+    order = np.hstack([last, removal_order[::-1]]).astype(int)
+    if contribution is None:
+        contribution = np.zeros(n_units)
+    incremental_contribution[last] = np.inf
+
+    info = dict(n_units=np.arange(n_units, 0, -1), error=np.array(errors), contribution=contribution,
+        incremental_contribution=incremental_contribution)
+    return np.asarray(decoder.units)[order], info
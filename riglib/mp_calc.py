@@ -9,6 +9,7 @@ class MPCompute(mp.Process):
     Generic class for running computations that occur infrequently
     but take longer than a single BMI loop iteration
     """
+    poll_interval = 1. # seconds between checks of the 'done' flag while waiting for a job
     def __init__(self, work_queue, result_queue, fn):
         '''
         Constructor for MPCompute
@@ -34,18 +35,18 @@ class MPCompute(mp.Process):
 
     def _check_for_job(self):
         '''
-        Non-blocking check to see if data is present in the input queue
+        Wait for data to be present in the input queue. Returns None if no job arrives within 'poll_interval'
         '''
         try:
-            job = self.work_queue.get_nowait()
-        except:
+            job = self.work_queue.get(True, self.poll_interval)
+        except Queue.Empty:
             job = None
         return job
         
     def run(self):
         '''
         The main loop. Starts automatically when the process is spawned. See mp.Process.run for additional docs.
-        Every 0.5 seconds, check for new computation to carry out
+        Blocks on the input queue, so a job is started as soon as it is queued
 
         Parameters
         ----------
@@ -59,12 +60,23 @@ class MPCompute(mp.Process):
             job = self._check_for_job()
 
             # unpack the data
-            if not (job is None):
-                new_params = self.calc(*job[0], **job[1])
-                self.result_queue.put(new_params)
+            if not (job is None) and not self.done.is_set():
+                output = self.process_job(job)
+                self.result_queue.put(output)
+                self.after_job(output)
 
-            # Pause to lower the process's effective priority
-            time.sleep(0.5)
+    def process_job(self, job):
+        '''
+        Run the computation for one job from the input queue and return what to put on the result queue
+        '''
+        return self.calc(*job[0], **job[1])
+
+    def after_job(self, output):
+        '''
+        Run after the output of a job has been put on the result queue, so that any bookkeeping 
+        here does not delay the result. Does nothing by default
+        '''
+        pass
 
     def calc(self, *args, **kwargs):
         '''
@@ -77,6 +89,173 @@ class MPCompute(mp.Process):
         Set the flag to stop the 'while' loop in the 'run' method gracefully
         '''
         self.done.set()
+        try:
+            # wake up the process if it is waiting for a job
+            self.work_queue.put(None)
+        except Exception:
+            pass
+
+
+class SharedArrayPool(object):
+    '''
+    Preallocated shared-memory buffers for handing named arrays to a child process without pickling them. 
+    Must be created before the child process is started. There are 'n_slots' sets of buffers so that 
+    a new set of arrays can be written while the child is still reading the previous one.
+    '''
+    def __init__(self, shapes, n_slots=2):
+        '''
+        Constructor for SharedArrayPool
+
+        Parameters
+        ----------
+        shapes : dict
+            Keys are array names, values are the largest shape (n_rows, n_cols) of each array. 
+            Arrays with the same number of rows and fewer columns also fit.
+        n_slots : int, optional, default=2
+            Number of sets of buffers
+
+        Returns
+        -------
+        SharedArrayPool instance
+        '''
+        self.shapes = dict((name, tuple(shape)) for name, shape in shapes.items())
+        # 8 bytes per element, enough for any numeric dtype except complex
+        self._bufs = [dict((name, mp.RawArray('b', int(np.prod(shape))*8)) for name, shape in self.shapes.items())
+                      for k in range(n_slots)]
+        self._free = range(n_slots)
+
+    def put(self, arrays):
+        '''
+        Copy arrays into a free set of buffers
+
+        Parameters
+        ----------
+        arrays : dict
+            Keys are array names (keys of 'shapes'), values are 2D arrays
+
+        Returns
+        -------
+        slot : int or None
+            Index of the buffers used, or None if no buffers are free or the arrays do not fit
+        layout : dict or None
+            Description of the arrays for 'get'
+        '''
+        if len(self._free) == 0:
+            return None, None
+
+        layout = dict()
+        for name, arr in arrays.items():
+            arr = np.asanyarray(arr)
+            if name not in self.shapes or arr.ndim != 2 or arr.shape[0] != self.shapes[name][0] or \
+                arr.shape[1] > self.shapes[name][1] or arr.dtype.itemsize > 8 or arr.dtype.hasobject:
+                return None, None
+            layout[name] = (arr.shape, arr.dtype.str, isinstance(arr, np.matrix))
+
+        slot = self._free.pop(0)
+        for name, arr in arrays.items():
+            shape, dtype, is_matrix = layout[name]
+            self._view(slot, name, shape, dtype)[:] = arr
+        return slot, layout
+
+    def _view(self, slot, name, shape, dtype):
+        n = int(np.prod(shape))
+        return np.frombuffer(self._bufs[slot][name], dtype=dtype, count=n).reshape(shape)
+
+    def get(self, slot, layout):
+        '''
+        Views of arrays written by 'put' (in either process). The views are only valid until the slot is released
+
+        Returns
+        -------
+        dict
+        '''
+        arrays = dict()
+        for name, (shape, dtype, is_matrix) in layout.items():
+            arr = self._view(slot, name, shape, dtype)
+            arrays[name] = arr.view(np.matrix) if is_matrix else arr
+        return arrays
+
+    def release(self, slot):
+        '''
+        Mark a set of buffers as free to be re-used, once the child process is done with them
+        '''
+        if slot is not None and slot not in self._free:
+            self._free.append(slot)
+
+
+class SharedBatchCompute(MPCompute):
+    '''
+    MPCompute for functions which are run on batches of data, e.g., CLDA updates. Large arrays are 
+    passed through a SharedArrayPool instead of being pickled, and objects which the function needs 
+    for every job (e.g., the decoder) are handed to the process once, when it is started.
+
+    Jobs are (slot, layout, args, kwargs, submit_time) tuples, see 'submit'. Results are dicts with the 
+    keys 'result', 'slot', 't_submit', 't_start' and 't_done'.
+    '''
+    def __init__(self, work_queue, result_queue, fn, arrays, registered=None, on_result=None):
+        '''
+        Constructor for SharedBatchCompute
+
+        Parameters
+        ----------
+        work_queue : mp.Queue
+            Jobs start when an entry is found in work_queue
+        result_queue : mp.Queue
+            Results of job are placed back onto result_queue
+        fn : callable
+            Function to run on each batch
+        arrays : SharedArrayPool
+            Buffers for the large arrays of each batch
+        registered : dict, optional
+            Keyword arguments given to 'fn' for every job. These live in the child process, 
+            so changes made to them by 'fn' or 'on_result' persist between jobs
+        on_result : callable, optional
+            Called in the child process as on_result(result, **registered) after the result of each 
+            job has been sent to the parent, e.g., to keep the registered objects in sync with the 
+            parent process
+
+        Returns
+        -------
+        SharedBatchCompute instance
+        '''
+        super(SharedBatchCompute, self).__init__(work_queue, result_queue, fn)
+        self.arrays = arrays
+        self.registered = registered if registered is not None else dict()
+        self.on_result = on_result
+
+    def submit(self, arrays, *args, **kwargs):
+        '''
+        Queue a job from the parent process. The arrays are copied into free shared buffers if 
+        possible, and are otherwise sent through the queue with the other arguments.
+
+        Parameters
+        ----------
+        arrays : dict
+            Large arrays to pass to 'fn' as keyword arguments
+        *args, **kwargs : optional positional/keyword arguments
+            Other arguments to 'fn'
+
+        Returns
+        -------
+        None
+        '''
+        slot, layout = self.arrays.put(arrays)
+        if slot is None:
+            kwargs.update(arrays)
+        self.work_queue.put((slot, layout, args, kwargs, time.time()))
+
+    def process_job(self, job):
+        slot, layout, args, kwargs, t_submit = job
+        t_start = time.time()
+        if slot is not None:
+            kwargs.update(self.arrays.get(slot, layout))
+        kwargs.update(self.registered)
+        result = self.calc(*args, **kwargs)
+        return dict(result=result, slot=slot, t_submit=t_submit, t_start=t_start, t_done=time.time())
+
+    def after_job(self, output):
+        if self.on_result is not None:
+            self.on_result(output['result'], **self.registered)
 
 
 class FuncProxy(object):
@@ -153,29 +332,35 @@ class FuncProxy(object):
         -------
         '''
         args, kwargs = stuff
-        if self.prev_input == None:
+        if self.prev_input is None:
             return False
 
-        args_same = True
-        for a1, a2 in izip(args, self.prev_input[0]):
-            try: 
-                args_same = args_same and np.all(a1 == a2)
-            except ValueError:
-                args_same = args_same and np.array_equal(a1, a2)
+        prev_args, prev_kwargs = self.prev_input
+        if len(args) != len(prev_args) or set(kwargs.keys()) != set(prev_kwargs.keys()):
+            return False
 
-        kwargs_same = kwargs.keys() == self.prev_input[1].keys()
+        # stop at the first difference
+        for a1, a2 in izip(args, prev_args):
+            if not self._same(a1, a2):
+                return False
 
-        for key1, key2 in izip(kwargs.keys(), self.prev_input[1].keys()):
-            k1 = kwargs[key1]
-            k2 = kwargs[key2]
-            if key1 == 'q_start': 
+        for key in kwargs:
+            if key == 'q_start':
                 continue
-            try:
-                kwargs_same = kwargs_same and np.all(k1 == k2)
-            except:
-                kwargs_same = kwargs_same and np.array_equal(k1, k2)
-
-        return args_same and kwargs_same
+            if not self._same(kwargs[key], prev_kwargs[key]):
+                return False
+        return True
+
+    @staticmethod
+    def _same(a1, a2):
+        if a1 is a2:
+            return True
+        if isinstance(a1, np.ndarray) or isinstance(a2, np.ndarray):
+            return np.shape(a1) == np.shape(a2) and np.array_equal(a1, a2)
+        try:
+            return bool(np.all(a1 == a2))
+        except ValueError:
+            return np.array_equal(a1, a2)
 
 
     def __call__(self, *args, **kwargs):
@@ -78,6 +78,57 @@ class Spikes(DataSourceSystem):
         return np.array([(d.ts / self.update_freq, d.chan, d.unit, d.arrival_ts)], dtype=self.dtype)
 
 
+class SpikeWaveforms(Spikes):
+    '''
+    Client for spike timestamps and waveforms streamed from plexon system, compatible with riglib.source.DataSource. 
+    Used by extractors which classify spikes online from their waveforms (e.g., riglib.bmi.extractor.WaveformClusterCountExtractor). 
+    Waveforms are in raw A/D units (not divided by the channel gain, as in riglib.plexon.plexfile)
+    '''
+    n_wf_pts = 32
+    dtype = np.dtype([("ts", np.float), ("chan", np.int32), ("unit", np.int32), ("arrival_ts", np.float64), 
+        ("waveform", np.float64, (n_wf_pts,))])
+
+    def __init__(self, addr=PL_ADDR, channels=None):
+        '''
+        Constructor for plexon.SpikeWaveforms
+
+        Parameters
+        ----------
+        addr: tuple of length 2
+            (IP address, UDP port)
+        channels: optional, default = None
+            list of channels (electrodes) from which to receive spike data
+
+        Returns
+        -------
+        SpikeWaveforms instance
+        '''
+        self.conn = plexnet.Connection(*addr)
+        self.conn.connect(256, waveforms=True, analog=False)
+
+        try:
+            self.conn.select_spikes(channels, waveforms=True, unsorted=True)
+        except:
+            print "Cannot run select_spikes method; old system?"
+
+    def get(self):
+        '''
+        Return a single spike timestamp and waveform. Must be polled continuously for additional spike data. 
+        The polling is automatically taken care of by riglib.source.DataSource, whose 'get' method returns all 
+        the spikes (and waveforms) received since the last call as one batch
+        '''
+        d = self.data.next()
+        while d.type != PL_SingleWFType:
+            d = self.data.next()
+
+        waveform = np.zeros(self.n_wf_pts)
+        if d.waveform is not None:
+            n_pts = min(len(d.waveform), self.n_wf_pts)
+            waveform[:n_pts] = d.waveform[:n_pts]
+
+        return np.array([(d.ts / self.update_freq, d.chan, d.unit, d.arrival_ts, waveform)], dtype=self.dtype)
+
+
 class LFP(DataSourceSystem):
     '''
     Client for local field potential data streamed from plexon system, compatible with riglib.source.MultiChanDataSource
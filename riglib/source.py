@@ -61,6 +61,144 @@ class FuncProxy(object):
 # NOTE: this import MUST be after the defintion of FuncProxy
 import sink
 
+
+class FeatureRing(object):
+    '''
+    Small shared-memory ring buffer of feature vectors (e.g., binned spike counts or LFP band power) 
+    computed by a feature extractor running inside a data source process. Each slot holds one 
+    record of the extractor's 'feature_dtype' along with the time at which it was computed.
+    '''
+    def __init__(self, feature_dtype, n_slots=16):
+        '''
+        Constructor for FeatureRing
+
+        Parameters
+        ----------
+        feature_dtype : tuple or list of tuples
+            Datatype of the extractor output, e.g., ('lfp_power', 'f8', (n_features, 1)) or a list of named fields
+        n_slots : int, optional, default=16
+            Number of feature vectors to keep
+
+        Returns
+        -------
+        FeatureRing instance
+        '''
+        if isinstance(feature_dtype, tuple):
+            feature_dtype = [feature_dtype]
+        self.dtype = np.dtype(feature_dtype)
+        self.n_slots = n_slots
+        self.lock = mp.Lock()
+        self.idx = shm.RawValue('l', 0)
+        self.ts = np.frombuffer(shm.RawArray('d', n_slots), dtype=np.float64)
+        self.data = np.frombuffer(shm.RawArray('c', n_slots * self.dtype.itemsize), dtype=self.dtype)
+        self.last_idx = 0
+
+    def put(self, features, ts):
+        '''
+        Write one feature vector into the ring. Called in the process running the extractor.
+
+        Parameters
+        ----------
+        features : dict
+            Output of the feature extractor, keyed by the field names of the feature dtype
+        ts : float
+            Time at which the features were computed
+
+        Returns
+        -------
+        None
+        '''
+        self.lock.acquire()
+        i = self.idx.value % self.n_slots
+        for name in self.dtype.names:
+            self.data[name][i] = features[name]
+        self.ts[i] = ts
+        self.idx.value += 1
+        self.lock.release()
+
+    def get_new(self):
+        '''
+        Retrieve the feature vectors written since the last call. If the reader falls more than 
+        'n_slots' vectors behind, only the most recent 'n_slots' are returned.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        data : np.ndarray of shape (n_new,)
+            Record array of the new feature vectors, oldest first
+        ts : np.ndarray of shape (n_new,)
+            Times at which the feature vectors were computed
+        '''
+        self.lock.acquire()
+        idx = self.idx.value
+        n_new = min(idx - self.last_idx, self.n_slots)
+        inds = np.arange(idx - n_new, idx) % self.n_slots
+        data = self.data[inds]
+        ts = self.ts[inds]
+        self.last_idx = idx
+        self.lock.release()
+        return data, ts
+
+
+class FeatureExtractionMixin(object):
+    '''
+    Runs a feature extractor inside the remote data source process. The extractor reads the 
+    raw data directly out of the source's ring buffer and publishes finished feature vectors 
+    to a FeatureRing, so the task process only has to read the latest feature vector.
+    '''
+    feature_extractor = None
+
+    def set_feature_extractor(self, extractor, interval, n_slots=16):
+        '''
+        Run 'extractor' in the source process every 'interval' seconds. Must be called before the source is started.
+
+        Parameters
+        ----------
+        extractor : callable
+            Feature extractor whose source is this data source, e.g., riglib.bmi.extractor.BinnedSpikeCountsExtractor
+        interval : float
+            Seconds between feature vectors, typically the update rate of the task
+        n_slots : int, optional, default=16
+            Number of feature vectors to keep in the shared ring
+
+        Returns
+        -------
+        FeatureRing instance
+        '''
+        if self.is_alive():
+            raise Exception("source: feature extractor must be set before the source is started")
+        self.feature_extractor = extractor
+        self.feature_interval = interval
+        self.features = FeatureRing(extractor.feature_dtype, n_slots=n_slots)
+        return self.features
+
+    def get_new_features(self):
+        '''
+        Retrieve the feature vectors computed in the source process since the last call. See FeatureRing.get_new
+        '''
+        if self.status.value <= 0:
+            raise Exception('\n\nError starting datasource: %s\n\n' % self.name)
+        return self.features.get_new()
+
+    def _update_features(self):
+        '''
+        Run the feature extractor if it is due. Called from the run loop in the *remote* process
+        '''
+        now = time.time()
+        if now < self._next_feature_time:
+            return
+        try:
+            self.features.put(self.feature_extractor(now), now)
+        except Exception as e:
+            print("source: exception running feature extractor")
+            traceback.print_exc()
+        # schedule on a fixed grid, but don't try to catch up on missed vectors
+        self._next_feature_time = max(self._next_feature_time + self.feature_interval, now)
+
+
 class DataSourceSystem(object):
     '''
     Abstract base class for use with the generic DataSource infrastructure. Requirements:
@@ -92,7 +230,7 @@ class DataSourceSystem(object):
         '''
         pass
 
-class DataSource(mp.Process):
+class DataSource(FeatureExtractionMixin, mp.Process):
     '''
     Generic single-channel data source
     '''
@@ -177,6 +315,7 @@ class DataSource(mp.Process):
 
         streaming = True
         size = self.slice_size
+        self._next_feature_time = time.time()
         while self.status.value > 0:
             if self.cmd_event.is_set(): # if a command has been sent from the main task
                 cmd, args, kwargs = self._pipe.recv()
@@ -221,6 +360,9 @@ class DataSource(mp.Process):
                     except Exception as e:
                         print("source.DataSource.run, exception saving data to ring buffer")
                         print(e)
+
+                if self.feature_extractor is not None:
+                    self._update_features()
             else:
                 time.sleep(.001)
 
@@ -345,7 +487,7 @@ class DataSource(mp.Process):
         raise AttributeError(attr)
 
 
-class MultiChanDataSource(mp.Process):
+class MultiChanDataSource(FeatureExtractionMixin, mp.Process):
     '''
     Multi-channel version of 'DataSource'
     '''
@@ -470,6 +612,7 @@ class MultiChanDataSource(mp.Process):
 
         streaming = True
         size = self.slice_size
+        self._next_feature_time = time.time()
         while self.status.value > 0:
             if self.cmd_event.is_set():
                 cmd, args, kwargs = self._pipe.recv()
@@ -588,6 +731,9 @@ class MultiChanDataSource(mp.Process):
                             self.next_send_idx.value = np.mod(idxs_to_send[-1] + 1, self.max_len)
 
                         self.lock.release()
+
+                if self.feature_extractor is not None:
+                    self._update_features()
             else:
                 time.sleep(.001)
         
@@ -0,0 +1,197 @@
+import os
+import time
+import signal
+import shutil
+import tempfile
+import threading
+import unittest
+
+from db import local_jobs
+
+####################################
+## Dummy jobs, run in the worker processes (module-level so that they can be pickled)
+####################################
+def log_call(log_fname, name, duration=0.):
+    with open(log_fname, 'a') as f:
+        f.write('%s start %f\n' % (name, time.time()))
+    time.sleep(duration)
+    with open(log_fname, 'a') as f:
+        f.write('%s end %f\n' % (name, time.time()))
+
+def fail_call(log_fname, name):
+    with open(log_fname, 'a') as f:
+        f.write('%s start %f\n' % (name, time.time()))
+    raise ValueError('dummy failure of %s' % name)
+
+def exit_call(log_fname, name, sig=None):
+    # the worker process dies without returning, as when it is killed for running out of memory
+    with open(log_fname, 'a') as f:
+        f.write('%s start %f\n' % (name, time.time()))
+    if sig is None:
+        os._exit(1)
+    os.kill(os.getpid(), sig)
+
+def call_arg(log_fname, name, fn):
+    fn(log_fname, name)
+
+def read_log(log_fname):
+    if not os.path.exists(log_fname):
+        return []
+    with open(log_fname) as f:
+        return [line.split() for line in f.readlines()]
+
+
+class TestLocalJobExecutor(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log_fname = os.path.join(self.tmp_dir, 'calls.log')
+        self.messages = []
+        self.notify_threads = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def notify(self, msg):
+        self.notify_threads.append(threading.current_thread())
+        self.messages.append(msg)
+
+    def calls(self, event='start'):
+        return [name for name, ev, t in read_log(self.log_fname) if ev == event]
+
+    def test_step_dedup(self):
+        executor = local_jobs.LocalJobExecutor(max_workers=2, notify=self.notify)
+        steps = [('cache:a', log_call, (self.log_fname, 'step_a', 0.2))]
+        job_ids = [executor.submit('job%d' % k, log_call, (self.log_fname, 'job%d' % k), steps=steps) for k in range(3)]
+        self.assertTrue(executor.wait(job_ids, timeout=30))
+        self.assertEqual(self.calls().count('step_a'), 1)
+        self.assertEqual(sorted(self.calls()), ['job0', 'job1', 'job2', 'step_a'])
+
+        # the jobs only start once the step has finished
+        log = read_log(self.log_fname)
+        t_step_end = [float(t) for name, ev, t in log if name == 'step_a' and ev == 'end'][0]
+        for name, ev, t in log:
+            if name.startswith('job'):
+                self.assertGreaterEqual(float(t), t_step_end)
+
+        # a completed step is not run again for a later job
+        job_id = executor.submit('job3', log_call, (self.log_fname, 'job3'), steps=steps)
+        self.assertTrue(executor.wait([job_id], timeout=30))
+        executor.shutdown()
+        self.assertEqual(self.calls().count('step_a'), 1)
+        self.assertTrue(all(executor.status(k) == 'done' for k in job_ids + [job_id]))
+
+    def test_failure(self):
+        executor = local_jobs.LocalJobExecutor(max_workers=2, notify=self.notify)
+        bad_steps = [('cache:b', fail_call, (self.log_fname, 'step_b'))]
+        failed_ids = [executor.submit('job%d' % k, log_call, (self.log_fname, 'job%d' % k), steps=bad_steps) for k in range(2)]
+        failed_job = executor.submit('bad_job', fail_call, (self.log_fname, 'bad_job'))
+        self.assertTrue(executor.wait(timeout=30))
+
+        # the jobs waiting for the failed step fail without running, and get the step's traceback
+        for job_id in failed_ids:
+            self.assertEqual(executor.status(job_id), 'failed')
+            self.assertIn('ValueError: dummy failure of step_b', executor.jobs[job_id]['error'])
+        self.assertEqual(executor.status(failed_job), 'failed')
+        self.assertIn('ValueError: dummy failure of bad_job', executor.jobs[failed_job]['error'])
+        self.assertEqual(sorted(self.calls()), ['bad_job', 'step_b'])
+
+        # the failed step is run again for the next job which needs it
+        good_steps = [('cache:b', log_call, (self.log_fname, 'step_b_retry'))]
+        job_id = executor.submit('job2', log_call, (self.log_fname, 'job2'), steps=good_steps)
+        self.assertTrue(executor.wait([job_id], timeout=30))
+        executor.shutdown()
+        self.assertEqual(executor.status(job_id), 'done')
+        self.assertIsNone(executor.jobs[job_id]['error'])
+        self.assertEqual(self.calls()[-2:], ['step_b_retry', 'job2'])
+
+    def test_lost_worker(self):
+        executor = local_jobs.LocalJobExecutor(max_workers=1, notify=self.notify)
+        crashed = executor.submit('crash', exit_call, (self.log_fname, 'crash'))
+        steps = [('cache:d', exit_call, (self.log_fname, 'step_d', signal.SIGKILL))]
+        killed = executor.submit('killed_step', log_call, (self.log_fname, 'killed_step'), steps=steps)
+        job_id = executor.submit('noop', log_call, (self.log_fname, 'noop'))
+        self.assertTrue(executor.wait(timeout=30))
+
+        # the slot of the lost worker is given back, so the next job runs
+        self.assertEqual(executor.status(crashed), 'failed')
+        self.assertIn('exited with code 1 without returning a result', executor.jobs[crashed]['error'])
+        self.assertEqual(executor.status(killed), 'failed')
+        self.assertIn('exited with code -%d' % signal.SIGKILL, executor.jobs[killed]['error'])
+        self.assertEqual(executor.status(job_id), 'done')
+        self.assertEqual(executor._n_running, 0)
+
+        # the functions and arguments are not pickled
+        job_id = executor.submit('closure', call_arg, (self.log_fname, 'closure', lambda fname, name: log_call(fname, name)))
+        self.assertTrue(executor.wait([job_id], timeout=30))
+        self.assertEqual(executor.status(job_id), 'done')
+        executor.shutdown()
+        self.assertEqual(sorted(self.calls()), ['closure', 'crash', 'noop', 'step_d'])
+        self.assertTrue(any(msg.startswith('Job 1 (crash) failed:') for msg in self.messages))
+
+    def test_shutdown_no_wait(self):
+        executor = local_jobs.LocalJobExecutor(max_workers=1)
+        running = executor.submit('long', log_call, (self.log_fname, 'long', 30.))
+        queued = executor.submit('queued', log_call, (self.log_fname, 'queued'))
+        while len(self.calls()) == 0:
+            time.sleep(0.01)
+        t_start = time.time()
+        executor.shutdown(wait=False)
+        self.assertTrue(time.time() - t_start < 5)
+        self.assertEqual(executor.status(running), 'failed')
+        self.assertEqual(executor.status(queued), 'failed')
+        self.assertTrue(executor.wait(timeout=1))
+        self.assertEqual(self.calls(), ['long'])
+
+    def test_max_workers(self):
+        for max_workers in [1, 2]:
+            if os.path.exists(self.log_fname):
+                os.remove(self.log_fname)
+            executor = local_jobs.LocalJobExecutor(max_workers=max_workers)
+            for k in range(4):
+                executor.submit('job%d' % k, log_call, (self.log_fname, 'job%d' % k, 0.3))
+            executor.shutdown(wait=True)
+
+            # count the jobs running at the same time from the start/end times
+            events = sorted((float(t), 1 if ev == 'start' else -1) for name, ev, t in read_log(self.log_fname))
+            n_running = 0
+            max_running = 0
+            for t, d in events:
+                n_running += d
+                max_running = max(max_running, n_running)
+            self.assertEqual(len(events), 8)
+            self.assertEqual(max_running, max_workers)
+
+    def test_progress_messages(self):
+        executor = local_jobs.LocalJobExecutor(max_workers=1, notify=self.notify)
+        steps = [('cache:c', log_call, (self.log_fname, 'step_c'))]
+        executor.submit('good', log_call, (self.log_fname, 'good'), steps=steps)
+        executor.submit('bad', fail_call, (self.log_fname, 'bad'))
+        executor.shutdown(wait=True)
+
+        # job 2 is ready when the step finishes, so it is started ahead of job 1
+        expected = ['Queued step cache:c', 'Queued job 1 (good), waiting for cache:c', 'Running step cache:c',
+            'Queued job 2 (bad)', 'Finished step cache:c', 'Started job 2 (bad)', 'Job 2 (bad) failed:',
+            'Started job 1 (good)', 'Finished job 1 (good)']
+        self.assertEqual(len(self.messages), len(expected))
+        for msg, prefix in zip(self.messages, expected):
+            self.assertTrue(msg.startswith(prefix), msg)
+
+        # all the messages are delivered by the notifier thread, not the thread watching the workers
+        self.assertTrue(all(thread is executor._notifier for thread in self.notify_threads))
+        self.assertFalse(executor._notifier.is_alive())
+
+    def test_notify_error(self):
+        # an exception in 'notify' does not stop the delivery of the later messages
+        def notify(msg):
+            self.messages.append(msg)
+            if len(self.messages) == 1:
+                raise RuntimeError('dummy notify failure')
+        executor = local_jobs.LocalJobExecutor(max_workers=1, notify=notify)
+        executor.submit('job0', log_call, (self.log_fname, 'job0'))
+        executor.shutdown(wait=True)
+        self.assertEqual(len(self.messages), 3)
+        self.assertEqual(executor.status(1), 'done')
+
+
+if __name__ == '__main__':
+    unittest.main()
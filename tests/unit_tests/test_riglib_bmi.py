@@ -1,4 +1,5 @@
 import unittest
+import os
 import numpy as np
 from reqlib import swreq
 from requirements import *
@@ -71,6 +72,65 @@ class TestKalmanFilter(unittest.TestCase):
         self.assertTrue(np.all(W < tol))
 
 
+    def test_steady_state_update(self):
+        """Steady-state fast path shall match the full KF update and be invalidated by parameter changes"""
+        np.random.seed(0)
+        A = np.mat(np.eye(5))
+        A[0:2,2:4] = 0.1*np.eye(2)
+        A[2:4,2:4] *= 0.8
+        W = np.mat(np.zeros([5, 5]))
+        W[2:4,2:4] = 0.01*np.eye(2)
+        C = np.mat(np.random.randn(20, 5))
+        C[:,0:2] = 0 # positions are unobserved, so their variance never converges
+        Q = np.mat(np.diag(np.random.rand(20) + 0.5))
+        Y = np.random.poisson(5, size=(20, 300))
+
+        kf_ss = KalmanFilter(A, W, C, Q)
+        kf_full = KalmanFilter(A, W, C, Q)
+        kf_full.steady_state_tol = 0
+        for kf in [kf_ss, kf_full]:
+            kf._init_state()
+            kf.x_hist = np.array([np.array(kf(np.mat(y).T)).ravel() for y in Y.T])
+
+        self.assertTrue(kf_ss._ss_active)
+        self.assertTrue(np.allclose(kf_ss.x_hist, kf_full.x_hist, rtol=1e-8, atol=1e-8))
+
+        kf_ss.C = 2*C
+        self.assertFalse(kf_ss._ss_active)
+        kf_full.C = 2*C
+        self.assertTrue(np.allclose(kf_ss(np.mat(Y[:,0]).T), kf_full(np.mat(Y[:,0]).T)))
+
+    def test_sskf_dare(self):
+        """Direct Riccati solve of the steady-state gains shall match the iterative solution"""
+        np.random.seed(0)
+        A = np.mat(np.eye(5))
+        A[0:2,2:4] = 0.1*np.eye(2)
+        A[2:4,2:4] *= 0.8
+        W = np.mat(np.zeros([5, 5]))
+        W[2:4,2:4] = 0.01*np.eye(2)
+        C = np.mat(np.random.randn(20, 5))
+        C[:,0:2] = 0
+        Q = np.mat(np.diag(np.random.rand(20) + 0.5))
+        kf = KalmanFilter(A, W, C, Q)
+
+        F_ref, K_ref = kf._get_sskf_riccati_iter()
+        F, K = kf.get_sskf()
+        self.assertEqual(kf.sskf_diagnostics['method'], 'dare')
+        self.assertTrue(np.allclose(F, F_ref, atol=1e-10))
+        self.assertTrue(np.allclose(K, K_ref, atol=1e-10))
+
+        F, K = kf.get_sskf(method='iterative')
+        self.assertEqual(kf.sskf_diagnostics['method'], 'iterative')
+        self.assertTrue(np.allclose(K, K_ref, atol=1e-10))
+
+        # unstable unobserved state driven by the velocity: the gains do not converge, fall back to the iteration
+        A[0,0] = 2
+        kf = KalmanFilter(A, W, C, Q)
+        kf.get_sskf(max_iter=100)
+        self.assertEqual(kf.sskf_diagnostics['method'], 'iterative')
+        self.assertTrue('fallback_reason' in kf.sskf_diagnostics)
+        self.assertFalse(kf.sskf_diagnostics['converged'])
+
 ###############################################################################
 ## Kalman filter decoder ######################################################
 from riglib.bmi.kfdecoder import KFDecoder
@@ -105,6 +165,569 @@ class TestKFDecoder(unittest.TestCase):
         self.assertTrue(np.abs(x_t_est[0] - y*K_expected*(-1)) < tol)
         self.assertTrue(np.abs(x_t_est[1] - y*K_expected*(1)) < tol)
 
+    def _make_decoder(self):
+        np.random.seed(1)
+        A = np.mat(np.eye(5))
+        A[0:2,2:4] = 0.1*np.eye(2)
+        A[2:4,2:4] *= 0.8
+        W = np.mat(np.zeros([5, 5]))
+        W[2:4,2:4] = 0.01*np.eye(2)
+        C = np.mat(np.random.randn(20, 5))
+        C[:,0:2] = 0
+        Q = np.mat(np.diag(np.random.rand(20) + 0.5))
+        kf = KalmanFilter(A, W, C, Q)
+
+        units = [(k, 1) for k in range(20)]
+        ssm = StateSpace(*([State(name, stochastic=True, drives_obs=True, order=1) for name in ['px', 'py', 'vx', 'vy']] + 
+            [State('offset', stochastic=False, drives_obs=False, order=-1)]))
+        decoder = KFDecoder(kf, units, ssm)
+        decoder.zscore = True
+        decoder.mFR = np.random.rand(20) + 4.5
+        decoder.sdFR = np.random.rand(20) + 1.5
+        decoder.zeromeanunits = np.array([3, 7])
+        return decoder
+
+    def test_decode_batch(self):
+        import copy
+        decoder = self._make_decoder()
+        def bounder(state, states):
+            state = state.copy()
+            state[0:2,:] = np.clip(state[0:2,:], -1, 1)
+            return state
+        decoder.bounder = bounder
+
+        neural_obs = np.random.poisson(5, size=(20, 600))
+        decoder_seq = copy.deepcopy(decoder)
+        decoder_seq.bounder = bounder
+
+        states = decoder.decode_batch(neural_obs)
+        states_seq = decoder_seq.decode(neural_obs)
+        self.assertEqual(states.shape, (600, 5))
+        self.assertTrue(np.any(np.abs(states_seq[:,0:2]) == 1)) # bounding was active
+        self.assertTrue(np.allclose(states, states_seq, rtol=1e-10, atol=1e-10))
+        self.assertTrue(np.allclose(decoder.filt.get_mean(), decoder_seq.filt.get_mean(), rtol=1e-10, atol=1e-10))
+
+###############################################################################
+## Cross-validation ###########################################################
+from riglib.bmi import cross_validation, state_space_models
+
+class TestCrossValidation(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.ssm = state_space_models.StateSpaceEndptVel2D()
+        n_samples = 3000
+        vel = np.zeros([3, n_samples])
+        for t in range(1, n_samples):
+            vel[:,t] = 0.9*vel[:,t-1] + np.random.randn(3)
+        vel[1] = 0
+        self.kin = np.vstack([np.cumsum(vel, axis=1)*0.1, vel])
+        C = np.random.randn(15, 3)
+        self.neural_features = np.dot(C, np.vstack([vel[[0,2]], np.ones(n_samples)])) + 3*np.random.randn(15, n_samples)
+
+    def test_obs_model_from_suff_stats(self):
+        X = self.kin[self.ssm.train_inds]
+        X1 = np.vstack([X, np.ones(X.shape[1])])
+        R, S, T, n = cross_validation.fold_suff_stats(X1, self.neural_features, [slice(0, X.shape[1])])
+        for regularizer in [0., 100.]:
+            C, Q = cross_validation.obs_model_from_suff_stats(R[0], S[0], T[0], n[0], regularizer=regularizer)
+            C_ref, Q_ref = KalmanFilter.MLE_obs_model(X, self.neural_features, regularizer=regularizer)
+            self.assertTrue(np.allclose(C, C_ref))
+            self.assertTrue(np.allclose(Q, Q_ref))
+
+        # a repeated state makes X*X.T singular, which is solved by least squares, without warnings
+        import warnings
+        X2 = np.vstack([X[:1], X1])
+        R, S, T, n = cross_validation.fold_suff_stats(X2, self.neural_features, [slice(0, X.shape[1])])
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            C, Q = cross_validation.obs_model_from_suff_stats(R[0], S[0], T[0], n[0])
+        self.assertEqual([str(x.message) for x in w if issubclass(x.category, FutureWarning)], [])
+        C_ref, Q_ref = KalmanFilter.MLE_obs_model(X, self.neural_features)
+        C_ref = np.asarray(C_ref)
+        self.assertTrue(np.allclose(C[:,0] + C[:,1], C_ref[:,0]))
+        self.assertTrue(np.allclose(C[:,2:], C_ref[:,1:]))
+        self.assertTrue(np.allclose(Q, Q_ref))
+
+    def test_cross_validate_kf(self):
+        regularizers = [0., 1e3, 1e6]
+        table = cross_validation.cross_validate_kf(self.ssm, self.kin, self.neural_features, 0.1, 
+            regularizers=regularizers, n_folds=4)
+        self.assertEqual(table['fold_scores'].shape, (3, 4))
+        self.assertTrue(np.array_equal(table['regularizer'], regularizers))
+        # heavy regularization shrinks C toward zero, which fits the held-out data worse
+        self.assertTrue(table['mean_score'][2] < table['mean_score'][0])
+        self.assertTrue(cross_validation.best_regularizer(table) in [0., 1e3])
+
+        table_pool = cross_validation.cross_validate_kf(self.ssm, self.kin, self.neural_features, 0.1, 
+            regularizers=regularizers, n_folds=4, n_processes=2)
+        self.assertTrue(np.allclose(table['fold_scores'], table_pool['fold_scores']))
+
+        table_decode = cross_validation.cross_validate_kf(self.ssm, self.kin, self.neural_features, 0.1, 
+            regularizers=regularizers, n_folds=4, score='decode')
+        self.assertTrue(np.all(table_decode['mean_score'] < 1))
+        self.assertTrue(table_decode['mean_score'][0] > table_decode['mean_score'][2])
+
+
+###############################################################################
+## Unit ranking ###############################################################
+from riglib.bmi import unit_ranking
+
+class TestUnitRanking(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        n_units = 12
+        self.ssm = state_space_models.StateSpaceEndptVel2D()
+        A, B, W = self.ssm.get_ssm_matrices(update_rate=0.1)
+        C = np.zeros([n_units, 7])
+        C[:, [3, 5, 6]] = np.random.randn(n_units, 3) * np.random.rand(n_units, 1)
+        L = 0.1 * np.random.randn(n_units, n_units)
+        Q = np.diag(np.random.rand(n_units) + 0.5) + np.dot(L, L.T)
+        kf = KalmanFilter(A, W, C, Q, is_stochastic=self.ssm.is_stochastic)
+        self.decoder = KFDecoder(kf, [(k + 1, 1) for k in range(n_units)], self.ssm)
+
+    def _error(self, decoder):
+        sub = self.ssm.drives_obs_inds
+        A = np.asarray(decoder.filt.A)[np.ix_(sub, sub)]
+        W = np.asarray(decoder.filt.W)[np.ix_(sub, sub)]
+        J = np.asarray(decoder.filt.C_xpose_Q_inv_C)[np.ix_(sub, sub)]
+        P = unit_ranking.steady_state_error_cov(A, W, J)
+        return np.mean(np.diag(P)[:2])
+
+    def test_rank_units(self):
+        ranked_units, info = unit_ranking.rank_units(self.decoder, refresh_interval=5)
+        self.assertEqual(sorted(map(tuple, ranked_units)), sorted(map(tuple, self.decoder.units)))
+        self.assertTrue(np.all(np.diff(info['error']) >= 0))
+
+        # compare with the decoders retrained on the unit subsets
+        full_error = self._error(self.decoder)
+        self.assertTrue(np.allclose(info['error'][0], full_error))
+        for k in [0, 5]:
+            unit = self.decoder.units[k]
+            dec_rm = self.decoder.subselect_units([u for u in self.decoder.units if tuple(u) != tuple(unit)])
+            self.assertEqual(dec_rm.n_features, 11)
+            self.assertTrue(np.allclose(info['contribution'][k], self._error(dec_rm) - full_error))
+        for n in [1, 4, 8]:
+            dec_n = self.decoder.subselect_units(ranked_units[:n])
+            self.assertTrue(np.allclose(info['error'][info['n_units'] == n], self._error(dec_n)))
+
+
+###############################################################################
+## Decoder storage ############################################################
+from riglib.bmi import decoder_store
+
+class TestDecoderStore(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmp_dir = tempfile.mkdtemp()
+        self.decoder = TestKFDecoder('test_decode_batch')._make_decoder()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp_dir)
+
+    def test_save_load(self):
+        fname = self.decoder.save(os.path.join(self.tmp_dir, 'dec.dec'), binary=True)
+        self.assertTrue(decoder_store.is_decoder_file(fname))
+
+        header = decoder_store.read_header(fname)
+        self.assertEqual(header['version'], decoder_store.FORMAT_VERSION)
+        self.assertEqual(header['decoder']['cls'], 'riglib.bmi.kfdecoder.KFDecoder')
+        self.assertEqual(header['decoder']['states'], ['px', 'py', 'vx', 'vy', 'offset'])
+        self.assertEqual(header['decoder']['n_units'], 20)
+
+        dec = decoder_store.load(fname)
+        self.assertTrue(isinstance(dec.filt.C, np.matrix))
+        self.assertTrue(np.array_equal(dec.filt.C, self.decoder.filt.C))
+        self.assertTrue(np.array_equal(dec.mFR, self.decoder.mFR))
+        obs = np.random.poisson(5, size=(20, 50))
+        self.assertTrue(np.allclose(dec.decode(obs), self.decoder.decode(obs)))
+
+        # in-place modifications are not written back to the file
+        dec.filt.C[:] = 0
+        self.assertTrue(np.array_equal(decoder_store.load(fname).filt.C, self.decoder.filt.C))
+
+    def test_convert_pickle(self):
+        pkl_fname = self.decoder.save(os.path.join(self.tmp_dir, 'dec.pkl'))
+        self.assertFalse(decoder_store.is_decoder_file(pkl_fname))
+        self.assertTrue(np.array_equal(decoder_store.load(pkl_fname).filt.C, self.decoder.filt.C))
+
+        fname = decoder_store.convert(pkl_fname)
+        self.assertEqual(fname, os.path.join(self.tmp_dir, 'dec.dec'))
+        self.assertTrue(np.array_equal(decoder_store.load(fname, mmap=False).filt.C, self.decoder.filt.C))
+
+###############################################################################
+## Point-process filter #######################################################
+from riglib.bmi.ppfdecoder import PointProcessFilter
+
+def make_ppf(n_units=30, seed=0):
+    np.random.seed(seed)
+    A = np.mat(np.eye(5))
+    A[0:2,2:4] = 0.005*np.eye(2)
+    A[2:4,2:4] *= 0.99
+    W = np.mat(np.zeros([5, 5]))
+    W[2:4,2:4] = 1e-3*np.eye(2)
+    C = np.zeros([n_units, 5])
+    C[:,2:4] = np.random.randn(n_units, 2)
+    C[:,4] = np.log(np.random.rand(n_units)*30*0.005)
+    is_stochastic = [False, False, True, True, False]
+    ppf = PointProcessFilter(A, W, C, dt=0.005, is_stochastic=is_stochastic)
+    ppf._init_state()
+    return ppf
+
+def ppf_reference_update(ppf, st, obs_t):
+    """PPF update written out with dense matrices"""
+    inds, = np.nonzero(ppf.is_stochastic)
+    mesh = np.ix_(inds, inds)
+    pred_state = ppf._ssm_pred(st)
+    x_pred, P_pred = pred_state.mean, pred_state.cov[mesh]
+    C = ppf.C[:,inds]
+    lambda_dt = np.exp(np.array(ppf.C*x_pred).ravel())
+    if np.linalg.cond(P_pred) > 1e5:
+        P_est = P_pred
+    else:
+        P_est = (P_pred.I + C.T*np.mat(np.diag(lambda_dt))*C).I
+    P_est_full = np.mat(np.zeros(ppf.A.shape))
+    P_est_full[mesh] = P_est
+    x_est = x_pred + P_est_full*ppf.C.T*(np.mat(obs_t).reshape(-1,1) - np.mat(lambda_dt).T)
+    return GaussianState(x_est, P_est_full)
+
+class TestPointProcessFilter(unittest.TestCase):
+    def test_update_matches_reference(self):
+        ppf = make_ppf()
+        spikes = np.random.rand(30, 200) < 0.05
+        st = ppf.state
+        for obs_t in spikes.T.astype(float):
+            post = ppf._forward_infer(st, obs_t)
+            ref = ppf_reference_update(ppf, st, obs_t)
+            self.assertTrue(np.allclose(post.mean, ref.mean, rtol=1e-8, atol=1e-12))
+            self.assertTrue(np.allclose(post.cov, ref.cov, rtol=1e-8, atol=1e-12))
+            st = post
+
+        # cached observation matrices follow re-assignment of C
+        ppf.C = 2*ppf.C
+        post = ppf._forward_infer(st, spikes[:,0].astype(float))
+        ref = ppf_reference_update(ppf, st, spikes[:,0].astype(float))
+        self.assertTrue(np.allclose(post.mean, ref.mean, rtol=1e-8, atol=1e-12))
+
+    def test_sparse_update(self):
+        ppf = make_ppf(n_units=100)
+        spikes = (np.random.rand(100, 300) < 0.02).astype(float)
+        ppf_sparse = make_ppf(n_units=100)
+        ppf_sparse.sparse_update = True
+
+        st = st_sparse = ppf.state
+        for obs_t in spikes.T:
+            st = ppf._forward_infer(st, obs_t)
+            st_sparse = ppf_sparse._forward_infer(st_sparse, obs_t)
+            self.assertTrue(np.allclose(st.mean, st_sparse.mean, rtol=0, atol=1e-5))
+            self.assertTrue(np.allclose(st.cov, st_sparse.cov, rtol=1e-4, atol=1e-12))
+
+        # exact if the expansion is always taken at the predicted state
+        ppf_sparse.sparse_update_tol = 0
+        post = ppf._forward_infer(st, spikes[:,0])
+        post_sparse = ppf_sparse._forward_infer(st, spikes[:,0])
+        self.assertTrue(np.allclose(post.mean, post_sparse.mean, rtol=1e-10, atol=1e-12))
+        self.assertTrue(np.allclose(post.cov, post_sparse.cov, rtol=1e-10, atol=1e-12))
+
+    def test_fit_poisson_glm(self):
+        import statsmodels.api as sm
+        from riglib.bmi.ppfdecoder import fit_poisson_glm
+        np.random.seed(0)
+        X = np.vstack([np.random.randn(2, 5000)*0.1, np.ones([1, 5000])])
+        C_true = np.hstack([np.random.randn(6, 2)*3, np.log(np.random.rand(6, 1)*0.1 + 0.01)])
+        Y = np.random.poisson(np.exp(np.dot(C_true, X))).astype(float)
+        Y[0] = 0 # silent unit
+
+        C, pvalues, info = fit_poisson_glm(X, Y)
+        self.assertTrue(np.array_equal(info['converged'], [False] + [True]*5))
+        self.assertTrue(np.array_equal(info['silent'], [True] + [False]*5))
+        self.assertTrue(np.all(C[0] == 0))
+        for k in range(1, 6):
+            fit = sm.GLM(Y[k], X.T, family=sm.families.Poisson()).fit()
+            self.assertTrue(np.allclose(C[k], fit.params, rtol=0, atol=1e-6))
+            self.assertTrue(np.allclose(pvalues[k], fit.pvalues, rtol=1e-3, atol=1e-8))
+
+        C_pool, pvalues_pool, info_pool = fit_poisson_glm(X, Y, n_processes=2)
+        self.assertTrue(np.allclose(C_pool, C))
+        self.assertTrue(np.array_equal(info_pool['n_iter'], info['n_iter']))
+        self.assertTrue(np.array_equal(info_pool['silent'], info['silent']))
+
+        # a unit which fires but whose fit fails is not reported as silent
+        C_fail, pvalues_fail, info_fail = fit_poisson_glm(X, Y, max_iter=1)
+        self.assertFalse(np.any(info_fail['converged']))
+        self.assertTrue(np.array_equal(info_fail['silent'], info['silent']))
+
+    def test_refine_poisson_glm(self):
+        from riglib.bmi.ppfdecoder import fit_poisson_glm, refine_poisson_glm
+        np.random.seed(0)
+        X = np.vstack([np.random.randn(2, 5000)*0.1, np.ones([1, 5000])])
+        C_true = np.hstack([np.random.randn(6, 2)*3, np.log(np.random.rand(6, 1)*0.1 + 0.01)])
+        Y = np.random.poisson(np.exp(np.dot(C_true, X))).astype(float)
+        Y[0] = 0 # silent unit
+        C_mle, pvalues_mle, info = fit_poisson_glm(X, Y)
+
+        # a few Newton steps from a nearby starting point reach the maximum-likelihood estimate
+        C_init = C_true + np.random.randn(*C_true.shape)*0.05
+        C, pvalues = refine_poisson_glm(X, Y, C_init, n_steps=4)
+        self.assertTrue(np.array_equal(C[0], C_init[0]))
+        self.assertTrue(np.all(np.isnan(pvalues[0])))
+        self.assertTrue(np.allclose(C[1:], C_mle[1:], rtol=0, atol=1e-6))
+        self.assertTrue(np.allclose(pvalues[1:], pvalues_mle[1:], rtol=1e-3, atol=1e-8))
+
+###############################################################################
+## Feature extractors #########################################################
+from riglib.bmi import extractor, sim_neurons
+
+class MockSpikeSource(object):
+    def __init__(self, ts):
+        self.ts = ts
+
+    def get(self, *args, **kwargs):
+        return self.ts
+
+class TestBinnedSpikeCountsExtractor(unittest.TestCase):
+    def setUp(self):
+        self.units = np.array([[1, 1], [1, 2], [3, 1], [20, 4]])
+        ts = [(0.01, 1, 1, 0.01), (0.02, 1, 2, 0.02), (0.03, 1, 1, 0.03), (0.04, 5, 1, 0.04),
+              (0.05, 20, 4, 0.05), (0.06, 3, 1, 0.06), (0.07, 1, 3, 0.07), (0.08, 20, 4, 0.08)]
+        self.ts = np.array(ts, dtype=sim_neurons.ts_dtype_new)
+
+    def test_bin_spikes(self):
+        counts = extractor.BinnedSpikeCountsExtractor.bin_spikes(self.ts, self.units)
+        self.assertTrue(np.array_equal(counts, [2, 1, 1, 2]))
+
+    def test_subbins(self):
+        f_extractor = extractor.BinnedSpikeCountsExtractor(MockSpikeSource(self.ts), n_subbins=2, units=self.units)
+        f_extractor.last_get_spike_counts_time = 0.
+        counts = f_extractor(0.1)['spike_counts']
+
+        expected = np.array([[2, 0], [1, 0], [0, 1], [0, 2]])
+        self.assertEqual(counts.shape, (4, 2))
+        self.assertTrue(np.array_equal(counts, expected))
+
+class TestLFPMTMPowerExtractor(unittest.TestCase):
+    def test_matches_nitime(self):
+        import nitime.algorithms as tsa
+        channels = [1, 2, 3]
+        f_extractor = extractor.LFPMTMPowerExtractor(None, channels=channels, fs=1000)
+        cont_samples = np.random.randn(len(channels), f_extractor.n_pts)
+
+        psd_est = tsa.multi_taper_psd(cont_samples, Fs=f_extractor.fs, NW=f_extractor.NW, jackknife=False, 
+            low_bias=True, NFFT=f_extractor.nfft)[1]
+        n_chan = len(channels)
+        expected = np.zeros((n_chan * len(f_extractor.bands), 1))
+        for idx, band in enumerate(f_extractor.bands):
+            expected[idx*n_chan:(idx+1)*n_chan, 0] = np.mean(np.log10(psd_est[:, f_extractor.fft_inds[idx]] + f_extractor.epsilon), axis=1)
+
+        lfp_power = f_extractor.extract_features(cont_samples)
+        self.assertEqual(lfp_power.shape, expected.shape)
+        self.assertTrue(np.allclose(lfp_power, expected, rtol=1e-10, atol=1e-10))
+
+class MockLFPSource(object):
+    def __init__(self, data, chunk_sizes):
+        self.data = data
+        self.chunk_sizes = list(chunk_sizes)
+        self.idx = 0
+
+    def get_new(self, channels, **kwargs):
+        n = self.chunk_sizes.pop(0)
+        new_data = [self.data[k, self.idx:self.idx + n] for k in range(len(channels))]
+        self.idx += n
+        return new_data
+
+class TestLFPButterBPFPowerExtractor(unittest.TestCase):
+    def test_streaming_matches_full_record_filter(self):
+        from scipy.signal import sosfilt
+        channels = [1, 2, 3]
+        bands = [(10, 20), (20, 40), (70, 90)]
+        f_extractor = extractor.LFPButterBPFPowerExtractor(None, channels=channels, bands=bands, fs=1000, streaming=True)
+
+        chunk_sizes = [17, 16, 17, 250, 3, 0, 17, 16, 17, 17, 16, 17, 400, 17]
+        data = np.random.randn(len(channels), sum(chunk_sizes))
+        f_extractor.source = MockLFPSource(data, chunk_sizes)
+
+        n_read = 0
+        for n in chunk_sizes:
+            lfp_power = f_extractor(0.)['lfp_power']
+            n_read += n
+
+            expected = np.zeros((len(channels) * len(bands), 1))
+            for i, band in enumerate(bands):
+                y = sosfilt(f_extractor.filt_sos[band], data[:, :n_read], axis=-1)
+                sq_sum = np.sum(y[:, -f_extractor.n_pts:]**2, axis=1)
+                expected[i*len(channels):(i+1)*len(channels), 0] = np.log(sq_sum / f_extractor.n_pts + f_extractor.epsilon)
+            self.assertTrue(np.allclose(lfp_power, expected, rtol=1e-8, atol=1e-8))
+
+class MockContinuousFile(object):
+    def __init__(self, data):
+        self.data = data
+
+    def __getitem__(self, item):
+        return MockContinuousFile(self.data[:, item[1]])
+
+class TestOfflineLFPPower(unittest.TestCase):
+    def setUp(self):
+        self.channels = np.array([1, 2, 3, 4, 5])
+        self.bands = [(10, 20), (20, 40), (70, 90)]
+        self.lfp = MockContinuousFile(np.random.randn(3000, 6))
+        self.interp_rows = np.arange(0.1, 3.0, 0.1)
+
+    def _windowed_features(self, f_extractor):
+        window_ends = (self.interp_rows * f_extractor.fs).astype(int)
+        data = self.lfp.data[:, self.channels - 1]
+        features = np.zeros((len(window_ends), len(self.channels) * len(self.bands)))
+        for i, end in enumerate(window_ends):
+            if end >= f_extractor.n_pts:
+                features[i] = f_extractor.extract_features(data[end - f_extractor.n_pts:end].T).ravel()
+        return features
+
+    def test_mtm_power(self):
+        f_extractor = extractor.LFPMTMPowerExtractor(None, channels=self.channels, bands=self.bands, fs=1000)
+        lfp_power = extractor.compute_mtm_power(self.lfp, f_extractor, self.interp_rows, chan_chunk_size=2, window_chunk=7)
+        self.assertTrue(np.allclose(lfp_power, self._windowed_features(f_extractor)))
+
+    def test_butter_bpf_power(self):
+        f_extractor = extractor.LFPButterBPFPowerExtractor(None, channels=self.channels, bands=self.bands, fs=1000)
+        lfp_power = extractor.compute_butter_bpf_power(self.lfp, f_extractor, self.interp_rows, chan_chunk_size=2, window_chunk=7)
+        self.assertTrue(np.allclose(lfp_power, self._windowed_features(f_extractor)))
+
+class TestWaveformClusterCountExtractor(unittest.TestCase):
+    def setUp(self):
+        from sklearn.mixture import GaussianMixture
+        n_pts = 8
+        self.units = np.array([[1, 1], [1, 2], [2, 1], [2, 2], [2, 3]])
+        self.gmm_model_params = dict()
+        self.gmms = dict()
+        chans, waveforms = [], []
+        for ch in [1, 2]:
+            ch_units = self.units[self.units[:,0] == ch]
+            means = np.random.randn(len(ch_units), n_pts) * 3
+            wfs = np.vstack([m + np.random.randn(200, n_pts) for m in means])
+            gmm = GaussianMixture(n_components=len(ch_units), covariance_type='full', random_state=0).fit(wfs)
+            self.gmms[ch] = gmm
+            self.gmm_model_params[ch] = extractor.gmm_to_model_params(gmm, ch_units)
+            chans.append(np.ones(len(wfs), dtype=np.int32) * ch)
+            waveforms.append(wfs)
+
+        # interleave the spikes of the two channels, as they would arrive from the source
+        order = np.random.permutation(sum(len(wfs) for wfs in waveforms))
+        self.chans = np.hstack(chans)[order]
+        self.waveforms = np.vstack(waveforms)[order]
+
+    def test_matches_sklearn(self):
+        classifier = extractor.GMMWaveformClassifier(self.gmm_model_params, self.units)
+        labels = classifier.predict(self.chans, self.waveforms)
+        for ch in [1, 2]:
+            inds = self.chans == ch
+            self.assertTrue(np.array_equal(labels[inds], self.gmms[ch].predict(self.waveforms[inds])))
+
+    def test_cluster_counts(self):
+        spike_dtype = np.dtype([("ts", np.float), ("chan", np.int32), ("unit", np.int32), ("arrival_ts", np.float64), 
+            ("waveform", np.float64, (self.waveforms.shape[1],))])
+        ts = np.zeros(len(self.chans), dtype=spike_dtype)
+        ts['chan'] = self.chans
+        ts['waveform'] = self.waveforms
+        ts['ts'] = np.linspace(0, 1, len(ts))
+
+        f_extractor = extractor.WaveformClusterCountExtractor(MockSpikeSource(ts), self.gmm_model_params, units=self.units)
+        output = f_extractor(1.)
+        counts = output['cluster_counts']
+
+        expected = np.hstack([self.gmms[ch].predict_proba(self.waveforms[self.chans == ch]).sum(axis=0) for ch in [1, 2]])
+        self.assertEqual(counts.shape, (len(self.units), 1))
+        self.assertTrue(np.allclose(counts[:,0], expected))
+        self.assertTrue(np.array_equal(output['bin_edges'], [0, 1]))
+
+class TestSourceProcessFeatureExtractor(unittest.TestCase):
+    def test_counts_from_source_process(self):
+        import time
+        from riglib import source
+
+        class FiniteSpikes(source.DataSourceSystem):
+            dtype = np.dtype(sim_neurons.ts_dtype_new)
+            update_freq = 1000.
+            n_spikes = 200
+            def start(self):
+                self.k = 0
+            def get(self):
+                time.sleep(0.0005)
+                if self.k >= self.n_spikes:
+                    return None
+                self.k += 1
+                return np.array([(time.time(), 1 + self.k % 2, 1, time.time())], dtype=self.dtype)
+
+        units = np.array([[1, 1], [2, 1], [3, 1]])
+        neurondata = source.DataSource(FiniteSpikes, send_data_to_sink_manager=False)
+        f_extractor = extractor.SourceProcessFeatureExtractor(
+            extractor.BinnedSpikeCountsExtractor(neurondata, units=units), 0.01)
+        self.assertTrue(np.array_equal(f_extractor.units, units))
+
+        neurondata.start()
+        try:
+            counts = np.zeros((len(units), 1))
+            for k in range(50):
+                time.sleep(0.01)
+                counts += f_extractor(time.time())['spike_counts']
+        finally:
+            neurondata.stop()
+            neurondata.join()
+        self.assertTrue(np.array_equal(counts[:,0], [100, 100, 0]))
+
+###############################################################################
+## Feature cache ##############################################################
+from riglib.bmi import feature_cache
+
+class TestFeatureCache(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.cache_dir = tempfile.mkdtemp()
+        self.data_fname = os.path.join(self.cache_dir, 'block.plx')
+        open(self.data_fname, 'w').write('data')
+        self.n_calls = 0
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.cache_dir)
+
+    def extract(self, binlen, units=None):
+        self.n_calls += 1
+        return np.arange(100.).reshape(50, 2) * binlen, units, dict(units=units, binlen=binlen)
+
+    def test_get(self):
+        cache = feature_cache.FeatureCache(os.path.join(self.cache_dir, 'cache'))
+        units = np.array([[1, 1], [2, 1]])
+        key = (feature_cache.file_identity(dict(plexon=self.data_fname)), 0.1, units)
+        features, units_out, kwargs = cache.get(key, self.extract, 0.1, units=units)
+        features_cached, units_cached, kwargs_cached = cache.get(key, self.extract, 0.1, units=units)
+
+        self.assertEqual(self.n_calls, 1)
+        self.assertTrue(isinstance(features_cached, np.memmap))
+        self.assertTrue(np.array_equal(features, features_cached))
+        self.assertTrue(np.array_equal(units_cached, units))
+        self.assertEqual(kwargs_cached['binlen'], 0.1)
+
+        # a different parameter or a modified data file gives a new entry
+        cache.get((key[0], 0.05, units), self.extract, 0.05, units=units)
+        self.assertEqual(self.n_calls, 2)
+        os.utime(self.data_fname, (0, 0))
+        key = (feature_cache.file_identity(dict(plexon=self.data_fname)), 0.1, units)
+        cache.get(key, self.extract, 0.1, units=units)
+        self.assertEqual(self.n_calls, 3)
+
+    def test_lru_eviction(self):
+        import time
+        cache = feature_cache.FeatureCache(os.path.join(self.cache_dir, 'cache'), max_size_mb=0.002)
+        cache.get(('a',), self.extract, 0.1)
+        time.sleep(0.05)
+        cache.get(('b',), self.extract, 0.1)
+        time.sleep(0.05)
+        cache.get(('a',), self.extract, 0.1) # mark 'a' as recently used
+        time.sleep(0.05)
+        cache.get(('c',), self.extract, 0.1)
+
+        keys = [key for key, last_used, size in cache.entries()]
+        self.assertEqual(keys, [cache.make_key('c'), cache.make_key('a')])
+
 ###############################################################################
 ## Accumulators ###############################################################
 from riglib.bmi import accumulator
@@ -186,6 +809,701 @@ class TestGaussianState(unittest.TestCase):
         self.assertEqual(z.cov[1,0], 0)
 
 
+###############################################################################
+## CLDA parameter history #####################################################
+from riglib.bmi.bmi import CLDAParamHistStream
+
+class MockSink(object):
+    def __init__(self):
+        self.dtypes = dict()
+        self.data = dict()
+
+    def register(self, name, dtype):
+        self.dtypes[name] = dtype
+        self.data[name] = []
+
+    def send(self, name, data):
+        self.data[name].append(data)
+
+class TestCLDAParamHistStream(unittest.TestCase):
+    def test_stream(self):
+        updates = [dict([('filt.C', np.random.randn(4, 3)), ('mFR', np.random.rand(4)), ('rho', 0.5)]) for k in range(3)]
+        dtype = CLDAParamHistStream.table_dtype(updates[0])
+
+        sink = MockSink()
+        param_hist = CLDAParamHistStream(sink, dtype)
+        self.assertEqual(sink.dtypes['clda'], dtype) # registered before any update
+        param_hist.append(None)
+        for update in updates:
+            param_hist.append(update)
+        param_hist.append(dict([('filt.C', np.zeros([5, 3])), ('mFR', np.ones(4)), ('rho', 0.1)])) # C does not fit
+        self.assertEqual(len(param_hist), 5)
+
+        clda_data = np.hstack(sink.data['clda'])
+        self.assertEqual(len(clda_data), 5)
+        self.assertTrue(np.all(np.isnan(clda_data[0]['filt_C'])))
+        self.assertTrue(np.array_equal(clda_data[1:4]['filt_C'], np.array([u['filt.C'] for u in updates])))
+        self.assertTrue(np.array_equal(clda_data[1:4]['mFR'], np.array([u['mFR'] for u in updates])))
+        self.assertTrue(np.all(clda_data[1:4]['rho'] == 0.5))
+        self.assertTrue(np.all(np.isnan(clda_data[4]['filt_C'])))
+        self.assertTrue(np.all(clda_data[4]['mFR'] == 1))
+
+        sink = MockSink()
+        param_hist = CLDAParamHistStream(sink, dtype, ignore_none=True)
+        param_hist.append(None)
+        param_hist.append(updates[0])
+        self.assertEqual(len(param_hist), 2)
+        self.assertEqual(len(sink.data['clda']), 1)
+
+    def _make_decoder(self):
+        A = np.mat(np.eye(3))
+        C = np.mat(np.random.randn(4, 3))
+        kf = KalmanFilter(A, np.mat(np.eye(3)), C, np.mat(np.eye(4)))
+        kf.R, kf.S, kf.T, kf.ESS = np.mat(np.eye(3)), C.copy(), np.mat(np.eye(4)), 100.
+        ssm = StateSpace(*[State(name, stochastic=True, drives_obs=True, order=1) for name in ['vx', 'vy', 'vz']])
+        decoder = KFDecoder(kf, [(k, 1) for k in range(4)], ssm)
+        decoder.mFR = np.zeros(4)
+        return decoder
+
+    def test_updater_dtype(self):
+        decoder = self._make_decoder()
+        dtype = CLDAParamHistStream.updater_dtype(decoder, ('filt.C', 'filt.Q', 'filt.R', 'kf.ESS', 'mFR', 'rho'), 9.5)
+        self.assertEqual(dtype['filt_C'].shape, (4, 3))
+        self.assertEqual(dtype['filt_Q'].shape, (4, 4))
+        self.assertEqual(dtype['filt_R'].shape, (3, 3))
+        self.assertEqual(dtype['kf_ESS'].shape, (1,))
+        self.assertEqual(dtype['mFR'].shape, (4,))
+        self.assertEqual(dtype['rho'].shape, (1,))
+        self.assertEqual(dtype['intended_kin'].shape, (3, 10))
+        self.assertEqual(dtype['spike_counts_batch'].shape, (4, 10))
+        self.assertEqual(dtype['batch_len'].shape, (1,))
+
+    def test_short_batch(self):
+        decoder = self._make_decoder()
+        dtype = CLDAParamHistStream.updater_dtype(decoder, ('filt.C', 'rho'), 10)
+        sink = MockSink()
+        param_hist = CLDAParamHistStream(sink, dtype)
+        batches = [(np.random.randn(3, n), np.random.poisson(3, size=(4, n)).astype(float)) for n in [10, 4, 1]]
+        for int_kin, spike_counts in batches:
+            param_hist.append({'filt.C':np.random.randn(4, 3), 'rho':0.5, 'intended_kin':np.mat(int_kin), 'spike_counts_batch':spike_counts})
+        # a batch which is longer than the columns does not fit
+        param_hist.append({'filt.C':np.zeros([4, 3]), 'intended_kin':np.zeros([3, 11]), 'spike_counts_batch':np.zeros([4, 11])})
+
+        clda_data = np.hstack(sink.data['clda'])
+        for row, (int_kin, spike_counts) in zip(clda_data, batches):
+            # batches ended early fill the first columns
+            n = int_kin.shape[1]
+            self.assertEqual(row['batch_len'], n)
+            self.assertTrue(np.array_equal(row['intended_kin'][:, :n], int_kin))
+            self.assertTrue(np.array_equal(row['spike_counts_batch'][:, :n], spike_counts))
+            self.assertTrue(np.all(np.isnan(row['intended_kin'][:, n:])))
+            self.assertTrue(np.all(np.isnan(row['spike_counts_batch'][:, n:])))
+            self.assertEqual(row['rho'], 0.5)
+        self.assertTrue(np.all(np.isnan(clda_data[3]['intended_kin'])))
+        self.assertEqual(clda_data[3]['batch_len'], 11)
+        self.assertTrue(np.all(clda_data[3]['filt_C'] == 0))
+
+
+###############################################################################
+## Shadow decoders ############################################################
+from riglib.bmi.shadow_decoders import ShadowDecoderBank
+
+class TestShadowDecoderBank(unittest.TestCase):
+    def _make_decoders(self):
+        import copy
+        decoder = TestKFDecoder('test_decode_batch')._make_decoder()
+        decoders = []
+        for inds in [np.arange(20), np.arange(0, 20, 2), np.arange(5, 15)]:
+            dec = copy.deepcopy(decoder)
+            kf = decoder.filt
+            dec.filt = KalmanFilter(kf.A, kf.W, kf.C[inds], kf.Q[np.ix_(inds, inds)])
+            dec.filt._init_state()
+            dec.units = np.array(decoder.units)[inds]
+            dec.mFR, dec.sdFR = decoder.mFR[inds], decoder.sdFR[inds]
+            dec.zeromeanunits = np.nonzero(np.in1d(inds, decoder.zeromeanunits))[0]
+            decoders.append(dec)
+        live_units = np.array(decoder.units)[::-1]
+        return decoders, live_units
+
+    def test_matches_decoders(self):
+        import copy
+        decoders, live_units = self._make_decoders()
+        ref_decoders = copy.deepcopy(decoders)
+        # the last decoder is run one observation at a time
+        bank = ShadowDecoderBank(decoders, live_units, time_budget=10., stack=[True, True, False])
+
+        neural_obs = np.random.poisson(5, size=(20, 300)).astype(float)
+        for k in range(300):
+            states = bank.run([neural_obs[:,k]])
+            for m, ref in enumerate(ref_decoders):
+                ref.predict(neural_obs[bank.feature_inds[m],k])
+                self.assertTrue(np.allclose(states[m], np.asarray(ref.filt.get_mean()).ravel(), rtol=1e-8, atol=1e-8))
+        self.assertEqual(bank._stacked, [0, 1]) # both steady-state filters are stacked
+        self.assertTrue(np.all(bank.n_skipped == 0))
+
+    def test_skip_over_budget(self):
+        decoders, live_units = self._make_decoders()
+        bank = ShadowDecoderBank(decoders, live_units, time_budget=0., max_backlog=10, stack=False)
+        obs = [np.ones(20)] * 15
+        bank.run(obs)
+        self.assertTrue(np.array_equal(bank.n_skipped, [5, 5, 5]))
+        with self.assertRaises(ValueError):
+            ShadowDecoderBank(decoders, live_units[:10])
+        with self.assertRaises(ValueError):
+            ShadowDecoderBank(decoders, live_units, stack=[True, False])
+
+
+###############################################################################
+## CLDA worker process #########################################################
+from riglib import mp_calc
+import multiprocessing as mp
+
+def worker_update(intended_kin=None, spike_counts=None, decoder=None, scale=1.):
+    return dict(C=decoder['C'] + scale*np.dot(spike_counts, intended_kin.T))
+
+def worker_apply_update(new_params, decoder=None):
+    decoder['C'] = new_params['C']
+
+def worker_slow_apply_update(new_params, decoder=None):
+    import time
+    time.sleep(1.)
+    worker_apply_update(new_params, decoder=decoder)
+
+class TestSharedBatchCompute(unittest.TestCase):
+    def test_batches(self):
+        pool = mp_calc.SharedArrayPool(dict(intended_kin=(3, 10), spike_counts=(4, 10)))
+        work_queue, result_queue = mp.Queue(), mp.Queue()
+        worker = mp_calc.SharedBatchCompute(work_queue, result_queue, worker_update, pool, 
+            registered=dict(decoder=dict(C=np.zeros([4, 3]))), on_result=worker_apply_update)
+        worker.start()
+        try:
+            C = np.zeros([4, 3])
+            for n_obs in [10, 6, 12]:
+                x, y = np.random.randn(3, n_obs), np.random.randn(4, n_obs)
+                worker.submit(dict(intended_kin=np.mat(x), spike_counts=y), scale=2.)
+                result = result_queue.get(timeout=10)
+                pool.release(result['slot'])
+                C += 2*np.dot(y, x.T)
+                self.assertTrue(np.allclose(result['result']['C'], C))
+                self.assertTrue(result['t_submit'] <= result['t_start'] <= result['t_done'])
+                # batches larger than the shared buffers are sent through the queue
+                self.assertEqual(result['slot'] is None, n_obs > 10)
+            self.assertEqual(sorted(pool._free), [0, 1])
+        finally:
+            worker.stop()
+            worker.join(5)
+        self.assertFalse(worker.is_alive())
+
+    def test_result_before_sync(self):
+        import time
+        pool = mp_calc.SharedArrayPool(dict(intended_kin=(3, 10), spike_counts=(4, 10)))
+        work_queue, result_queue = mp.Queue(), mp.Queue()
+        worker = mp_calc.SharedBatchCompute(work_queue, result_queue, worker_update, pool, 
+            registered=dict(decoder=dict(C=np.zeros([4, 3]))), on_result=worker_slow_apply_update)
+        worker.start()
+        try:
+            C = np.zeros([4, 3])
+            for k in range(2):
+                x, y = np.random.randn(3, 5), np.random.randn(4, 5)
+                t_submit = time.time()
+                worker.submit(dict(intended_kin=x, spike_counts=y))
+                result = result_queue.get(timeout=10)
+                pool.release(result['slot'])
+                # the result is sent before the (slow) sync of the worker's objects, which is not counted as computation
+                if k == 0:
+                    self.assertTrue(time.time() - t_submit < 0.8)
+                self.assertTrue(result['t_done'] - result['t_start'] < 0.5)
+                # and the next job, which waits for the sync, sees the synced objects
+                C += np.dot(y, x.T)
+                self.assertTrue(np.allclose(result['result']['C'], C))
+        finally:
+            worker.stop()
+            worker.join(5)
+
+class TestSharedArrayPool(unittest.TestCase):
+    def test_put_get(self):
+        pool = mp_calc.SharedArrayPool(dict(a=(3, 5), b=(2, 5)))
+        a, b = np.mat(np.random.randn(3, 4)), np.arange(6, dtype=np.int32).reshape(2, 3)
+        slot, layout = pool.put(dict(a=a, b=b))
+        arrays = pool.get(slot, layout)
+        self.assertTrue(isinstance(arrays['a'], np.matrix))
+        self.assertTrue(np.array_equal(arrays['a'], a))
+        self.assertEqual(arrays['b'].dtype, np.int32)
+        self.assertTrue(np.array_equal(arrays['b'], b))
+
+        # no free buffers until a slot is released
+        slot2, layout2 = pool.put(dict(a=a))
+        self.assertNotEqual(slot2, slot)
+        self.assertEqual(pool.put(dict(a=a)), (None, None))
+        pool.release(slot)
+        self.assertEqual(pool.put(dict(b=b))[0], slot)
+        pool.release(slot)
+
+        # arrays which do not fit the buffers
+        for arrays in [dict(a=np.zeros([3, 6])), dict(a=np.zeros([2, 5])), dict(a=np.zeros(5)), 
+                dict(a=np.zeros([3, 5], dtype=complex)), dict(c=np.zeros([3, 5]))]:
+            self.assertEqual(pool.put(arrays), (None, None))
+        self.assertEqual(sorted(pool._free), [slot])
+
+def worker_square(x):
+    return x**2
+
+class TestMPCompute(unittest.TestCase):
+    def test_blocking_get(self):
+        import time
+        work_queue, result_queue = mp.Queue(), mp.Queue()
+        proc = mp_calc.MPCompute(work_queue, result_queue, worker_square)
+        proc.poll_interval = 10.
+        proc.start()
+        try:
+            time.sleep(0.2)
+            # jobs start as soon as they are queued, not at the end of the poll interval
+            t_start = time.time()
+            work_queue.put(((3,), dict()))
+            self.assertEqual(result_queue.get(timeout=5), 9)
+            self.assertTrue(time.time() - t_start < 5)
+        finally:
+            t_start = time.time()
+            proc.stop()
+            proc.join(5)
+        self.assertFalse(proc.is_alive())
+        self.assertTrue(time.time() - t_start < 5) # 'stop' wakes up the waiting process
+
+
+###############################################################################
+## CLDA #######################################################################
+from riglib.bmi import clda, train
+
+def make_trained_kf_decoder(n_units=15, n_samples=2000, seed=0):
+    np.random.seed(seed)
+    ssm = state_space_models.StateSpaceEndptVel2D()
+    vel = np.zeros([3, n_samples])
+    for t in range(1, n_samples):
+        vel[:,t] = 0.9*vel[:,t-1] + np.random.randn(3)
+    vel[1] = 0
+    kin = np.vstack([np.cumsum(vel, axis=1)*0.1, vel])
+    C = np.random.randn(n_units, 3)
+    neural_features = np.dot(C, np.vstack([vel[[0,2]], np.ones(n_samples)])) + 3*np.random.randn(n_units, n_samples)
+    return train.train_KFDecoder_abstract(ssm, kin, neural_features, [(k + 1, 1) for k in range(n_units)], 0.1)
+
+def kfrml_reference_update(R, S, T, ESS, drives_neurons, x, y, rho, values=None):
+    # RML update with a dense matrix of sample weights and pseudo-inverses, as KFRML.calc used to compute it
+    x, y = np.mat(x), np.mat(y)
+    if values is not None:
+        n_samples = np.sum(values)
+        B = np.mat(np.diag(values))
+    else:
+        n_samples = y.shape[1]
+        B = np.mat(np.eye(n_samples))
+    R = rho*R + x*B*x.T
+    S = S.copy()
+    S[:, drives_neurons] = rho*S[:, drives_neurons] + y*B*x[drives_neurons, :].T
+    T = rho*T + np.dot(y, B*y.T)
+    ESS = rho*ESS + n_samples
+
+    R_inv = np.mat(np.zeros(R.shape))
+    R_inv[np.ix_(drives_neurons, drives_neurons)] = np.linalg.pinv(R[np.ix_(drives_neurons, drives_neurons)])
+    C = S*R_inv
+    Q = (1./ESS) * (T - S*C.T)
+    return R, S, T, ESS, C, Q, C.T*np.linalg.pinv(Q)
+
+class TestKFRML(unittest.TestCase):
+    def test_matches_dense_update(self):
+        decoder = make_trained_kf_decoder()
+        R, S, T, ESS = decoder.filt.R.copy(), decoder.filt.S.copy(), decoder.filt.T.copy(), decoder.filt.ESS
+        updater = clda.KFRML(0.3, 10.)
+        updater.init(decoder)
+
+        n_recursive = []
+        for k in range(150):
+            x = np.vstack([np.random.randn(6, 3), np.ones([1, 3])])
+            y = np.random.randn(15, 3) + 2
+            values = np.random.rand(3) if k % 2 == 0 else None
+            new_params = updater.calc(intended_kin=x, spike_counts=y, decoder=decoder, values=values)
+            decoder.update_params(new_params)
+            n_recursive.append(updater._Q_inv_cache[2])
+
+            R, S, T, ESS, C, Q, C_xpose_Q_inv = kfrml_reference_update(R, S, T, ESS, decoder.drives_neurons, x, y, updater.rho, values)
+            self.assertTrue(np.allclose(new_params['filt.R'], R))
+            self.assertTrue(np.allclose(new_params['filt.C'], C))
+            self.assertTrue(np.allclose(new_params['filt.Q'], Q))
+            self.assertTrue(np.allclose(new_params['filt.C_xpose_Q_inv'], C_xpose_Q_inv, rtol=1e-6, atol=1e-8))
+            self.assertTrue(np.allclose(new_params['filt.C_xpose_Q_inv_C'], C_xpose_Q_inv*C, rtol=1e-6, atol=1e-8))
+            self.assertTrue(np.allclose(new_params['kf.ESS'], ESS))
+
+        # Q^{-1} is updated recursively, and re-computed directly after 'Q_inv_refresh_interval' updates
+        self.assertEqual(n_recursive[:3], [0, 1, 2])
+        self.assertEqual(max(n_recursive), clda.KFRML.Q_inv_refresh_interval)
+        self.assertEqual(n_recursive[clda.KFRML.Q_inv_refresh_interval + 1], 0)
+
+        # a batch which is not small compared to the number of features gets a direct inverse
+        x = np.vstack([np.random.randn(6, 10), np.ones([1, 10])])
+        updater.calc(intended_kin=x, spike_counts=np.random.randn(15, 10), decoder=decoder)
+        self.assertEqual(updater._Q_inv_cache[2], 0)
+
+
+class PassThroughLearner(clda.Learner):
+    def calc_int_kin(self, current_state, target_state, decoder_output, task_state, state_order=None):
+        return current_state
+
+class TestLearner(unittest.TestCase):
+    def _feed(self, learner, samples):
+        for k in samples:
+            learner(np.mat([k, 10*k]).T, np.mat([k, -k, 1.]).T, None, None, 'target')
+
+    def test_wrap_around(self):
+        learner = PassThroughLearner(5)
+        self._feed(learner, range(8))
+        self.assertTrue(learner.is_ready())
+        self.assertEqual(learner.n_samples, 5)
+        batch = learner.get_batch()
+        # the oldest samples were overwritten, and the rest are in the order they arrived
+        self.assertTrue(isinstance(batch['intended_kin'], np.matrix))
+        self.assertTrue(np.array_equal(batch['intended_kin'][0], np.mat(range(3, 8))))
+        self.assertTrue(np.array_equal(batch['spike_counts'], np.mat([range(3, 8), range(30, 80, 10)])))
+        self.assertEqual(learner.n_samples, 0)
+
+        # the batch is handed off, so new samples do not overwrite it
+        self._feed(learner, range(20, 27))
+        self.assertTrue(np.array_equal(batch['intended_kin'][0], np.mat(range(3, 8))))
+        self.assertTrue(np.array_equal(learner.get_batch()['intended_kin'][0], np.mat(range(22, 27))))
+
+    def test_grow(self):
+        for n_first in [3, 4, 5]: # full, wrapped once, wrapped twice
+            learner = PassThroughLearner(3)
+            self._feed(learner, range(n_first))
+            learner.batch_size = 6
+            self._feed(learner, range(100, 103))
+            self.assertTrue(learner.is_ready())
+            batch = learner.get_batch()
+            self.assertTrue(np.array_equal(batch['intended_kin'][0], np.mat(range(n_first - 3, n_first) + range(100, 103))))
+
+        # partially filled buffers
+        learner = PassThroughLearner(3)
+        self._feed(learner, range(2))
+        learner.batch_size = 4
+        self._feed(learner, range(2, 4))
+        self.assertTrue(np.array_equal(learner.get_batch()['intended_kin'][0], np.mat(range(4))))
+
+    def test_reset_and_done_states(self):
+        learner = PassThroughLearner(10, done_states=['reward'], reset_states=['timeout_penalty'])
+        self._feed(learner, range(4))
+        learner(np.mat([0, 0]).T, np.mat([9, 9, 1.]).T, None, None, 'timeout_penalty')
+        self.assertEqual(learner.n_samples, 1)
+        learner(np.mat([0, 0]).T, np.mat([8, 8, 1.]).T, None, None, 'reward')
+        self.assertTrue(learner.is_ready())
+        self.assertTrue(np.array_equal(learner.get_batch()['intended_kin'][0], np.mat([9, 8])))
+
+class TestOFCLearner(unittest.TestCase):
+    def test_closed_loop_matrices(self):
+        A = np.mat(np.random.randn(3, 3))
+        B = np.mat(np.random.randn(3, 2))
+        F_dict = dict(target=np.mat(np.random.randn(2, 3)), hold=np.mat(np.random.randn(2, 3)))
+        learner = clda.OFCLearner(10, A, B, F_dict)
+
+        x, x_star = np.mat(np.random.randn(3, 1)), np.mat(np.random.randn(3, 1))
+        for task_state in ['target', 'hold']:
+            int_kin = learner.calc_int_kin(x, x_star, None, task_state)
+            self.assertTrue(np.allclose(int_kin, A*x + B*F_dict[task_state]*(x_star - x)))
+        self.assertEqual(learner.calc_int_kin(x, x_star, None, 'reward'), None)
+
+        # the cached matrices follow replacements of A, B and the gains
+        cached = learner._closed_loop_matrices('target', F_dict['target'])
+        self.assertTrue(learner._closed_loop_matrices('target', F_dict['target'])[0] is cached[0])
+        learner.A = np.mat(np.eye(3))
+        learner.B = np.mat(np.ones([3, 2]))
+        learner.F_dict['target'] = np.mat(np.ones([2, 3]))
+        self.assertTrue(np.allclose(learner.calc_int_kin(x, x_star, None, 'target'), 
+            x + learner.B*learner.F_dict['target']*(x_star - x)))
+
+
+class TestIntendedKinBatch(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.A = np.mat(np.random.randn(4, 4))
+        self.B = np.mat(np.random.randn(4, 2))
+        self.F_dict = dict(target=np.mat(np.random.randn(2, 4)), hold=np.mat(np.random.randn(2, 4)))
+        self.current_states = np.random.randn(4, 60)
+        self.target_states = np.random.randn(4, 60)
+        self.task_states = [['target', 'hold', 'wait'][k % 3] for k in range(60)] # no policy for 'wait'
+
+    def _check(self, learner):
+        int_kin, valid = learner.calc_int_kin_batch(self.current_states, self.target_states, self.current_states, self.task_states)
+        for k, task_state in enumerate(self.task_states):
+            int_kin_k = learner.calc_int_kin(np.mat(self.current_states[:,k]).T, np.mat(self.target_states[:,k]).T, 
+                None, task_state)
+            self.assertEqual(valid[k], int_kin_k is not None)
+            if valid[k]:
+                self.assertTrue(np.allclose(int_kin[:,k], np.asarray(int_kin_k).ravel()))
+            else:
+                self.assertTrue(np.all(np.isnan(int_kin[:,k])))
+        self.assertEqual(np.sum(valid), 40)
+
+    def test_ofc_learner(self):
+        self._check(clda.OFCLearner(10, self.A, self.B, self.F_dict))
+
+    def test_feedback_controller_learner(self):
+        ctrl = feedback_controllers.MultiModalLFC(A=self.A, B=self.B, F_dict=self.F_dict)
+        self._check(clda.FeedbackControllerLearner(10, ctrl))
+
+    def test_default_loop(self):
+        learner = clda.OFCLearner(10, self.A, self.B, self.F_dict)
+        int_kin, valid = clda.Learner.calc_int_kin_batch(learner, self.current_states, self.target_states, 
+            self.current_states, self.task_states)
+        int_kin_vec, valid_vec = learner.calc_int_kin_batch(self.current_states, self.target_states, 
+            self.current_states, self.task_states)
+        self.assertTrue(np.array_equal(valid, valid_vec))
+        self.assertTrue(np.allclose(int_kin[:,valid], int_kin_vec[:,valid]))
+
+class TestReplayUpdates(unittest.TestCase):
+    def test_matches_online(self):
+        import copy
+        from riglib.bmi import accumulator
+        from riglib.bmi.bmi import BMISystem
+        decoder = make_trained_kf_decoder()
+        seed_decoder = copy.deepcopy(decoder)
+        n_states = len(decoder.states)
+        A = np.asarray(decoder.filt.A)
+        B = np.vstack([np.zeros([3, 3]), np.eye(3), np.zeros([1, 3])])
+        F_dict = dict(target=0.2*np.random.randn(3, n_states), hold=0.2*np.random.randn(3, n_states))
+        make_learner = lambda: clda.OFCLearner(7, A, B, F_dict, done_states=['hold'], reset_states=['timeout_penalty'])
+
+        learner = make_learner()
+        bmi_system = BMISystem(decoder, learner, clda.KFRML(0.7, 5.), accumulator.NullAccumulator(1))
+        n_samples = 300
+        task_states = ((['target']*8 + ['hold']*2 + ['wait']*2 + ['timeout_penalty'] + ['target']*5) * 17)[:n_samples]
+        spike_counts = np.random.poisson(3, size=(15, n_samples)).astype(float)
+        target_states = np.random.randn(n_states, n_samples)
+        current_states = np.zeros([n_states, n_samples])
+        for k in range(n_samples):
+            current_states[:,k] = np.asarray(decoder.get_state()).ravel()
+            bmi_system(spike_counts[:,k:k+1], target_states[:,k:k+1], task_states[k], learn_flag=True)
+        online = bmi_system.param_hist
+        self.assertTrue(len(online) > 20)
+
+        replayed = clda.replay_updates(seed_decoder, make_learner(), clda.KFRML(0.7, 5.), spike_counts, 
+            current_states, target_states, task_states)
+        self.assertEqual(len(replayed), len(online))
+        for params, params_online in zip(replayed, online):
+            for key in ['intended_kin', 'spike_counts_batch', 'filt.C', 'filt.Q']:
+                self.assertTrue(np.allclose(params[key], params_online[key]))
+        self.assertTrue(np.allclose(seed_decoder.filt.C, decoder.filt.C))
+
+
+class MockUpdaterDecoder(object):
+    n_states = 3
+    n_features = 4
+    def __init__(self):
+        self.C = np.zeros([4, 3])
+
+    def update_params(self, new_params, **kwargs):
+        self.C = new_params['C']
+
+def updater_sum(intended_kin=None, spike_counts=None, decoder=None):
+    return dict(C=decoder.C + np.dot(spike_counts, intended_kin.T))
+
+class RecordingLearner(PassThroughLearner):
+    def get_batch(self):
+        batch = super(RecordingLearner, self).get_batch()
+        if not hasattr(self, 'batches'):
+            self.batches = []
+        self.batches.append(dict((key, batch[key].copy()) for key in ['intended_kin', 'spike_counts']))
+        return batch
+
+class ShortHistUpdater(clda.Updater):
+    latency_hist_len = 5
+
+class TestUpdater(unittest.TestCase):
+    def test_multiproc(self):
+        import time
+        updater = clda.Updater(updater_sum, multiproc=True)
+        updater.start(MockUpdaterDecoder(), batch_size=10)
+        try:
+            C = np.zeros([4, 3])
+            for n_obs in [10, 4, 12]:
+                x, y = np.random.randn(3, n_obs), np.random.randn(4, n_obs)
+                updater(intended_kin=x, spike_counts=y, decoder=None)
+                t_start = time.time()
+                while not updater.result_ready() and time.time() - t_start < 10:
+                    time.sleep(0.01)
+                # the worker applies each update to its copy of the decoder
+                C += np.dot(y, x.T)
+                self.assertTrue(np.allclose(updater.get_result()['C'], C))
+            self.assertEqual(updater.get_result(), None)
+            self.assertEqual(updater.latency_summary()['n_updates'], 3)
+        finally:
+            updater.calculator.stop()
+            updater.calculator.join(5)
+
+    def test_bmi_system_multiproc(self):
+        import copy
+        import time
+        from riglib.bmi import accumulator
+        from riglib.bmi.bmi import BMISystem
+        decoder = make_trained_kf_decoder()
+        ref_decoder = copy.deepcopy(decoder)
+        learner = RecordingLearner(5)
+        updater = clda.KFRML(0.3, 5.)
+        updater.multiproc = True
+        bmi_system = BMISystem(decoder, learner, updater, accumulator.NullAccumulator(1))
+        n_states = len(decoder.states)
+        try:
+            # the results arrive on later calls than the batches they were computed from
+            t_start = time.time()
+            n_calls = 0
+            while (n_calls < 60 or updater.n_pending > 0) and time.time() - t_start < 30:
+                bmi_system(np.random.poisson(3, size=(15, 1)).astype(float), np.random.randn(n_states, 1), 
+                    'target', learn_flag=n_calls < 60)
+                n_calls += 1
+                time.sleep(0.002)
+        finally:
+            updater.calculator.stop()
+            updater.calculator.join(5)
+        self.assertEqual(updater.n_pending, 0)
+        self.assertTrue(len(learner.batches) >= 5)
+        self.assertEqual(len(bmi_system.param_hist), len(learner.batches))
+
+        # each update is recorded with its batch, and matches the updates computed in this process
+        ref_updater = clda.KFRML(0.3, 5.)
+        ref_updater.init(ref_decoder)
+        for batch, new_params in zip(learner.batches, bmi_system.param_hist):
+            self.assertTrue(np.array_equal(new_params['intended_kin'], batch['intended_kin']))
+            self.assertTrue(np.array_equal(new_params['spike_counts_batch'], batch['spike_counts']))
+            ref_updater(intended_kin=batch['intended_kin'], spike_counts=batch['spike_counts'], decoder=ref_decoder)
+            ref_params = ref_updater.get_result()
+            ref_decoder.update_params(ref_params, **ref_updater.update_kwargs)
+            for key in ['filt.C', 'filt.Q', 'filt.C_xpose_Q_inv_C']:
+                self.assertTrue(np.allclose(new_params[key], ref_params[key]), key)
+        self.assertTrue(np.allclose(decoder.filt.C, ref_decoder.filt.C))
+
+    def test_latency_hist_bounded(self):
+        updater = ShortHistUpdater(lambda **kwargs: dict(), multiproc=False)
+        self.assertEqual(updater.latency_summary(), None)
+        for k in range(12):
+            updater()
+            self.assertEqual(updater.get_result(), dict())
+        self.assertEqual(len(updater.latency_hist), 5)
+        summary = updater.latency_summary()
+        self.assertEqual(summary['n_updates'], 12)
+        self.assertTrue(summary['max_latency'] >= summary['median_latency'])
+
+class TestKFSmoothbatch(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.n_states, self.n_units = 5, 12
+        self.drives_obs = np.array([True, False, True, True, True])
+        self.C = np.random.randn(self.n_units, self.n_states)
+
+    def _samples(self, n_samples):
+        X = np.vstack([np.random.randn(self.n_states - 1, n_samples), np.ones([1, n_samples])])
+        rates = np.exp(0.3*np.dot(self.C, X))
+        Y = np.random.poisson(rates).astype(np.float64)
+        Y[3] = 0 # silent unit
+        return X, Y
+
+    def _check_mle(self, suff_stats, X, Y, drives_obs):
+        C_hat, Q_hat, mFR, sdFR = clda.KFSmoothbatch.batch_mle(suff_stats, drives_obs)
+        C_ref, Q_ref = KalmanFilter.MLE_obs_model(X, Y, include_offset=False, drives_obs=drives_obs)
+        self.assertEqual(suff_stats.n, X.shape[1])
+        self.assertTrue(np.allclose(C_hat, np.asarray(C_ref), rtol=1e-7, atol=1e-8))
+        self.assertTrue(np.allclose(Q_hat, np.asarray(Q_ref), rtol=1e-7, atol=1e-8))
+        self.assertTrue(np.allclose(mFR, Y.mean(axis=1)))
+        self.assertTrue(np.allclose(sdFR, Y.std(axis=1)))
+
+    def test_batch_mle(self):
+        X, Y = self._samples(200)
+        self._check_mle(clda.BatchSuffStats.from_batch(X, Y), X, Y, self.drives_obs)
+
+        # rank-one updates, filling only the upper triangles of the symmetric sums
+        stats = clda.BatchSuffStats()
+        for k in range(X.shape[1]):
+            stats.add(X[:, k], Y[:, k])
+        self._check_mle(stats, X, Y, self.drives_obs)
+
+    def test_learner_downdates(self):
+        # the learner's buffer wraps around several times, so most of the samples are removed from the statistics again
+        learner = PassThroughLearner(60)
+        learner.suff_stats = clda.BatchSuffStats()
+        X, Y = self._samples(250)
+        for k in range(X.shape[1]):
+            learner(np.mat(Y[:, k]).T, np.mat(X[:, k]).T, None, None, 'target')
+        batch = learner.get_batch()
+        self.assertTrue(np.array_equal(batch['intended_kin'], X[:, -60:]))
+        self._check_mle(batch['suff_stats'], X[:, -60:], Y[:, -60:], self.drives_obs)
+
+        # the learner starts the next batch with new statistics
+        self.assertEqual(learner.suff_stats.n, 0)
+        self.assertIsNot(learner.suff_stats, batch['suff_stats'])
+
+    def test_rank_deficient_batch(self):
+        X, Y = self._samples(200)
+        Y[7] = Y[6] # duplicated unit: singular Q with a positive diagonal
+        X[2] = X[0] - X[4] # collinear states: singular X*X.T
+        stats = clda.BatchSuffStats()
+        for k in range(X.shape[1]):
+            stats.add(X[:, k], Y[:, k])
+        self._check_mle(stats, X, Y, np.ones(self.n_states, dtype=bool))
+
+        C_hat, Q_hat, mFR, sdFR = clda.KFSmoothbatch.batch_mle(stats, self.drives_obs)
+        self.assertEqual(np.linalg.matrix_rank(Q_hat), self.n_units - 2)
+        self.assertTrue(np.allclose(clda._psd_pinv(Q_hat), np.linalg.pinv(Q_hat)))
+
+        # batch shorter than the number of units
+        self.assertTrue(np.allclose(clda._psd_pinv(np.cov(Y[:, :6], bias=1)), np.linalg.pinv(np.cov(Y[:, :6], bias=1))))
+
+    def test_calc(self):
+        decoder = make_trained_kf_decoder(n_units=self.n_units)
+        n_states = len(decoder.states)
+        updater = clda.KFSmoothbatch(batch_time=1., half_life=10.)
+        X = np.vstack([np.random.randn(n_states - 1, 100), np.ones([1, 100])])
+        Y = np.random.poisson(3, size=(self.n_units, 100)).astype(np.float64)
+        Y[5] = Y[4]
+        stats = clda.BatchSuffStats()
+        for k in range(X.shape[1]):
+            stats.add(X[:, k], Y[:, k])
+
+        new_params = updater.calc(intended_kin=X, spike_counts=Y, decoder=decoder, suff_stats=stats)
+        new_params_ref = updater.calc(intended_kin=X, spike_counts=Y, decoder=decoder)
+        for key in updater.param_names:
+            self.assertTrue(np.allclose(new_params[key], new_params_ref[key]), key)
+
+        C, Q = new_params['kf.C'], new_params['kf.Q']
+        self.assertTrue(np.allclose(new_params['kf.C_xpose_Q_inv'], C.T * np.mat(np.linalg.pinv(Q))))
+
+
+###############################################################################
+## Feedback controllers #######################################################
+from riglib.bmi import feedback_controllers
+
+class TestFeedbackControllerBatch(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.A = np.mat(np.random.randn(4, 4))
+        self.B = np.mat(np.random.randn(4, 2))
+        self.F_dict = dict(target=np.mat(np.random.randn(2, 4)), hold=np.mat(np.random.randn(2, 4)))
+        self.current_states = np.random.randn(4, 50)
+        self.target_states = np.random.randn(4, 50)
+
+    def test_linear_batch(self):
+        ctrl = feedback_controllers.LinearFeedbackController(self.A, self.B, self.F_dict['target'])
+        next_states = ctrl.calc_next_state_batch(self.current_states, self.target_states)
+        self.assertEqual(next_states.shape, (4, 50))
+        for k in range(50):
+            x, x_star = np.mat(self.current_states[:,k]).T, np.mat(self.target_states[:,k]).T
+            expected = self.A*x + self.B*self.F_dict['target']*(x_star - x)
+            self.assertTrue(np.allclose(next_states[:,k], np.asarray(expected).ravel()))
+            self.assertTrue(np.allclose(ctrl.calc_next_state(x, x_star), expected))
+
+    def test_multimodal_batch(self):
+        ctrl = feedback_controllers.MultiModalLFC(A=self.A, B=self.B, F_dict=self.F_dict)
+        for mode in ['target', 'hold']:
+            next_states = ctrl.calc_next_state_batch(self.current_states, self.target_states, mode=mode)
+            for k in [0, 49]:
+                next_state = ctrl.calc_next_state(self.current_states[:,k], self.target_states[:,k], mode=mode)
+                self.assertTrue(np.allclose(next_states[:,k], np.asarray(next_state).ravel()))
+        self.assertRaises(KeyError, ctrl.calc_next_state_batch, self.current_states, self.target_states, mode='wait')
+
+
 ###############################################################################
 ## Goal calculators ###########################################################
 from riglib.bmi import goal_calculators, state_space_models
@@ -198,4 +1516,100 @@ class TestZeroVelocityGoal(unittest.TestCase):
         (goal_state, error), _ = goal_calc(target_pos)
 
         self.assertTrue(np.array_equal(goal_state.ravel(), np.array([0, 0, 0, 0, 0, 0, 1])))
-        
\ No newline at end of file
+        
+
+###############################################################################
+## HDF access #################################################################
+import tempfile
+import shutil
+import tables
+from riglib.bmi import hdf_access
+
+def get_plant_pos_vel_rowwise(files, binlen, tmask, update_rate_hz=60., pos_key='cursor', vel_key=None):
+    # reads the whole table and indexes the rows, as train.get_plant_pos_vel used to
+    if pos_key == 'plant_pos':
+        vel_key = 'plant_vel'
+    hdf = tables.open_file(files['hdf'])
+    try:
+        kin = hdf.root.task[:][pos_key]
+        inds, = np.nonzero(tmask)
+        if binlen/(1./update_rate_hz) < 1:
+            if vel_key is not None:
+                velocity = hdf.root.task[:][vel_key]
+            else:
+                velocity = np.vstack([np.zeros(kin.shape[1]), np.diff(kin, axis=0) * update_rate_hz])
+            kin = np.hstack([kin, velocity])
+            n_repeats = int((1./update_rate_hz)/binlen)
+            kin = kin[np.sort(np.hstack([inds]*n_repeats))]
+        else:
+            inds = inds[::int(binlen/(1./update_rate_hz))]
+            ix = np.nonzero(inds < len(kin))[0]
+            kin2 = np.zeros((len(inds), kin.shape[1]))
+            kin2[ix, :] = kin[inds[ix], :]
+            kin = kin2
+            if vel_key is not None:
+                velocity = np.zeros((len(inds), kin.shape[1]))
+                velocity[ix, :] = hdf.root.task[inds[ix]][vel_key]
+            else:
+                velocity = np.vstack([np.zeros(kin.shape[1]), np.diff(kin, axis=0) * 1./binlen])
+            kin = np.hstack([kin, velocity])
+    finally:
+        hdf.close()
+    return kin
+
+class TestHDFAccess(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmp_dir, 'task.hdf')
+        dtype = np.dtype([('cursor', np.float64, (3,)), ('plant_pos', np.float64, (3,)), ('plant_vel', np.float64, (3,)), 
+            ('spike_counts', np.uint16, (20,1))])
+        self.data = np.zeros(500, dtype=dtype)
+        self.data['cursor'] = np.random.randn(500, 3)
+        self.data['plant_pos'] = np.random.randn(500, 3)
+        self.data['plant_vel'] = np.random.randn(500, 3)
+        self.data['spike_counts'] = np.random.poisson(2, size=(500, 20, 1))
+        h5file = tables.open_file(self.fname, mode='w')
+        h5file.create_table('/', 'task', dtype).append(self.data)
+        h5file.close()
+
+    def tearDown(self):
+        hdf_access.pool.close_all()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_column_reads(self):
+        with hdf_access.open_hdf(self.fname) as hdf:
+            task = hdf.root.task
+            self.assertTrue(np.array_equal(hdf_access.read_column(task, 'cursor'), self.data['cursor']))
+            self.assertTrue(np.array_equal(hdf_access.read_column(task, 'spike_counts', start=10, stop=20), self.data['spike_counts'][10:20]))
+            inds = np.array([30, 12, 12, 499])
+            self.assertTrue(np.array_equal(hdf_access.read_column_rows(task, 'cursor', inds), self.data['cursor'][inds]))
+            self.assertRaises(IndexError, hdf_access.read_column_rows, task, 'cursor', np.array([10, 500]))
+
+    def test_handles_shared_in_session(self):
+        with hdf_access.session():
+            with hdf_access.open_hdf(self.fname) as hdf_1:
+                pass
+            with hdf_access.open_hdf(self.fname) as hdf_2:
+                self.assertTrue(hdf_1 is hdf_2)
+            self.assertTrue(hdf_1.isopen)
+        self.assertFalse(hdf_1.isopen)
+        self.assertEqual(hdf_access.pool.open_files, [])
+
+        # without a session, a handle is closed as soon as it is no longer used
+        with hdf_access.open_hdf(self.fname) as hdf:
+            with hdf_access.open_hdf(self.fname) as hdf_nested:
+                self.assertTrue(hdf is hdf_nested)
+            self.assertTrue(hdf.isopen)
+        self.assertFalse(hdf.isopen)
+
+    def test_plant_pos_vel(self):
+        files = dict(hdf=self.fname)
+        for binlen, start, n_rows in [(1./60, 10, 300), (0.1, 20, 600), (1./120, 0, 200), (1./120, 37, 200)]:
+            tmask = np.zeros(n_rows, dtype=bool)
+            tmask[start:] = True
+            for pos_key in ['cursor', 'plant_pos']:
+                kin = train.get_plant_pos_vel(files, binlen, tmask, pos_key=pos_key)
+                kin_ref = get_plant_pos_vel_rowwise(files, binlen, tmask, pos_key=pos_key)
+                self.assertEqual(kin.shape, kin_ref.shape)
+                self.assertTrue(np.allclose(kin, kin_ref, rtol=1e-12, atol=1e-12))
+        self.assertEqual(hdf_access.pool.open_files, [])
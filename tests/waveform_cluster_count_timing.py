@@ -0,0 +1,79 @@
+#!/usr/bin/python
+"""
+Benchmark the online waveform classification in WaveformClusterCountExtractor. 
+
+Simulates a 60 Hz task loop with spikes (and waveforms) arriving at plexon-like rates 
+and reports the time per cycle spent classifying the spikes, compared to the 
+cycle period. Also checks that the online classifier assigns each spike to the same 
+cluster as the offline sklearn model.
+"""
+import time
+import numpy as np
+from sklearn.mixture import GaussianMixture
+from riglib.bmi import extractor
+
+task_update_rate = 60.
+n_channels = 128
+units_per_channel = 3
+n_wf_pts = 32
+n_cycles = 600
+
+# fit a GMM to simulated waveforms on each channel
+units = np.array([(ch, u) for ch in range(1, n_channels+1) for u in range(1, units_per_channel+1)], dtype=np.int32)
+gmm_model_params = dict()
+gmms = dict()
+for ch in range(1, n_channels+1):
+    ch_units = units[units[:,0] == ch]
+    means = np.random.randn(units_per_channel, n_wf_pts) * 3
+    wfs = np.vstack([m + np.random.randn(300, n_wf_pts) for m in means])
+    gmm = GaussianMixture(n_components=units_per_channel, covariance_type='full').fit(wfs)
+    gmms[ch] = gmm
+    gmm_model_params[ch] = extractor.gmm_to_model_params(gmm, ch_units)
+    gmm_model_params[ch]['sim_means'] = means
+
+spike_dtype = np.dtype([("ts", np.float), ("chan", np.int32), ("unit", np.int32), ("arrival_ts", np.float64), 
+    ("waveform", np.float64, (n_wf_pts,))])
+
+def gen_spikes(n_spikes):
+    spikes = np.zeros(n_spikes, dtype=spike_dtype)
+    spikes['chan'] = np.random.randint(1, n_channels+1, size=n_spikes)
+    unit_inds = np.random.randint(0, units_per_channel, size=n_spikes)
+    means = np.array([gmm_model_params[ch]['sim_means'][u] for ch, u in zip(spikes['chan'], unit_inds)])
+    spikes['waveform'] = means + np.random.randn(n_spikes, n_wf_pts)
+    return spikes
+
+class SpikeBatchSource(object):
+    def __init__(self, batch):
+        self.batch = batch
+
+    def get(self):
+        return self.batch
+
+f_extractor = extractor.WaveformClusterCountExtractor(None, gmm_model_params, units=units)
+
+# check that the online classifier agrees with the offline model
+spikes = gen_spikes(5000)
+labels = f_extractor.classifier.predict(spikes['chan'], spikes['waveform'])
+n_agree = 0
+for ch in range(1, n_channels+1):
+    inds = spikes['chan'] == ch
+    if np.any(inds):
+        n_agree += np.sum(labels[inds] == gmms[ch].predict(spikes['waveform'][inds]))
+print 'Agreement with sklearn cluster assignments: %d / %d' % (n_agree, len(spikes))
+
+# time the extractor at increasing total spike rates (spikes/sec over all units)
+cycle_period = 1./task_update_rate
+for spike_rate in [5000, 20000, 50000, 100000]:
+    n_spikes = np.random.poisson(spike_rate * cycle_period, size=n_cycles)
+    batches = [gen_spikes(n) for n in n_spikes]
+
+    cycle_times = np.zeros(n_cycles)
+    for k, batch in enumerate(batches):
+        f_extractor.source = SpikeBatchSource(batch)
+        t_start = time.time()
+        f_extractor(k * cycle_period)
+        cycle_times[k] = time.time() - t_start
+
+    print '%6d spikes/s (%4d spikes/cycle): mean %.2f ms, max %.2f ms per cycle (%.1f%% of the %.1f ms cycle)' % (
+        spike_rate, np.mean(n_spikes), np.mean(cycle_times)*1000, np.max(cycle_times)*1000, 
+        np.mean(cycle_times)/cycle_period*100, cycle_period*1000)